@@ -31,6 +31,10 @@ try:
     # Tolerance
     clippingTolerance = 0.00000000001
 
+    # Tile prefetching (lib/tile_prefetch.py): tiles read ahead or waiting to be written, and the memory they may use
+    prefetchTiles = 2
+    prefetchMemoryMB = 256
+
 except Exception:
     arcpy.AddError("Configuration file not read successfully")
     raise
@@ -0,0 +1,15 @@
+'''
+arcpy_lock.py holds the lock for calling arcpy while other threads may be running.
+
+arcpy cannot be called from more than one thread at a time. The writer thread of lib/array_pipeline.py and the
+reader and writer threads of lib/tile_prefetch.py call arcpy through lib/raster_arrays.py, which holds this lock.
+Log messages (lib/log.py) also hold it. Other arcpy calls in the main thread must wait for the writes to finish first
+(array_pipeline.ArrayStore.waitForWrites).
+
+The lock is kept in its own module, which is not refreshed, so that every module shares the same lock.
+'''
+
+import threading
+
+# Reentrant, so a function holding the lock can call others which take it
+lock = threading.RLock()
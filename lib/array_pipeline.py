@@ -0,0 +1,199 @@
+'''
+array_pipeline.py passes rasters between the code blocks of a tool as NumPy arrays (with their georeferencing, as a
+lib/raster_arrays.RasterGrid), rather than each block saving its result and the next block reading it back.
+
+An ArrayStore holds the arrays by name. In memory mode:
+
+    - a block's result is kept in memory, and the next block gets it from the store rather than from disk
+    - final outputs are written by a writer thread while the following blocks run, and intermediate rasters
+      (e.g. the burned DEM in the scratch geodatabase) are not written at all
+    - with checkpoints on, intermediate rasters are also written, and checkpoint() waits for all writes to finish
+      before logging the block's progress, so a rerun can continue from that block
+    - without checkpoints, the blocks' progress is logged by finish(), once all the final outputs have been written
+
+Rasters not in the store (e.g. those made by geoprocessing tools, or by blocks skipped on a rerun) are read from disk.
+
+arcpy cannot be called from two threads at once. The writer thread holds lib/arcpy_lock.py, as do lib/raster_arrays.py
+and lib/log.py. Before making any other arcpy call (geoprocessing tools, cursors, arcpy.env) after a put(), the main
+thread must call waitForWrites().
+Without memory mode, the store writes each result straight away and reads every input from disk, as the blocks did
+before.
+'''
+
+import os
+import numpy as np
+
+import NB_EE.lib.log as log
+import NB_EE.lib.progress as progress
+import NB_EE.lib.raster_arrays as raster_arrays
+import NB_EE.lib.tiled_accumulation as tiled_accumulation
+import NB_EE.lib.tile_prefetch as tile_prefetch
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log, progress, raster_arrays, tiled_accumulation, tile_prefetch])
+
+
+class ArrayTileSource:
+
+    ''' Tile source (see lib/tiled_accumulation.py) reading windows of an array held in memory '''
+
+    def __init__(self, array):
+
+        self.array = array
+        self.rows, self.cols = array.shape
+
+    def read(self, rowStart, rowEnd, colStart, colEnd):
+
+        return self.array[rowStart:rowEnd, colStart:colEnd]
+
+
+class RasterWriter(tile_prefetch.BackgroundWriter):
+
+    ''' Writes arrays to rasters in a background thread, in the order they were queued '''
+
+    def __init__(self):
+
+        tile_prefetch.BackgroundWriter.__init__(self, raster_arrays.writeRaster, description='Raster')
+
+
+class ArrayStore:
+
+    '''
+    Arrays passed between code blocks. inMemory: keep arrays in memory and write final outputs in a writer thread.
+    checkpoints: in memory mode, also write intermediate rasters so that a rerun can continue from any block.
+    '''
+
+    def __init__(self, inMemory=False, checkpoints=False, scratchFolder=None):
+
+        self.inMemory = inMemory
+        self.checkpoints = checkpoints
+        self.scratchFolder = scratchFolder
+        self.arrays = {}
+        self.sharedFiles = []
+        self.pendingBlocks = []
+        self.writer = None
+
+        if inMemory:
+            self.writer = RasterWriter()
+            log.info('Intermediate rasters will be kept in memory')
+
+    def put(self, name, array, grid, raster, noDataValue=None, final=True):
+
+        '''
+        Stores the array as name. Final outputs are always written to raster, intermediate rasters only without memory
+        mode or with checkpoints on.
+        '''
+
+        if not self.inMemory:
+            raster_arrays.writeRaster(array, grid, raster, noDataValue)
+            return
+
+        self.arrays[name] = (array, grid)
+
+        if final or self.checkpoints:
+            self.writer.write(array, grid, raster, noDataValue)
+
+    def get(self, name, raster, dtype=np.float32):
+
+        ''' Returns the array and grid stored as name, or reads them from raster if the store does not hold them '''
+
+        if name in self.arrays:
+            array, grid = self.arrays[name]
+            return array.astype(dtype, copy=False), grid
+
+        self.waitForWrites()
+        return raster_arrays.readRaster(raster, dtype)
+
+    def grid(self, name, raster):
+
+        ''' Returns the grid of the array stored as name, or of raster if the store does not hold it '''
+
+        if name in self.arrays:
+            return self.arrays[name][1]
+
+        self.waitForWrites()
+        return raster_arrays.RasterTileSource(raster, None).grid()
+
+    def waitForWrites(self):
+
+        '''
+        Waits for the queued rasters to be written, before a raster released from the store is read from disk, or
+        before the main thread calls arcpy other than through lib/raster_arrays.py or lib/log.py
+        '''
+
+        if self.writer is not None:
+            self.writer.wait()
+
+    def holds(self, name):
+
+        return name in self.arrays
+
+    def release(self, name):
+
+        ''' Drops the array from memory once no later block needs it '''
+
+        self.arrays.pop(name, None)
+
+    def tileSource(self, name, raster, noDataValue, shared=False):
+
+        '''
+        Tile source for the array stored as name, or for raster if the store does not hold it.
+        shared: the source is passed to worker processes, so arrays in memory are saved to a .npy file they can read.
+        '''
+
+        if name not in self.arrays:
+            self.waitForWrites()
+            return raster_arrays.RasterTileSource(raster, noDataValue)
+
+        array = self.arrays[name][0]
+        if not shared:
+            return ArrayTileSource(array)
+
+        npyFile = os.path.join(self.scratchFolder, 'store_' + name + '.npy')
+        np.save(npyFile, array)
+        self.sharedFiles.append(npyFile)
+
+        return tiled_accumulation.NumpyTileSource(npyFile)
+
+    def checkpoint(self, codeBlock, outputFolder):
+
+        '''
+        Logs the code block's progress, as progress.logProgress. In memory mode, progress is logged with checkpoints on
+        once the block's rasters have been written, and otherwise by finish(), as a rerun cannot continue from arrays
+        in memory.
+        '''
+
+        if not self.inMemory:
+            progress.logProgress(codeBlock, outputFolder)
+
+        elif self.checkpoints:
+            self.writer.wait()
+            progress.logProgress(codeBlock, outputFolder)
+
+        else:
+            self.pendingBlocks.append((codeBlock, outputFolder))
+
+    def finish(self, logPending=True):
+
+        '''
+        Waits for all rasters to be written and frees the arrays. logPending: log the progress of the code blocks whose
+        outputs were held in memory (False when the tool has failed).
+        '''
+
+        self.arrays = {}
+
+        for npyFile in self.sharedFiles:
+            if os.path.exists(npyFile):
+                os.remove(npyFile)
+        self.sharedFiles = []
+
+        if self.writer is not None:
+            try:
+                self.writer.wait()
+            finally:
+                self.writer.close()
+                self.writer = None
+
+        if logPending:
+            for codeBlock, outputFolder in self.pendingBlocks:
+                progress.logProgress(codeBlock, outputFolder)
+        self.pendingBlocks = []
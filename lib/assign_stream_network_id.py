@@ -1,168 +1,232 @@
 import arcpy
 import os
+import numpy as np
+
+try:
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+except ImportError:
+    connected_components = None
 
 import NB_EE.lib.log as log
+import NB_EE.lib.instrumentation as instrumentation
+import NB_EE.lib.stream_network_index as stream_network_index
 from NB_EE.lib.refresh_modules import refresh_modules
-refresh_modules([log])
+refresh_modules([log, instrumentation, stream_network_index])
 
-def function(streams, streamNetworks, fromNodeField, toNodeField, streamSegments=[]):
 
-    class StreamSeg:
+def findRoot(parent, node):
 
-        def __init__(self, ID, fromNode, toNode, streamNetworkID=None):
-            self.ID = ID
-            self.fromNode = fromNode
-            self.toNode = toNode
-            self.streamNetworkID = streamNetworkID
+    ''' Finds the root of node in the disjoint-set forest, pointing every node on the path directly at the root '''
 
+    root = node
+    while parent[root] != root:
+        root = parent[root]
 
-    #############################
-    ### Create stream network ###
-    #############################
+    while parent[node] != root:
+        parent[node], node = root, parent[node]
 
-    try:
-        # Initialise temporary variables
-        prefix = "genStrNet_"
-        streamsCopy = os.path.join(arcpy.env.scratchFolder, prefix + "streamsCopy.shp")
+    return root
 
-        if streamSegments == []:
 
-            # Populate stream segments list, so can access quicker and easier than using search cursors
-            with arcpy.da.SearchCursor(streams, ["SEGMENT_ID", fromNodeField, toNodeField]) as searchCursor:
+def labelStreamNetworks(streamSegments):
 
-                for row in searchCursor:
+    '''
+    Gives each stream segment the ID of the stream network (connected set of segments) it belongs to.
+    The segments' from and to nodes are joined with a disjoint-set (union-find, with path compression and union by rank),
+    then networks are numbered consecutively from 1 in the order of their first segment in the list.
+    Returns the number of stream networks.
+    '''
 
-                    streamSegID = row[0]
-                    fromNode = int(row[1])
-                    toNode = int(row[2])
+    parent = {}
+    rank = {}
 
-                    streamSegments.append(StreamSeg(streamSegID, fromNode, toNode))
+    # Single pass over the segments, joining the sets of each segment's two end nodes
+    for streamSeg in streamSegments:
 
-            log.info('Streams loaded into memory from file')
-        
-        # Sort stream segments list into from node order
-        streamSegments.sort(key=lambda x: x.fromNode)
+        for node in (streamSeg.fromNode, streamSeg.toNode):
+            if node not in parent:
+                parent[node] = node
+                rank[node] = 0
 
-        # Create dictionary for 'from' nodes to make accessing them faster in loop later on
-        fromNodeDict = {}
-        prevNode = -1
-        IDlist = []
+        fromRoot = findRoot(parent, streamSeg.fromNode)
+        toRoot = findRoot(parent, streamSeg.toNode)
 
-        for streamSeg in streamSegments:
-            currNode = streamSeg.fromNode
+        if fromRoot != toRoot:
+            if rank[fromRoot] < rank[toRoot]:
+                fromRoot, toRoot = toRoot, fromRoot
 
-            if currNode == prevNode:
-                IDlist.append(streamSeg.ID)
-            else:
-                fromNodeDict[prevNode] = IDlist
-                IDlist = [streamSeg.ID]
+            parent[toRoot] = fromRoot
+            if rank[fromRoot] == rank[toRoot]:
+                rank[fromRoot] += 1
 
-            prevNode = currNode
+    # Number the networks in the order they are first seen
+    networkIDs = {}
+    for streamSeg in streamSegments:
 
-        # Write last node to dictionary
-        fromNodeDict[prevNode] = IDlist
+        root = findRoot(parent, streamSeg.fromNode)
+        if root not in networkIDs:
+            networkIDs[root] = len(networkIDs) + 1
 
-        # Sort stream segments list into to node order
-        streamSegments.sort(key=lambda x: x.toNode)
+        streamSeg.streamNetworkID = networkIDs[root]
 
-        # Create dictionary for 'to' nodes to make accessing them faster in loop later on
-        toNodeDict = {}
-        prevNode = -1
-        IDlist = []
+    return len(networkIDs)
 
-        for streamSeg in streamSegments:
-            currNode = streamSeg.toNode
 
-            if currNode == prevNode:
-                IDlist.append(streamSeg.ID)
-            else:
-                toNodeDict[prevNode] = IDlist
-                IDlist = [streamSeg.ID]
+def labelStreamNetworkArrays(fromNodes, toNodes):
 
-            prevNode = currNode
+    '''
+    Vectorised version of labelStreamNetworks for arrays of from and to node IDs (one element per segment).
+    Node IDs are mapped to dense indexes, the connected components of the node adjacency graph are found with
+    scipy.sparse.csgraph, and the components are renumbered from 1 in the order of their first segment.
+    Returns the array of stream network IDs and the number of stream networks.
+    '''
 
-        # Write last node to dictionary
-        toNodeDict[prevNode] = IDlist
+    fromNodes = np.asarray(fromNodes, dtype=np.int64)
+    toNodes = np.asarray(toNodes, dtype=np.int64)
+    numSegments = len(fromNodes)
 
-        # Sort stream segments back into ID order
-        streamSegments.sort(key=lambda x: x.ID)
+    if numSegments == 0:
+        return np.zeros(0, dtype=np.int32), 0
 
-        # Loop through stream segments giving them a stream network ID
-        log.info('Assigning stream network IDs to streams')
-        streamNetworkID = 1
-        streamNodes = []
+    nodeIDs, inverse = np.unique(np.concatenate([fromNodes, toNodes]), return_inverse=True)
+    fromIndex = inverse[:numSegments]
+    toIndex = inverse[numSegments:]
+    numNodes = len(nodeIDs)
 
-        for streamSeg in streamSegments:
+    if connected_components is not None:
+        adjacency = coo_matrix((np.ones(numSegments, dtype=np.int8), (fromIndex, toIndex)), shape=(numNodes, numNodes))
+        numComponents, nodeLabels = connected_components(adjacency, directed=False)
 
-            if streamSeg.streamNetworkID is None:
+    else:
+        # scipy not available, so join the nodes with the union-find labelling
+        class NodePair:
+            def __init__(self, fromNode, toNode):
+                self.fromNode = fromNode
+                self.toNode = toNode
 
-                # Give stream segment SNID
-                streamSeg.streamNetworkID = streamNetworkID
+        pairs = [NodePair(f, t) for f, t in zip(fromIndex.tolist(), toIndex.tolist())]
+        labelStreamNetworks(pairs)
+        nodeLabels = np.zeros(numNodes, dtype=np.int64)
+        nodeLabels[fromIndex] = [pair.streamNetworkID for pair in pairs]
+
+    segmentLabels = nodeLabels[fromIndex]
 
-                # Add both nodes to stream nodes list
-                streamNodes.append(streamSeg.fromNode)
-                streamNodes.append(streamSeg.toNode)
+    # Renumber the components in first seen order
+    components, firstSegment = np.unique(segmentLabels, return_index=True)
+    renumber = np.zeros(components.max() + 1, dtype=np.int32)
+    renumber[components[np.argsort(firstSegment)]] = np.arange(1, len(components) + 1, dtype=np.int32)
 
-                # While stream nodes list is not empty
-                while len(streamNodes):
+    return renumber[segmentLabels], len(components)
 
-                    nodeToFind = streamNodes[0]
+def writeStreamNetworks(streams, streamNetworks, streamSegments, maxStreamNetworkID):
 
-                    # Get all other segments with the matching node
-                    linkedSegmentIDs = []
+    '''
+    Writes one multipart polyline per stream network to streamNetworks, with the network ID in the STREAM_NO field.
+    The segment geometries are read with one cursor pass and grouped by network in memory, with each segment's
+    parts becoming parts of its network's polyline.
+    '''
 
-                    try:
-                        linkedSegmentIDs += fromNodeDict[nodeToFind]
-                    except KeyError:
-                        pass
+    spatialRef = arcpy.Describe(streams).spatialReference
 
-                    try:
-                        linkedSegmentIDs += toNodeDict[nodeToFind]
-                    except KeyError:
-                        pass
+    networkParts = [[] for i in range(0, maxStreamNetworkID + 1)]
+    with arcpy.da.SearchCursor(streams, ["SEGMENT_ID", "SHAPE@"]) as searchCursor:
 
-                    for i in linkedSegmentIDs:
+        for row in searchCursor:
+            streamSegID = row[0]
+            shape = row[1]
 
-                        if streamSeg.ID != streamSegments[i].ID and streamSegments[i].streamNetworkID is None:
+            if shape is None:
+                continue
 
-                            # Give segment a stream network ID
-                            streamSegments[i].streamNetworkID = streamNetworkID
+            streamNetworkID = streamSegments[streamSegID].streamNetworkID
+            for part in shape:
+                networkParts[streamNetworkID].append(arcpy.Array([point for point in part if point is not None]))
 
-                            # Add new node to stream nodes list
-                            endNodes = [streamSegments[i].fromNode, streamSegments[i].toNode]
-                            endNodes.remove(nodeToFind)
-                            streamNodes = streamNodes + endNodes
+    instrumentation.count('cursor rows', len(streamSegments))
 
-                    # Remove processed node from stream nodes list
-                    streamNodes.pop(0)
+    arcpy.CreateFeatureclass_management(os.path.dirname(streamNetworks), os.path.basename(streamNetworks), 'POLYLINE', spatial_reference=spatialRef)
+    arcpy.AddField_management(streamNetworks, "STREAM_NO", "LONG")
 
-                # Increment stream network ID
-                streamNetworkID = streamNetworkID + 1
+    with arcpy.da.InsertCursor(streamNetworks, ["SHAPE@", "STREAM_NO"]) as insertCursor:
 
-        maxStreamNetworkID = streamNetworkID - 1
+        for streamNetworkID in range(1, maxStreamNetworkID + 1):
+            if len(networkParts[streamNetworkID]) > 0:
+                polyline = arcpy.Polyline(arcpy.Array(networkParts[streamNetworkID]), spatialRef)
+                insertCursor.insertRow((polyline, streamNetworkID))
 
-        # Create copy of stream display shapefile
-        arcpy.CopyFeatures_management(streams, streamsCopy)
+    # Shapefiles are created with a default Id field, which the dissolved output did not have
+    if streamNetworks.lower().endswith('.shp'):
+        arcpy.DeleteField_management(streamNetworks, "Id")
 
-        # Update streams file with stream network id
-        log.info('Updating stream file with stream network ID')
-        arcpy.AddField_management(streamsCopy, "STREAM_NO", "LONG")
+    return streamNetworks
 
-        with arcpy.da.UpdateCursor(streamsCopy, ["SEGMENT_ID", "STREAM_NO"]) as updateCursor:
 
-            for row in updateCursor:
+def function(streams, streamNetworks, fromNodeField, toNodeField, streamSegments=[]):
 
-                streamSegID = row[0]
-                row[1] = streamSegments[streamSegID].streamNetworkID
+    class StreamSeg:
 
-                try:
-                    updateCursor.updateRow(row)
-                except Exception:
-                    pass
+        def __init__(self, ID, fromNode, toNode, streamNetworkID=None):
+            self.ID = ID
+            self.fromNode = fromNode
+            self.toNode = toNode
+            self.streamNetworkID = streamNetworkID
+
+
+    #############################
+    ### Create stream network ###
+    #############################
+
+    try:
+        instrumentation.startPhase('network labelling')
+
+        if streamSegments == []:
+
+            # Read the segment IDs and nodes into arrays in one pass and label the networks without looping over the segments
+            fields = arcpy.da.FeatureClassToNumPyArray(streams, ["SEGMENT_ID", fromNodeField, toNodeField])
+            instrumentation.count('cursor rows', len(fields))
+            log.info('Streams loaded into memory from file')
+
+            fields = fields[np.argsort(fields["SEGMENT_ID"], kind='mergesort')]
+            networkIDs, maxStreamNetworkID = labelStreamNetworkArrays(fields[fromNodeField], fields[toNodeField])
+
+            # Populate stream segments list, so can access quicker and easier than using search cursors
+            streamSegments = [StreamSeg(streamSegID, fromNode, toNode, streamNetworkID)
+                              for streamSegID, fromNode, toNode, streamNetworkID
+                              in zip(fields["SEGMENT_ID"].tolist(), fields[fromNodeField].astype(np.int64).tolist(),
+                                     fields[toNodeField].astype(np.int64).tolist(), networkIDs.tolist())]
+
+        # Stream network IDs may already have been assigned (e.g. from the cached stream topology or the array read above)
+        if len(streamSegments) > 0 and None not in [streamSeg.streamNetworkID for streamSeg in streamSegments]:
+
+            log.info('Stream network IDs already assigned')
+            streamSegments.sort(key=lambda x: x.ID)
+            maxStreamNetworkID = max([streamSeg.streamNetworkID for streamSeg in streamSegments])
+
+        else:
+            # Sort stream segments into ID order
+            streamSegments.sort(key=lambda x: x.ID)
+
+            log.info('Assigning stream network IDs to streams')
+            fromNodes = np.fromiter((streamSeg.fromNode for streamSeg in streamSegments), dtype=np.int64, count=len(streamSegments))
+            toNodes = np.fromiter((streamSeg.toNode for streamSeg in streamSegments), dtype=np.int64, count=len(streamSegments))
+            networkIDs, maxStreamNetworkID = labelStreamNetworkArrays(fromNodes, toNodes)
+
+            for streamSeg, streamNetworkID in zip(streamSegments, networkIDs.tolist()):
+                streamSeg.streamNetworkID = streamNetworkID
+
+        instrumentation.startPhase('network output')
 
         # Create streams shapefile, with one stream network per row
-        log.info('Dissolving streams to create stream networks file')
-        arcpy.Dissolve_management(streamsCopy, streamNetworks, ["STREAM_NO"], "", "MULTI_PART", "DISSOLVE_LINES")
+        log.info('Writing stream networks file')
+        writeStreamNetworks(streams, streamNetworks, streamSegments, maxStreamNetworkID)
+
+        # The networks have been renumbered, so an index left by stream_network_index.update() no longer matches them
+        indexFile = stream_network_index.indexPath(streamNetworks)
+        if os.path.exists(indexFile):
+            os.remove(indexFile)
+
+        instrumentation.endPhase()
 
         return streamSegments, maxStreamNetworkID
 
@@ -0,0 +1,145 @@
+'''
+flow_accumulation.py calculates flow accumulation from a D8 flow direction array (1 - 128 encoding, as created by
+arcpy.sa.FlowDirection or lib/flow_direction.py) in linear time with NumPy.
+
+As with arcpy.sa.FlowAccumulation, the accumulation of a cell is the number of cells (or the total weight of the
+cells) which flow into it, not including the cell itself.
+
+The number of donors (in-degree) of each cell is found from the flow directions. Cells with no donors form the
+first wave. Each wave adds its cells' flow to their downstream cells in one vectorised np.add.at call, and the
+downstream cells whose donors have now all been processed form the next wave. Each cell is processed once.
+'''
+
+import numpy as np
+
+# Row and column shift of the downstream cell for each flow direction code
+directionShifts = {1: (0, 1), 2: (1, 1), 4: (1, 0), 8: (1, -1), 16: (0, -1), 32: (-1, -1), 64: (-1, 0), 128: (-1, 1)}
+
+
+def indexType(numCells):
+
+    if numCells < np.iinfo(np.int32).max:
+        return np.int32
+    else:
+        return np.int64
+
+
+def receivers(fdr):
+
+    '''
+    Flat index of the downstream cell of each cell. Cells which flow out of the array, into a NoData cell,
+    or which have no (or an invalid) flow direction have a receiver of -1.
+    '''
+
+    rows, cols = fdr.shape
+    dtype = indexType(rows * cols)
+
+    # Indexes are int32 where they fit, to halve the memory of these full size arrays
+    rowShift = np.zeros(256, dtype=dtype)
+    colShift = np.zeros(256, dtype=dtype)
+    isDirection = np.zeros(256, dtype=bool)
+
+    for code in directionShifts:
+        rowShift[code], colShift[code] = directionShifts[code]
+        isDirection[code] = True
+
+    codes = fdr.astype(np.uint8, copy=False)
+    rowIndexes = np.arange(rows, dtype=dtype)[:, None] + rowShift[codes]
+    colIndexes = np.arange(cols, dtype=dtype)[None, :] + colShift[codes]
+
+    inside = isDirection[codes] & (rowIndexes >= 0) & (rowIndexes < rows) & (colIndexes >= 0) & (colIndexes < cols)
+    receiver = np.where(inside, rowIndexes * dtype(cols) + colIndexes, dtype(-1)).ravel()
+    del rowIndexes, colIndexes
+
+    # Cells flowing into a NoData cell flow out of the DEM
+    hasReceiver = receiver >= 0
+    receiverValid = np.zeros(len(receiver), dtype=bool)
+    receiverValid[hasReceiver] = isDirection[codes.ravel()[receiver[hasReceiver]]] | (codes.ravel()[receiver[hasReceiver]] == 0)
+    receiver[~receiverValid] = -1
+
+    return receiver
+
+
+def validDirections(fdr):
+
+    ''' Mask of the cells of fdr with a valid flow direction (0 for no outflow, or one of the eight direction codes) '''
+
+    validDirection = np.zeros(256, dtype=bool)
+    validDirection[0] = True
+    for code in directionShifts:
+        validDirection[code] = True
+
+    return validDirection[fdr.astype(np.uint8, copy=False)]
+
+
+def accumulate(fdr, weights=None, dtype=np.float64):
+
+    '''
+    Calculates the flow accumulation of each cell from the flow direction array fdr.
+    weights: optional array of the same shape giving each cell's contribution (NaN is treated as 0). Default 1 per cell.
+    dtype: type used to sum the flows. float32 halves the memory needed on very large DEMs, at the cost of precision
+    for accumulations above 2^24 cells.
+    Returns a float32 array. Cells with NoData flow direction (not 0 - 128) are NaN.
+    '''
+
+    rows, cols = fdr.shape
+
+    receiver = receivers(fdr)
+    valid = validDirections(fdr).ravel()
+
+    if weights is None:
+        flow = valid.astype(dtype)
+    else:
+        flow = np.nan_to_num(np.asarray(weights, dtype=dtype).ravel())
+        flow[~valid] = 0
+
+    accumulation = propagate(receiver, flow, valid)
+
+    result = accumulation.astype(np.float32).reshape(rows, cols)
+    result[~valid.reshape(rows, cols)] = np.nan
+
+    return result
+
+
+def propagate(receiver, flow, active):
+
+    '''
+    Sums flow down a graph in which each node has at most one downstream node (receiver, -1 for none), in waves
+    of nodes whose donors have all been processed. Only active nodes start waves.
+    Returns the total flow into each node (not including the node's own flow), in the type of flow.
+    '''
+
+    accumulation = np.zeros(len(receiver), dtype=flow.dtype)
+
+    hasReceiver = receiver >= 0
+    inDegree = np.bincount(receiver[hasReceiver], minlength=len(receiver)).astype(np.int32)
+
+    wave = np.flatnonzero(active & (inDegree == 0)).astype(receiver.dtype)
+
+    while len(wave) > 0:
+
+        # Total flow leaving each node in the wave
+        outflow = flow[wave] + accumulation[wave]
+
+        downstream = receiver[wave]
+        keep = downstream >= 0
+        downstream = downstream[keep]
+
+        np.add.at(accumulation, downstream, outflow[keep])
+        np.add.at(inDegree, downstream, -1)
+
+        # Downstream nodes with all their donors processed form the next wave
+        wave = np.unique(downstream[inDegree[downstream] == 0])
+
+    return accumulation
+
+
+def integerView(accumulation, noDataValue=-1):
+
+    ''' Integer version of the accumulation (truncated, as arcpy.sa.Int), with NaN cells set to noDataValue '''
+
+    integer = np.full(accumulation.shape, noDataValue, dtype=np.int32)
+    valid = ~np.isnan(accumulation)
+    integer[valid] = accumulation[valid].astype(np.int32)
+
+    return integer
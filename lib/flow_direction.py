@@ -0,0 +1,220 @@
+'''
+flow_direction.py calculates D8 flow directions from a (filled) DEM array with NumPy, using the same encoding
+as arcpy.sa.FlowDirection:
+
+    32  64  128
+    16   x    1
+     8   4    2
+
+Each cell flows to the neighbour with the steepest drop, with diagonal drops divided by sqrt(2). The eight drops
+are found with shifted slices of the whole array rather than per cell loops.
+
+Cells on the edge of the DEM, or next to NoData, flow out of the DEM if none of their neighbours is lower
+(as with the NORMAL option of FlowDirection).
+
+Flats (connected cells of equal elevation with no downslope neighbour) are resolved as in Garbrecht & Martz (1997),
+following the implementation of Barnes, Lehman & Mulla (2014, "An efficient assignment of drainage direction over
+flat surfaces in raster digital elevation models"): a gradient towards lower terrain (distance from the flat's outlet
+cells) is combined with a gradient away from higher terrain (distance from the flat's edges with higher cells),
+each found by a breadth first search over the flat which expands a whole frontier of cells at a time.
+'''
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# (row shift, column shift, flow direction code) in the order used to break ties between equal drops
+directions = [(0, 1, 1), (1, 1, 2), (1, 0, 4), (1, -1, 8), (0, -1, 16), (-1, -1, 32), (-1, 0, 64), (-1, 1, 128)]
+
+noDataCode = 255
+
+
+def shifted(padded, rowShift, colShift):
+
+    ''' View of the padded array giving, for each interior cell, the value of its neighbour in the given direction '''
+
+    rows, cols = padded.shape
+    return padded[1 + rowShift:rows - 1 + rowShift, 1 + colShift:cols - 1 + colShift]
+
+
+def neighbourOffsets(cols):
+
+    return np.array([rowShift * cols + colShift for rowShift, colShift, code in directions], dtype=np.int64)
+
+
+def breadthFirstDistances(seeds, inFlat, elevations, offsets, startDistance):
+
+    '''
+    Distance (in cells) from the seed cells to each cell of inFlat reachable through cells of equal elevation.
+    All arrays are flat (raveled padded arrays). The search expands the whole frontier at once.
+    Unreached cells have distance 0.
+    '''
+
+    distances = np.zeros(len(inFlat), dtype=np.int32)
+    visited = np.zeros(len(inFlat), dtype=bool)
+    visited[seeds] = True
+
+    frontier = seeds
+    distance = startDistance
+    distances[frontier] = distance
+
+    while len(frontier) > 0:
+        distance += 1
+
+        neighbours = (frontier[:, None] + offsets[None, :])
+        sameLevel = elevations[neighbours] == elevations[frontier][:, None]
+        neighbours = neighbours[sameLevel & inFlat[neighbours] & ~visited[neighbours]]
+
+        frontier = np.unique(neighbours)
+        visited[frontier] = True
+        distances[frontier] = distance
+
+    return distances
+
+
+def steepestDescent(padded):
+
+    '''
+    D8 steepest descent directions for the interior of the NaN padded DEM. Cells with no lower neighbour which are
+    next to the edge or NoData flow out of the DEM. Returns the directions (0 where there is no outflow, and for
+    NoData cells) and a mask of cells with a neighbour of equal elevation.
+    '''
+
+    rows = padded.shape[0] - 2
+    cols = padded.shape[1] - 2
+    valid = ~np.isnan(padded[1:-1, 1:-1])
+
+    maxDrop = np.full((rows, cols), -np.inf, dtype=padded.dtype)
+    fdr = np.zeros((rows, cols), dtype=np.uint8)
+    outwardCode = np.zeros((rows, cols), dtype=np.uint8)
+    hasEqualNeighbour = np.zeros((rows, cols), dtype=bool)
+
+    centre = padded[1:-1, 1:-1]
+
+    with np.errstate(invalid='ignore'):
+        for rowShift, colShift, code in directions:
+
+            neighbour = shifted(padded, rowShift, colShift)
+            # A Python float, so that the drops keep the DEM's precision
+            distance = float(np.sqrt(2.0)) if rowShift != 0 and colShift != 0 else 1.0
+            drop = (centre - neighbour) / distance
+            neighbourInvalid = np.isnan(neighbour)
+
+            steeper = drop > maxDrop
+            maxDrop[steeper] = drop[steeper]
+            fdr[steeper & (drop > 0)] = code
+
+            # First direction out of the DEM (edge or NoData), for cells with no lower neighbour
+            outward = neighbourInvalid & (outwardCode == 0)
+            outwardCode[outward] = code
+
+            hasEqualNeighbour |= drop == 0
+
+    fdr[maxDrop <= 0] = 0
+    flowsOut = valid & (fdr == 0) & (outwardCode > 0)
+    fdr[flowsOut] = outwardCode[flowsOut]
+
+    return fdr, hasEqualNeighbour
+
+
+def flowDirection(dem):
+
+    '''
+    Calculates the D8 flow direction of each cell of dem (2D array, NoData as NaN).
+    Returns a uint8 array of direction codes (1 - 128). NoData cells are 255, and cells with no outflow
+    (pits, or flats with no outlet) are 0.
+    '''
+
+    # Padded in the DEM's own precision (float32 for rasters read with lib/raster_arrays.py), to save memory
+    rows, cols = dem.shape
+    padded = np.full((rows + 2, cols + 2), np.nan, dtype=np.result_type(dem.dtype, np.float32))
+    padded[1:-1, 1:-1] = dem
+
+    valid = ~np.isnan(dem)
+
+    fdr, hasEqualNeighbour = steepestDescent(padded)
+
+    #####################
+    ### Resolve flats ###
+    #####################
+
+    flat = valid & (fdr == 0) & hasEqualNeighbour
+
+    if flat.any():
+        resolveFlats(padded, fdr, flat)
+
+    fdr[~valid] = noDataCode
+
+    return fdr
+
+
+def resolveFlats(padded, fdr, flat):
+
+    ''' Gives the flat cells (those with no downslope neighbour) directions across the flat towards its outlets '''
+
+    rows, cols = fdr.shape
+    paddedCols = cols + 2
+    offsets = neighbourOffsets(paddedCols)
+
+    # Flat arrays over the padded grid, with a border of cells that are never in a flat
+    elevations = padded.ravel()
+    flatCells = np.zeros(padded.shape, dtype=bool)
+    flatCells[1:-1, 1:-1] = flat
+    flatCells = flatCells.ravel()
+
+    hasDirection = np.zeros(padded.shape, dtype=bool)
+    hasDirection[1:-1, 1:-1] = (fdr > 0) & (fdr != noDataCode)
+    hasDirection = hasDirection.ravel()
+
+    flatIndexes = np.flatnonzero(flatCells)
+    neighbours = flatIndexes[:, None] + offsets[None, :]
+    sameLevel = elevations[neighbours] == elevations[flatIndexes][:, None]
+
+    # Low edges: cells with a direction, next to a flat cell of the same elevation
+    lowEdges = np.unique(neighbours[sameLevel & hasDirection[neighbours]])
+
+    # High edges: flat cells next to a higher cell
+    with np.errstate(invalid='ignore'):
+        higher = (elevations[neighbours] > elevations[flatIndexes][:, None]).any(axis=1)
+    highEdges = flatIndexes[higher]
+
+    # Label each flat (flat cells and their low edges, joined through cells of equal elevation)
+    inFlatOrLowEdge = flatCells.copy()
+    inFlatOrLowEdge[lowEdges] = True
+
+    pairFrom = np.repeat(flatIndexes, len(offsets)).reshape(neighbours.shape)
+    joined = sameLevel & inFlatOrLowEdge[neighbours]
+    cellIDs = np.full(len(elevations), -1, dtype=np.int64)
+    members = np.flatnonzero(inFlatOrLowEdge)
+    cellIDs[members] = np.arange(len(members))
+
+    graph = coo_matrix((np.ones(joined.sum(), dtype=np.int8), (cellIDs[pairFrom[joined]], cellIDs[neighbours[joined]])),
+                       shape=(len(members), len(members)))
+    numLabels, memberLabels = connected_components(graph, directed=False)
+    labels = np.full(len(elevations), -1, dtype=np.int64)
+    labels[members] = memberLabels
+
+    # Gradient towards lower terrain: distance from the low edges (which have distance 0)
+    towards = breadthFirstDistances(lowEdges, flatCells, elevations, offsets, 0)
+
+    # Gradient away from higher terrain: distance from the high edges (which have distance 1)
+    away = breadthFirstDistances(highEdges, flatCells, elevations, offsets, 1)
+
+    flatHeight = np.zeros(numLabels, dtype=np.int32)
+    np.maximum.at(flatHeight, labels[flatIndexes], away[flatIndexes])
+
+    # Combined gradient. Towards lower terrain is doubled so that it always dominates.
+    mask = np.zeros(len(elevations), dtype=np.int64)
+    awayTerm = np.where(away[flatIndexes] > 0, flatHeight[labels[flatIndexes]] - away[flatIndexes] + 1, 0)
+    mask[flatIndexes] = 2 * towards[flatIndexes] + awayTerm
+
+    # Flow to the neighbour in the same flat with the lowest mask, if it is lower than the cell's own mask
+    neighbourMask = np.where(labels[neighbours] == labels[flatIndexes][:, None], mask[neighbours], np.iinfo(np.int64).max)
+    best = np.argmin(neighbourMask, axis=1)
+    bestMask = neighbourMask[np.arange(len(flatIndexes)), best]
+    drains = bestMask < mask[flatIndexes]
+
+    codes = np.array([code for rowShift, colShift, code in directions], dtype=np.uint8)
+    flatRows = flatIndexes // paddedCols - 1
+    flatCols = flatIndexes % paddedCols - 1
+    fdr[flatRows[drains], flatCols[drains]] = codes[best[drains]]
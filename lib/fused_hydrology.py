@@ -0,0 +1,64 @@
+'''
+fused_hydrology.py produces the filled DEM, D8 flow directions and flow accumulation from a DEM array in one
+Priority-Flood traversal, rather than three separate passes over the rasters.
+
+The flood fills the DEM and records the cell from which each cell was reached (its parent). Cells are reached in
+order of non-decreasing filled elevation, so:
+
+    - cells with a lower neighbour flow to the neighbour with the steepest drop (as lib/flow_direction.py)
+    - cells with no lower neighbour (filled depressions and flats) flow to their parent, which leads across the
+      filled area to the cell it spills over
+    - every cell drains to cells reached before it, so the flow directions contain no loops, and the flow
+      accumulation is found with the wave engine in lib/flow_accumulation.py
+'''
+
+import numpy as np
+
+import NB_EE.lib.priority_flood as priority_flood
+import NB_EE.lib.flow_direction as flow_direction
+import NB_EE.lib.flow_accumulation as flow_accumulation
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([priority_flood, flow_direction, flow_accumulation])
+
+
+def parentDirections(parents, noFlowCells, paddedCols):
+
+    ''' Direction code from each cell (flat indexes in the padded array) to its parent '''
+
+    offsets = flow_direction.neighbourOffsets(paddedCols)
+    codes = np.array([code for rowShift, colShift, code in flow_direction.directions], dtype=np.uint8)
+
+    order = np.argsort(offsets)
+    position = np.searchsorted(offsets[order], parents[noFlowCells] - noFlowCells)
+
+    return codes[order][position]
+
+
+def fillDirectionAccumulation(dem, epsilon=0.0, weights=None):
+
+    '''
+    Fills dem (2D array, NoData as NaN) and calculates its flow directions and flow accumulation.
+    Returns the filled DEM (float32), flow directions (uint8, 1 - 128, NoData 255) and flow accumulation (float32).
+    '''
+
+    rows, cols = dem.shape
+    paddedCols = cols + 2
+
+    filledPadded, parents = priority_flood.flood(dem, epsilon, recordParents=True)
+    filled = filledPadded[1:-1, 1:-1]
+    valid = ~np.isnan(filled)
+
+    fdr, hasEqualNeighbour = flow_direction.steepestDescent(filledPadded.astype(np.float64))
+
+    # Cells with no outflow drain to the cell from which the flood reached them
+    noFlowRows, noFlowCols = np.nonzero(valid & (fdr == 0))
+    noFlowCells = (noFlowRows + 1) * paddedCols + noFlowCols + 1
+    hasParent = parents[noFlowCells] >= 0
+
+    fdr[noFlowRows[hasParent], noFlowCols[hasParent]] = parentDirections(parents, noFlowCells[hasParent], paddedCols)
+    fdr[~valid] = flow_direction.noDataCode
+    del parents
+
+    accumulation = flow_accumulation.accumulate(fdr, weights)
+
+    return filled, fdr, accumulation
@@ -0,0 +1,166 @@
+'''
+instrumentation.py records the wall clock and CPU time spent in named phases of a tool run, along with counters
+(e.g. number of points, GetCellValue calls or scratch datasets created). The profile is written as JSON to the logs
+folder of the output folder, next to the text log, so that runs can be compared over time.
+
+Phases can either be timed with the phase() context manager, or marked sequentially with startPhase(), which ends
+the previous sequential phase (in the same way as progress.logProgress times consecutive code blocks).
+
+Phase and counter calls made when no profile has been started do nothing, so library functions can be
+instrumented without knowing which tool is calling them.
+'''
+
+import os
+import json
+import time
+import datetime
+from contextlib import contextmanager
+
+
+def cpuTime():
+
+    ''' CPU time (user + system) used by this process '''
+
+    if hasattr(time, 'process_time'): # Python 3.3+
+        return time.process_time()
+    else:
+        times = os.times()
+        return times[0] + times[1]
+
+
+class Profile:
+
+    def __init__(self, name):
+        self.name = name
+        self.startTime = datetime.datetime.now()
+        self.startWall = time.time()
+        self.startCPU = cpuTime()
+        self.phaseNames = []
+        self.phases = {}
+        self.counters = {}
+        self.openPhase = None
+
+    def addPhase(self, name, wall, cpu):
+
+        if name not in self.phases:
+            self.phaseNames.append(name)
+            self.phases[name] = {'wall': 0.0, 'cpu': 0.0, 'calls': 0}
+
+        self.phases[name]['wall'] += wall
+        self.phases[name]['cpu'] += cpu
+        self.phases[name]['calls'] += 1
+
+    def startPhase(self, name):
+
+        self.endPhase()
+        self.openPhase = (name, time.time(), cpuTime())
+
+    def endPhase(self):
+
+        if self.openPhase is not None:
+            name, startWall, startCPU = self.openPhase
+            self.addPhase(name, time.time() - startWall, cpuTime() - startCPU)
+            self.openPhase = None
+
+    def count(self, name, n=1):
+
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def toDict(self):
+
+        phases = []
+        for name in self.phaseNames:
+            phase = self.phases[name]
+            phases.append({'name': name,
+                           'wall': round(phase['wall'], 3),
+                           'cpu': round(phase['cpu'], 3),
+                           'calls': phase['calls']})
+
+        return {'tool': self.name,
+                'started': self.startTime.strftime('%Y-%m-%d %H:%M:%S'),
+                'wall': round(time.time() - self.startWall, 3),
+                'cpu': round(cpuTime() - self.startCPU, 3),
+                'phases': phases,
+                'counters': self.counters}
+
+
+currentProfile = None
+
+
+def startProfile(name):
+
+    ''' Starts a new profile, replacing any current one '''
+
+    global currentProfile
+    currentProfile = Profile(name)
+
+    return currentProfile
+
+
+@contextmanager
+def phase(name):
+
+    ''' Context manager which adds the time spent inside it to the named phase of the current profile '''
+
+    profile = currentProfile
+    if profile is None:
+        yield
+        return
+
+    startWall = time.time()
+    startCPU = cpuTime()
+    try:
+        yield
+    finally:
+        profile.addPhase(name, time.time() - startWall, cpuTime() - startCPU)
+
+
+def startPhase(name):
+
+    ''' Ends the current sequential phase (if any) and starts timing the named phase '''
+
+    if currentProfile is not None:
+        currentProfile.startPhase(name)
+
+
+def endPhase():
+
+    if currentProfile is not None:
+        currentProfile.endPhase()
+
+
+def count(name, n=1):
+
+    ''' Adds n to the named counter of the current profile '''
+
+    if currentProfile is not None:
+        currentProfile.count(name, n)
+
+
+def writeProfile(outputFolder):
+
+    '''
+    Writes the current profile to <outputFolder>/logs/profile_<date time>.json and stops profiling.
+    Returns the name of the file written, or None if there is no current profile.
+    '''
+
+    global currentProfile
+
+    if currentProfile is None:
+        return None
+
+    currentProfile.endPhase()
+
+    logsFolder = os.path.join(outputFolder, 'logs')
+    if not os.path.exists(logsFolder):
+        os.makedirs(logsFolder)
+
+    dateTimeStamp = currentProfile.startTime.strftime("%Y%m%d_%H%M%S")
+    profileFile = os.path.join(logsFolder, 'profile_' + dateTimeStamp + '.json')
+
+    with open(profileFile, 'w') as f:
+        json.dump(currentProfile.toDict(), f, indent=2, sort_keys=True)
+
+    currentProfile = None
+
+    return profileFile
@@ -0,0 +1,163 @@
+'''
+local_ops.py evaluates local (cell by cell) raster operations block by block with NumPy, so that several derived
+rasters can be made from the same inputs in one sweep, rather than one full raster pass (read and write) per output.
+
+Each input is read once, a block of rows at a time. The block function calculates every output for the block, and
+the blocks are written to memory-mapped arrays in the scratch folder, which are saved as the output rasters at the
+end. The next blocks are read in a background thread while the current block is calculated, and finished blocks are
+written in another (lib/tile_prefetch.py), so only a few blocks of each input are held in memory.
+
+With an in memory lib/array_pipeline.ArrayStore, the inputs held in the store are read from it, and the outputs are
+built in memory and put in the store, which writes them in its writer thread.
+'''
+
+import os
+import numpy as np
+
+import NB_EE.lib.log as log
+import NB_EE.lib.raster_arrays as raster_arrays
+import NB_EE.lib.array_pipeline as array_pipeline
+import NB_EE.lib.tile_prefetch as tile_prefetch
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log, raster_arrays, array_pipeline, tile_prefetch])
+
+blockRows = 1024
+
+
+class BlockOutput:
+
+    ''' An output raster of a sweep: its path, NumPy dtype and NoData value '''
+
+    def __init__(self, raster, dtype, noDataValue):
+        self.raster = raster
+        self.dtype = dtype
+        self.noDataValue = noDataValue
+
+
+def sweep(inputs, outputs, blockFunction, grid, scratchFolder, store=None):
+
+    '''
+    Runs blockFunction over the inputs block by block, and saves the outputs.
+    inputs: dictionary of name: tile source (e.g. raster_arrays.RasterTileSource), all on the grid.
+    outputs: dictionary of name: BlockOutput.
+    blockFunction: called with a dictionary of name: input block, returns a dictionary of name: output block
+    (and may return other values, e.g. statistics, which are collected and returned as a list).
+    store: lib/array_pipeline.ArrayStore. In memory mode, the outputs are put in the store under their names.
+    '''
+
+    inMemory = store is not None and store.inMemory
+
+    outputArrays = {}
+    for name in outputs:
+        if inMemory:
+            outputArrays[name] = np.empty((grid.rows, grid.cols), dtype=outputs[name].dtype)
+        else:
+            outputArrays[name] = np.lib.format.open_memmap(os.path.join(scratchFolder, 'sweep_' + name + '.npy'), mode='w+',
+                                                           dtype=outputs[name].dtype, shape=(grid.rows, grid.cols))
+
+    def readBlocks(rows):
+
+        blocks = {}
+        for name in inputs:
+            blocks[name] = inputs[name].read(rows[0], rows[1], 0, grid.cols)
+
+        return blocks
+
+    def writeBlocks(rows, results):
+
+        for name in outputs:
+            outputArrays[name][rows[0]:rows[1]] = results[name]
+
+    blockWindows = [(rowStart, min(rowStart + blockRows, grid.rows)) for rowStart in range(0, grid.rows, blockRows)]
+    writer = tile_prefetch.writerFromSettings(writeBlocks, 'Block')
+
+    extras = []
+    try:
+        for rows, blocks in tile_prefetch.prefetch(readBlocks, blockWindows):
+            results, extra = blockFunction(blocks)
+            extras.append(extra)
+            writer.write(rows, results)
+
+        writer.wait()
+
+    finally:
+        writer.close()
+
+    for name in outputs:
+        if inMemory:
+            store.put(name, outputArrays[name], grid, outputs[name].raster, outputs[name].noDataValue)
+            continue
+
+        raster_arrays.writeRaster(outputArrays[name], grid, outputs[name].raster, outputs[name].noDataValue)
+        memmapFile = outputArrays[name].filename
+        del outputArrays[name]
+        os.remove(memmapFile)
+
+    return extras
+
+
+def degreesTable():
+
+    ''' Lookup table from D8 flow direction code to direction in degrees (clockwise from north), -1 for other values '''
+
+    table = np.full(256, -1, dtype=np.int16)
+    for code, degrees in [(1, 90), (2, 135), (4, 180), (8, 225), (16, 270), (32, 315), (64, 0), (128, 45)]:
+        table[code] = degrees
+
+    return table
+
+
+def derivedRasters(rawDEM, hydFDR, hydFAC, multRaster, hydFDRDegrees, streamInvRas, streamsRaster,
+                   minAccThresh, majAccThresh, scratchFolder, store=None):
+
+    '''
+    Creates the rasters Preprocess DEM derives from rawDEM, hydFDR and hydFAC in one sweep:
+        multRaster: 1 for cells with DEM data
+        hydFDRDegrees: flow direction in degrees
+        streamInvRas: 0 for stream cells (accumulation above minAccThresh hectares), 1 for other cells
+        streamsRaster: stream display classes, 1 for minor streams and 2 for major streams (above majAccThresh)
+    Returns the maximum accumulation in hectares.
+    store: lib/array_pipeline.ArrayStore holding hydFDR and hydFAC (as 'hydFDR' and 'hydFAC'), if they are in memory.
+    '''
+
+    if store is None:
+        store = array_pipeline.ArrayStore()
+
+    grid = store.grid('hydFAC', hydFAC)
+    cellAreaHa = grid.cellSize * grid.cellSize / 10000.0
+    minAccThresh = float(minAccThresh)
+    majAccThresh = float(majAccThresh)
+    table = degreesTable()
+
+    inputs = {'dem': store.tileSource('rawDEM', rawDEM, np.nan),
+              'fdr': store.tileSource('hydFDR', hydFDR, 255),
+              'fac': store.tileSource('hydFAC', hydFAC, np.nan)}
+
+    outputs = {'mult': BlockOutput(multRaster, np.uint8, 255),
+               'degrees': BlockOutput(hydFDRDegrees, np.int16, -1),
+               'streamInv': BlockOutput(streamInvRas, np.uint8, 255),
+               'streams': BlockOutput(streamsRaster, np.uint8, 255)}
+
+    def blockFunction(blocks):
+
+        dem = blocks['dem']
+        with np.errstate(invalid='ignore'):
+            accHa = blocks['fac'].astype(np.float64) * cellAreaHa
+            isStream = accHa > minAccThresh
+            isMajor = accHa > majAccThresh
+        hasAcc = ~np.isnan(accHa)
+
+        results = {}
+        results['mult'] = np.where(np.isnan(dem), 255, 1).astype(np.uint8)
+        results['degrees'] = table[blocks['fdr'].astype(np.uint8)]
+        results['streamInv'] = np.where(hasAcc, np.where(isStream, 0, 1), 255).astype(np.uint8)
+        results['streams'] = np.where(isStream, np.where(isMajor, 2, 1), 255).astype(np.uint8)
+
+        maxAccHa = np.nanmax(accHa) if hasAcc.any() else -np.inf
+
+        return results, maxAccHa
+
+    log.info('Calculating derived rasters in one pass')
+    maxima = sweep(inputs, outputs, blockFunction, grid, scratchFolder, store)
+
+    return max(maxima)
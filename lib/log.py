@@ -3,6 +3,8 @@ import arcpy
 import os
 import datetime
 
+import NB_EE.lib.arcpy_lock as arcpy_lock
+
 class ArcpyMessageHandler(logging.FileHandler):
 
     def __init__(self, filename, mode, encoding=None, delay=False):
@@ -18,13 +20,14 @@ class ArcpyMessageHandler(logging.FileHandler):
         except:
             msg = record.msg
 
-        # Log message to arcpy.AddMessage, AddWarning or AddError
-        if record.levelno >= logging.ERROR:
-            arcpy.AddError(msg)
-        elif record.levelno >= logging.WARNING:
-            arcpy.AddWarning(msg)
-        else:
-            arcpy.AddMessage(msg)
+        # Log message to arcpy.AddMessage, AddWarning or AddError. Rasters may be being written in another thread.
+        with arcpy_lock.lock:
+            if record.levelno >= logging.ERROR:
+                arcpy.AddError(msg)
+            elif record.levelno >= logging.WARNING:
+                arcpy.AddWarning(msg)
+            else:
+                arcpy.AddMessage(msg)
 
         # Also log message to file using FileHandler's emit function
         logging.FileHandler.emit(self, record)
@@ -74,7 +77,8 @@ def info(msg):
         if len(root_logger.handlers) > 0:
             logging.info(msg)
         else:
-            arcpy.AddMessage(msg)
+            with arcpy_lock.lock:
+                arcpy.AddMessage(msg)
 
     except:
         pass
@@ -88,7 +92,8 @@ def warning(msg):
         if len(root_logger.handlers) > 0:
             logging.warning(msg)
         else:
-            arcpy.AddWarning(msg)
+            with arcpy_lock.lock:
+                arcpy.AddWarning(msg)
 
     except:
         pass
@@ -102,7 +107,8 @@ def error(msg):
         if len(root_logger.handlers) > 0:
             logging.error(msg)
         else:
-            arcpy.AddError(msg)
+            with arcpy_lock.lock:
+                arcpy.AddError(msg)
 
     except:
         pass
@@ -116,7 +122,8 @@ def exception(msg):
         if len(root_logger.handlers) > 0:
             logging.exception(msg)
         else:
-            arcpy.AddError(msg)
+            with arcpy_lock.lock:
+                arcpy.AddError(msg)
 
     except:
         pass
@@ -0,0 +1,146 @@
+'''
+priority_flood.py fills depressions in a DEM array with the Priority-Flood algorithm
+(Barnes, Lehman & Mulla 2014, "Priority-Flood: An optimal depression-filling and watershed-labeling algorithm
+for digital elevation models").
+
+Cells on the edge of the DEM, or next to NoData cells, are outlets. The flood works inwards from the outlets in
+order of elevation, using a priority queue (heapq). A cell reached from a lower or equal neighbour is in a
+depression: it is raised to the level of that neighbour and added to a plain FIFO queue instead of the priority
+queue, as all the cells of the depression are at the spill level and so need no sorting.
+
+With an epsilon above zero, each cell in a depression is raised to slightly above the cell it was reached from
+(Priority-Flood+epsilon), so that filled depressions and flats drain towards their outlets. With epsilon of zero
+the result is the same as arcpy.sa.Fill with no z limit.
+'''
+
+import heapq
+from collections import deque
+
+import numpy as np
+
+
+def neighbourOffsets(cols):
+
+    ''' Flat index offsets of the eight neighbours of a cell in an array with cols columns '''
+
+    return [-cols - 1, -cols, -cols + 1, -1, 1, cols - 1, cols, cols + 1]
+
+
+def padArray(dem):
+
+    ''' Pads the DEM with a one cell border of NaN, so that neighbour lookups never leave the array '''
+
+    padded = np.full((dem.shape[0] + 2, dem.shape[1] + 2), np.nan, dtype=np.float32)
+    padded[1:-1, 1:-1] = dem
+
+    return padded
+
+
+def outletCells(padded):
+
+    ''' Flat indexes of the valid cells of the padded DEM which have a NaN neighbour (DEM edge or NoData) '''
+
+    invalid = np.isnan(padded)
+    touchesInvalid = np.zeros(padded.shape, dtype=bool)
+
+    for rowShift in (-1, 0, 1):
+        for colShift in (-1, 0, 1):
+            if rowShift == 0 and colShift == 0:
+                continue
+            touchesInvalid[1:-1, 1:-1] |= invalid[1 + rowShift:padded.shape[0] - 1 + rowShift,
+                                                  1 + colShift:padded.shape[1] - 1 + colShift]
+
+    return np.flatnonzero(touchesInvalid & ~invalid)
+
+
+def raiseFunction(epsilon):
+
+    ''' Returns the function giving the level a depression cell is raised to, from the level of the cell it was reached from '''
+
+    if epsilon is None or epsilon <= 0:
+        return lambda level: level
+
+    infinity = np.float32(np.inf)
+
+    def raiseLevel(level):
+        raised = np.float32(level + epsilon)
+        if raised <= level:
+            raised = np.nextafter(np.float32(level), infinity)
+        return float(raised)
+
+    return raiseLevel
+
+
+def fill(dem, epsilon=0.0):
+
+    '''
+    Fills the depressions in dem (2D array, NoData as NaN). Returns the filled DEM as a new float32 array.
+    epsilon: if above zero, cells in depressions are raised by at least this amount above the cell they drain to.
+    '''
+
+    filled, parents = flood(dem, epsilon)
+
+    return filled[1:-1, 1:-1]
+
+
+def flood(dem, epsilon=0.0, recordParents=False):
+
+    '''
+    Runs the Priority-Flood over dem. Returns the filled DEM padded with a one cell NaN border and, if recordParents
+    is True, the flat index (in the padded array) of the cell from which each cell was reached (-1 for outlets and
+    NoData). Cells are reached in order of non-decreasing filled elevation, so a cell's parent is never higher than it.
+    '''
+
+    padded = padArray(dem)
+    cols = padded.shape[1]
+    offsets = neighbourOffsets(cols)
+    raiseLevel = raiseFunction(epsilon)
+
+    # Work on Python lists, which are much faster than NumPy arrays for single element access
+    elevations = padded.ravel().tolist()
+    closed = bytearray(np.isnan(padded).ravel().astype(np.uint8).tobytes())
+
+    openQueue = []
+    for cell in outletCells(padded).tolist():
+        openQueue.append((elevations[cell], cell))
+        closed[cell] = 1
+    heapq.heapify(openQueue)
+
+    pitQueue = deque()
+
+    if recordParents:
+        parents = [-1] * len(elevations)
+    else:
+        parents = None
+
+    while openQueue or pitQueue:
+
+        if pitQueue:
+            cell = pitQueue.popleft()
+        else:
+            cell = heapq.heappop(openQueue)[1]
+
+        level = elevations[cell]
+        raisedLevel = raiseLevel(level)
+
+        for offset in offsets:
+            neighbour = cell + offset
+            if closed[neighbour]:
+                continue
+            closed[neighbour] = 1
+
+            if recordParents:
+                parents[neighbour] = cell
+
+            if elevations[neighbour] <= raisedLevel:
+                elevations[neighbour] = raisedLevel
+                pitQueue.append(neighbour)
+            else:
+                heapq.heappush(openQueue, (elevations[neighbour], neighbour))
+
+    filled = np.array(elevations, dtype=np.float32).reshape(padded.shape)
+
+    if recordParents:
+        parents = np.array(parents, dtype=np.int64)
+
+    return filled, parents
@@ -0,0 +1,155 @@
+'''
+raster_arrays.py reads rasters into NumPy arrays and writes arrays back out as rasters, keeping the georeferencing
+(lower left corner, cell size and spatial reference) needed to write results on the same grid as the input.
+
+NoData cells are read as NaN for floating point rasters. For integer rasters, NoData cells are marked in the
+RasterGrid's noDataMask.
+
+arcpy is not safe to call from more than one thread at a time, and rasters may be read or written in the reader and
+writer threads of lib/tile_prefetch.py, so every arcpy call here is made holding arcpyLock (lib/arcpy_lock.py).
+'''
+
+import arcpy
+import os
+import numpy as np
+
+import NB_EE.lib.log as log
+import NB_EE.lib.arcpy_lock as arcpy_lock
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log])
+
+# Held for every arcpy call in this module
+arcpyLock = arcpy_lock.lock
+
+
+class RasterGrid:
+
+    ''' Georeferencing of a raster array: lower left corner, cell size, shape and spatial reference '''
+
+    def __init__(self, lowerLeftX, lowerLeftY, cellSize, rows, cols, spatialRef, noDataMask=None):
+        self.lowerLeftX = lowerLeftX
+        self.lowerLeftY = lowerLeftY
+        self.cellSize = cellSize
+        self.rows = rows
+        self.cols = cols
+        self.spatialRef = spatialRef
+        self.noDataMask = noDataMask
+
+
+def readRaster(raster, dtype=np.float32):
+
+    '''
+    Reads the raster into an array of type dtype. Returns the array and its RasterGrid.
+    For floating point dtypes, NoData cells are NaN.
+    '''
+
+    with arcpyLock:
+        desc = arcpy.Describe(raster)
+        extent = desc.extent
+        cellSize = float(desc.meanCellWidth)
+        spatialRef = desc.spatialReference
+
+        if np.issubdtype(np.dtype(dtype), np.floating):
+            noDataValue = np.nan
+        else:
+            noDataValue = np.iinfo(np.dtype(dtype)).max
+        array = arcpy.RasterToNumPyArray(raster, nodata_to_value=noDataValue)
+
+    array = array.astype(dtype, copy=False)
+    if np.issubdtype(np.dtype(dtype), np.floating):
+        noDataMask = np.isnan(array)
+    else:
+        noDataMask = array == noDataValue
+
+    rows, cols = array.shape
+    grid = RasterGrid(extent.XMin, extent.YMin, cellSize, rows, cols, spatialRef, noDataMask)
+
+    return array, grid
+
+
+def writeRaster(array, grid, outputRaster, noDataValue=None):
+
+    '''
+    Writes the array to outputRaster on the grid. NaN cells (floating point arrays) or cells equal to noDataValue
+    (integer arrays) are written as NoData.
+    '''
+
+    with arcpyLock:
+        lowerLeft = arcpy.Point(grid.lowerLeftX, grid.lowerLeftY)
+
+        if noDataValue is None and np.issubdtype(array.dtype, np.floating):
+            raster = arcpy.NumPyArrayToRaster(array, lowerLeft, grid.cellSize, grid.cellSize)
+        else:
+            raster = arcpy.NumPyArrayToRaster(array, lowerLeft, grid.cellSize, grid.cellSize, noDataValue)
+
+        raster.save(outputRaster)
+        arcpy.DefineProjection_management(outputRaster, grid.spatialRef)
+
+        del raster
+
+    return outputRaster
+
+
+class RasterTileSource:
+
+    '''
+    Reads windows (tiles) of a raster, so that rasters larger than memory can be processed a tile at a time.
+    Only the raster's path and extent are stored, so it can be passed to worker processes.
+    NoData cells are read as noDataValue.
+    '''
+
+    def __init__(self, raster, noDataValue):
+
+        with arcpyLock:
+            desc = arcpy.Describe(raster)
+            self.raster = desc.catalogPath
+            self.rows = int(desc.height)
+            self.cols = int(desc.width)
+            self.cellSize = float(desc.meanCellWidth)
+            self.xMin = desc.extent.XMin
+            self.yMax = desc.extent.YMax
+        self.noDataValue = noDataValue
+
+    def read(self, rowStart, rowEnd, colStart, colEnd):
+
+        with arcpyLock:
+            lowerLeft = arcpy.Point(self.xMin + colStart * self.cellSize, self.yMax - rowEnd * self.cellSize)
+            return arcpy.RasterToNumPyArray(self.raster, lowerLeft, colEnd - colStart, rowEnd - rowStart, self.noDataValue)
+
+    def grid(self):
+
+        with arcpyLock:
+            desc = arcpy.Describe(self.raster)
+            return RasterGrid(desc.extent.XMin, desc.extent.YMin, self.cellSize, self.rows, self.cols, desc.spatialReference)
+
+
+def writeRasterTiles(tiles, grid, outputRaster, pixelType, noDataValue=None):
+
+    '''
+    Writes a raster from tiles, given as a list of (row start, row end, column start, column end, .npy file).
+    Each tile is converted to a raster in the scratch folder and the tiles are mosaicked into outputRaster,
+    so only one tile is held in memory at a time.
+    pixelType: e.g. "32_BIT_FLOAT" or "32_BIT_SIGNED"
+    '''
+
+    tileRasters = []
+    for rowStart, rowEnd, colStart, colEnd, tileFile in tiles:
+
+        array = np.load(tileFile)
+        tileGrid = RasterGrid(grid.lowerLeftX + colStart * grid.cellSize,
+                              grid.lowerLeftY + (grid.rows - rowEnd) * grid.cellSize,
+                              grid.cellSize, rowEnd - rowStart, colEnd - colStart, grid.spatialRef)
+
+        tileRaster = os.path.splitext(tileFile)[0] + '.tif'
+        writeRaster(array, tileGrid, tileRaster, noDataValue)
+        tileRasters.append(tileRaster)
+        del array
+
+    with arcpyLock:
+        arcpy.MosaicToNewRaster_management(';'.join(tileRasters), os.path.dirname(outputRaster), os.path.basename(outputRaster),
+                                           grid.spatialRef, pixelType, grid.cellSize, 1, "FIRST")
+
+        for tileRaster in tileRasters:
+            arcpy.Delete_management(tileRaster)
+
+    return outputRaster
@@ -0,0 +1,537 @@
+'''
+raster_store.py reads and writes the raster store, a compressed file format for the rasters made by Preprocess DEM
+(e.g. hydDEM, hydFDR and hydFAC, which the downstream tools sample many times). The store is written next to the
+raster it copies, with the extension .nbt (e.g. hydFAC.nbt next to the ESRI grid hydFAC), and is used instead of the
+raster when it is present and was written from the raster as it is now: the header holds the size and modification
+time of the raster's cell data, and a store whose raster has since been changed (e.g. by a rerun of Preprocess DEM
+which failed before writing the store) is ignored.
+
+The raster is split into fixed size square tiles (edge tiles are padded with NoData), stored one after another in a
+flat binary file:
+
+    magic bytes 'NBRSTORE'
+    length of the header (8 byte little endian unsigned integer)
+    JSON header, padded with spaces so that the tile data starts on a page boundary
+    tile data
+
+The header holds the georeferencing (lower left corner, cell size, rows and columns, spatial reference as a string
+from SpatialReference.exportToString), the source raster's size and modification time, the tile size, the NumPy dtype and NoData value, and the tile index: the
+offset (from the start of the tile data) and length in bytes of each tile, and how it is encoded, in row major order.
+
+Each tile is encoded in the smallest of these forms:
+
+    rawTile: the cells, uncompressed
+    constantTile: a single value, for tiles where every cell is the same (e.g. multRaster, or NoData tiles)
+    zlibTile: the cells compressed with zlib, for single byte rasters (e.g. flow directions)
+    deltaTile: for multi byte rasters (e.g. DEM and flow accumulation), the difference of each cell's bits from
+        the cell to its left (lossless, also for floating point values), with the bytes of each cell split into
+        planes so that the slowly changing high bytes are together, compressed with zlib
+
+The file is opened with numpy.memmap, so a window which lies within one raw tile is returned as a view of the file
+and a point sample reads a single value, without decoding the raster or calling a geoprocessing tool. Other tiles are
+decoded when first read and kept in a least recently used cache. Windows spanning several tiles are copied from the
+tiles they cross, decoding the next tiles in a background thread.
+'''
+
+import arcpy
+import os
+import json
+import zlib
+import struct
+import collections
+import numpy as np
+
+import NB_EE.lib.log as log
+import NB_EE.lib.raster_arrays as raster_arrays
+import NB_EE.lib.instrumentation as instrumentation
+import NB_EE.lib.tile_prefetch as tile_prefetch
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log, raster_arrays, instrumentation, tile_prefetch])
+
+magic = b'NBRSTORE'
+storeExtension = '.nbt'
+formatVersion = 2
+defaultTileSize = 512
+pageSize = 4096
+compressionLevel = 6
+defaultCacheTiles = 64
+prefetchMinTiles = 4
+
+# Number of each store's first samples in getCellValue which are also taken with GetCellValue, to check they agree
+checkSamples = 5
+
+# Tile encodings
+rawTile = 0
+zlibTile = 1
+deltaTile = 2
+constantTile = 3
+
+# Stores already opened, by file, with the file's modification time
+openStores = {}
+
+
+def storeFile(raster):
+
+    ''' Path of the raster store for raster '''
+
+    return str(raster) + storeExtension
+
+
+def sourceStamp(raster):
+
+    '''
+    Size and modification time of the raster's cell data (the w001001.adf file of an ESRI grid, otherwise the raster
+    file), or None if it does not exist. Statistics and pyramids are kept in other files, so do not change it.
+    '''
+
+    path = str(raster)
+    if os.path.isdir(path):
+        path = os.path.join(path, 'w001001.adf')
+
+    if not os.path.isfile(path):
+        return None
+
+    return [os.path.getsize(path), os.path.getmtime(path)]
+
+
+def closeStore(path):
+
+    ''' Closes the store file at path if it is open, so that it can be replaced (Windows cannot remove open files) '''
+
+    if path in openStores:
+        openStores.pop(path)[0].close()
+
+
+def findStore(raster):
+
+    ''' Returns the raster store for raster if there is one, written from the raster as it is now, otherwise None '''
+
+    if raster is None:
+        return None
+
+    path = storeFile(raster)
+    if not os.path.exists(path):
+        closeStore(path)
+        return None
+
+    modified = os.path.getmtime(path)
+    if path not in openStores or openStores[path][1] != modified:
+        closeStore(path)
+        openStores[path] = (RasterStore(path), modified)
+
+    store = openStores[path][0]
+
+    stamp = sourceStamp(raster)
+    if stamp is None or store.header.get('source') != stamp:
+        closeStore(path)
+        return None
+
+    return store
+
+
+class RasterStore:
+
+    '''
+    A raster store opened for reading. Also a tile source (see lib/tiled_accumulation.py).
+    cacheTiles: number of decoded tiles kept in memory.
+    '''
+
+    def __init__(self, path, cacheTiles=defaultCacheTiles):
+
+        self.path = path
+        self.cacheTiles = cacheTiles
+        self.cache = collections.OrderedDict()
+
+        # Samples checked against GetCellValue (see getCellValue), and whether any disagreed
+        self.samplesChecked = 0
+        self.disagrees = False
+
+        with open(path, 'rb') as storeFile:
+            if storeFile.read(len(magic)) != magic:
+                raise ValueError(path + ' is not a raster store')
+            headerLength = struct.unpack('<Q', storeFile.read(8))[0]
+            header = json.loads(storeFile.read(headerLength).decode('utf-8'))
+
+        if header['version'] > formatVersion:
+            raise ValueError(path + ' was written by a newer version of the raster store')
+
+        self.header = header
+        self.rows = header['rows']
+        self.cols = header['cols']
+        self.tileSize = header['tileSize']
+        self.dtype = np.dtype(header['dtype'])
+        self.noDataValue = header['noDataValue']
+        if self.noDataValue is None:
+            self.noDataValue = np.nan
+        self.cellSize = header['cellSize']
+        self.lowerLeftX = header['lowerLeftX']
+        self.lowerLeftY = header['lowerLeftY']
+        self.tileRows = -(-self.rows // self.tileSize)
+        self.tileCols = -(-self.cols // self.tileSize)
+        self.tileIndex = np.array(header['tileIndex'], dtype=np.int64).reshape(self.tileRows * self.tileCols, -1)
+        if self.tileIndex.shape[1] == 2:
+            # Version 1 stores have raw tiles only
+            self.tileIndex = np.column_stack([self.tileIndex, np.full(len(self.tileIndex), rawTile)])
+
+        dataStart = len(magic) + 8 + headerLength
+        self.data = np.memmap(path, dtype=np.uint8, mode='r', offset=dataStart)
+
+    def close(self):
+
+        ''' Releases the file. Views of it returned by read() keep it open until they are freed. '''
+
+        self.cache = collections.OrderedDict()
+        self.data = None
+
+    def tile(self, tileRow, tileCol):
+
+        '''
+        The tile (tileSize by tileSize, padded with NoData), read only. Raw tiles are views of the file, others are
+        decoded, or taken from the cache.
+        '''
+
+        index = tileRow * self.tileCols + tileCol
+        offset, length, encoding = self.tileIndex[index]
+
+        if encoding == rawTile:
+            return self.data[offset:offset + length].view(self.dtype).reshape(self.tileSize, self.tileSize)
+
+        if index in self.cache:
+            tile = self.cache.pop(index)
+        else:
+            tile = decodeTile(self.data[offset:offset + length], encoding, self.dtype, self.tileSize)
+            if len(self.cache) >= self.cacheTiles:
+                self.cache.popitem(last=False)
+
+        # Most recently used last
+        self.cache[index] = tile
+
+        return tile
+
+    def read(self, rowStart, rowEnd, colStart, colEnd):
+
+        '''
+        Reads the window of rows rowStart to rowEnd and columns colStart to colEnd. Cells outside the raster are
+        NoData. A window within a single tile is a read only view of the file; others are copied.
+        '''
+
+        size = self.tileSize
+        tileRowStart, tileColStart = rowStart // size, colStart // size
+
+        inRaster = rowStart >= 0 and colStart >= 0 and rowEnd <= self.rows and colEnd <= self.cols
+        if inRaster and (rowEnd - 1) // size == tileRowStart and (colEnd - 1) // size == tileColStart:
+            r0, c0 = rowStart - tileRowStart * size, colStart - tileColStart * size
+            return self.tile(tileRowStart, tileColStart)[r0:r0 + rowEnd - rowStart, c0:c0 + colEnd - colStart]
+
+        window = np.full((rowEnd - rowStart, colEnd - colStart), self.noDataValue, dtype=self.dtype)
+
+        # Tiles crossed by the window, with the part of the window each covers
+        crossed = []
+        for tileRow in range(max(rowStart, 0) // size, min(rowEnd, self.rows) // size + 1):
+            for tileCol in range(max(colStart, 0) // size, min(colEnd, self.cols) // size + 1):
+                if tileRow >= self.tileRows or tileCol >= self.tileCols:
+                    continue
+
+                r0 = max(rowStart, tileRow * size, 0)
+                r1 = min(rowEnd, (tileRow + 1) * size, self.rows)
+                c0 = max(colStart, tileCol * size, 0)
+                c1 = min(colEnd, (tileCol + 1) * size, self.cols)
+                if r0 < r1 and c0 < c1:
+                    crossed.append((tileRow, tileCol, r0, r1, c0, c1))
+
+        def readTile(part):
+            return self.tile(part[0], part[1])
+
+        # Large windows decode the next tiles in a background thread (lib/tile_prefetch.py) while each is copied
+        if len(crossed) > prefetchMinTiles:
+            tiles = tile_prefetch.prefetch(readTile, crossed)
+        else:
+            tiles = [(part, readTile(part)) for part in crossed]
+
+        for (tileRow, tileCol, r0, r1, c0, c1), tile in tiles:
+            window[r0 - rowStart:r1 - rowStart, c0 - colStart:c1 - colStart] = \
+                tile[r0 - tileRow * size:r1 - tileRow * size, c0 - tileCol * size:c1 - tileCol * size]
+
+        return window
+
+    def readAll(self):
+
+        return self.read(0, self.rows, 0, self.cols)
+
+    def cellAt(self, x, y):
+
+        ''' Row and column of the cell containing the point (x, y). May be outside the raster. '''
+
+        col = int(np.floor((x - self.lowerLeftX) / self.cellSize))
+        row = int(np.floor((self.lowerLeftY + self.rows * self.cellSize - y) / self.cellSize))
+
+        return row, col
+
+    def value(self, row, col):
+
+        ''' Value of the cell, or None if it is outside the raster or NoData '''
+
+        if row < 0 or col < 0 or row >= self.rows or col >= self.cols:
+            return None
+
+        size = self.tileSize
+        value = self.tile(row // size, col // size)[row % size, col % size]
+
+        if isNoData(value, self.noDataValue):
+            return None
+
+        return value.item()
+
+    def valueAtPoint(self, x, y):
+
+        ''' Value of the cell containing the point (x, y), or None if it is outside the raster or NoData '''
+
+        row, col = self.cellAt(x, y)
+        return self.value(row, col)
+
+    def onCellBoundary(self, x, y, tolerance=1e-9):
+
+        ''' True if the point (x, y) lies on the boundary between cells (within tolerance, in cells) '''
+
+        for position in [(x - self.lowerLeftX) / self.cellSize, (y - self.lowerLeftY) / self.cellSize]:
+            if abs(position - round(position)) <= tolerance:
+                return True
+
+        return False
+
+    def cellValueText(self, x, y):
+
+        '''
+        Value at the point (x, y) as text, as GetCellValue gives it: 'NoData' for NoData cells, points outside the
+        raster and points on a cell boundary (which GetCellValue does not assign to a cell). Whole numbers have no
+        decimal point, and other values are given with the fewest digits which read back as the same value.
+        '''
+
+        if self.onCellBoundary(x, y):
+            return 'NoData'
+
+        value = self.valueAtPoint(x, y)
+
+        if value is None:
+            return 'NoData'
+        if float(value).is_integer():
+            return str(int(value))
+        return np.format_float_positional(self.dtype.type(value), trim='-')
+
+    def windowForExtent(self, xMin, yMin, xMax, yMax):
+
+        ''' Window (rowStart, rowEnd, colStart, colEnd) of the cells covering the extent '''
+
+        rowStart, colStart = self.cellAt(xMin + self.cellSize * 0.5, yMax - self.cellSize * 0.5)
+        rowEnd, colEnd = self.cellAt(xMax - self.cellSize * 0.5, yMin + self.cellSize * 0.5)
+
+        return rowStart, rowEnd + 1, colStart, colEnd + 1
+
+    def grid(self):
+
+        spatialRef = arcpy.SpatialReference()
+        spatialRef.loadFromString(self.header['spatialRef'])
+
+        return raster_arrays.RasterGrid(self.lowerLeftX, self.lowerLeftY, self.cellSize, self.rows, self.cols, spatialRef)
+
+
+def isNoData(value, noDataValue):
+
+    if isinstance(noDataValue, float) and np.isnan(noDataValue):
+        return np.isnan(value)
+
+    return value == noDataValue
+
+
+def encodeTile(tile, compress=True):
+
+    ''' Encodes the tile in the smallest form (see above). Returns the encoding and the encoded bytes. '''
+
+    # Compare the bits of the cells rather than their values, so that NaN tiles are constant
+    bits = tile.view('u' + str(tile.dtype.itemsize))
+    if (bits == bits.flat[0]).all():
+        return constantTile, tile.flat[:1].tobytes()
+
+    raw = tile.tobytes()
+    if not compress:
+        return rawTile, raw
+
+    if tile.dtype.itemsize == 1:
+        encoding = zlibTile
+        encoded = zlib.compress(raw, compressionLevel)
+    else:
+        deltas = bits.copy()
+        deltas[:, 1:] -= bits[:, :-1] # wraps around, so is exactly reversed by the cumulative sum
+        planes = deltas.view(np.uint8).reshape(-1, tile.dtype.itemsize).T
+        encoding = deltaTile
+        encoded = zlib.compress(planes.tobytes(), compressionLevel)
+
+    if len(encoded) >= len(raw):
+        return rawTile, raw
+
+    return encoding, encoded
+
+
+def decodeTile(data, encoding, dtype, tileSize):
+
+    ''' Decodes a tile encoded by encodeTile. The tile is read only. '''
+
+    if encoding == constantTile:
+        return np.broadcast_to(np.frombuffer(data.tobytes(), dtype=dtype), (tileSize, tileSize))
+
+    decoded = zlib.decompress(data.tobytes())
+
+    if encoding == zlibTile:
+        tile = np.frombuffer(decoded, dtype=dtype).reshape(tileSize, tileSize)
+
+    elif encoding == deltaTile:
+        planes = np.frombuffer(decoded, dtype=np.uint8).reshape(dtype.itemsize, -1)
+        deltas = np.ascontiguousarray(planes.T).view('u' + str(dtype.itemsize)).reshape(tileSize, tileSize)
+        tile = np.cumsum(deltas, axis=1, dtype=deltas.dtype).view(dtype)
+        tile.setflags(write=False)
+
+    else:
+        raise ValueError('Unknown tile encoding ' + str(encoding))
+
+    return tile
+
+
+def writeStore(source, grid, dtype, noDataValue, raster, tileSize=defaultTileSize, compress=True):
+
+    '''
+    Writes the raster store for raster (see storeFile) from the tile source (e.g. raster_arrays.RasterTileSource, or
+    array_pipeline.ArrayTileSource), on the grid (raster_arrays.RasterGrid). NoData cells must be noDataValue
+    (NaN for floating point dtypes). Only one tile is held in memory. raster must already be written, as the store
+    records its size and modification time.
+    compress: compress the tiles (see above). Constant tiles are always stored as a single value.
+    '''
+
+    dtype = np.dtype(dtype)
+    path = storeFile(raster)
+    tileRows = -(-grid.rows // tileSize)
+    tileCols = -(-grid.cols // tileSize)
+    numTiles = tileRows * tileCols
+
+    if isinstance(noDataValue, float) and np.isnan(noDataValue):
+        headerNoData = None # JSON has no NaN
+    else:
+        headerNoData = noDataValue
+
+    header = {'version': formatVersion,
+              'rows': grid.rows,
+              'cols': grid.cols,
+              'tileSize': tileSize,
+              'dtype': dtype.str,
+              'noDataValue': headerNoData,
+              'cellSize': grid.cellSize,
+              'lowerLeftX': grid.lowerLeftX,
+              'lowerLeftY': grid.lowerLeftY,
+              'spatialRef': grid.spatialRef.exportToString(),
+              'source': sourceStamp(raster),
+              'tileIndex': []}
+
+    # The tile lengths are only known once the tiles are encoded, so room is left for the longest possible index
+    maxEntryLength = len(json.dumps([numTiles * tileSize * tileSize * dtype.itemsize] * 2 + [constantTile])) + 2
+    headerLength = len(json.dumps(header)) + numTiles * maxEntryLength
+    headerLength += -(len(magic) + 8 + headerLength) % pageSize
+
+    # Write to a temporary file, so that a partly written store is never found
+    tempPath = path + '.tmp'
+    with open(tempPath, 'wb') as outFile:
+        outFile.write(magic)
+        outFile.write(struct.pack('<Q', headerLength))
+        outFile.write(b' ' * headerLength)
+
+        tileIndex = []
+
+        def readTile(tilePosition):
+
+            rowStart, colStart = tilePosition[0] * tileSize, tilePosition[1] * tileSize
+            rowEnd, colEnd = min(rowStart + tileSize, grid.rows), min(colStart + tileSize, grid.cols)
+
+            tile = np.full((tileSize, tileSize), noDataValue, dtype=dtype)
+            tile[:rowEnd - rowStart, :colEnd - colStart] = source.read(rowStart, rowEnd, colStart, colEnd)
+
+            return tile
+
+        def writeTile(encoding, encoded):
+
+            offset = tileIndex[-1][0] + tileIndex[-1][1] if tileIndex else 0
+
+            # Raw tiles are aligned to their dtype, so that they can be viewed in place
+            padding = -offset % dtype.itemsize if encoding == rawTile else 0
+            outFile.write(b'\0' * padding + encoded)
+
+            tileIndex.append([offset + padding, len(encoded), encoding])
+
+        # Tiles are read ahead and written behind (lib/tile_prefetch.py) while they are encoded
+        tilePositions = [(tileRow, tileCol) for tileRow in range(tileRows) for tileCol in range(tileCols)]
+        writer = tile_prefetch.writerFromSettings(writeTile)
+        try:
+            for tilePosition, tile in tile_prefetch.prefetch(readTile, tilePositions):
+                writer.write(*encodeTile(tile, compress))
+            writer.wait()
+        finally:
+            writer.close()
+
+        header['tileIndex'] = tileIndex
+        headerText = json.dumps(header).encode('utf-8')
+        outFile.seek(len(magic) + 8)
+        outFile.write(headerText)
+
+    # The old store may be open, e.g. from an earlier run in the same session
+    closeStore(path)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tempPath, path)
+
+    return path
+
+
+def sameCellValue(storeText, toolText):
+
+    ''' True if the values given as text by the raster store and by GetCellValue are the same '''
+
+    if 'NoData' in [storeText, toolText]:
+        return storeText == toolText
+
+    try:
+        return np.float32(storeText) == np.float32(toolText)
+    except ValueError:
+        return False
+
+
+def getCellValue(raster, x, y):
+
+    '''
+    Value of raster at the point (x, y) as text, as arcpy.GetCellValue_management gives it ('NoData' for NoData
+    cells). Read from the raster's store if it has one, otherwise with GetCellValue.
+
+    The first checkSamples samples of each store are also taken with GetCellValue. If any disagree, a warning is
+    logged and GetCellValue is used for the rest of the raster's samples.
+    '''
+
+    store = findStore(raster)
+
+    if store is not None and not store.disagrees:
+
+        instrumentation.count('raster store samples')
+        value = store.cellValueText(x, y)
+
+        if store.samplesChecked >= checkSamples:
+            return value
+
+        store.samplesChecked += 1
+        instrumentation.count('GetCellValue calls')
+        toolValue = arcpy.GetCellValue_management(raster, str(x) + " " + str(y)).getOutput(0)
+
+        if sameCellValue(value, toolValue):
+            return value
+
+        log.warning('Raster store for ' + str(raster) + ' gives ' + value + ' at (' + str(x) + ', ' + str(y) + '), but '
+                    'GetCellValue gives ' + str(toolValue) + '. GetCellValue will be used for this raster.')
+        store.disagrees = True
+        return toolValue
+
+    instrumentation.count('GetCellValue calls')
+    return arcpy.GetCellValue_management(raster, str(x) + " " + str(y)).getOutput(0)
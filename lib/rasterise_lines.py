@@ -0,0 +1,134 @@
+'''
+rasterise_lines.py burns polylines into an array on a raster's grid (e.g. stream networks into the DEM grid), in this
+process, without writing a scratch raster as PolylineToRaster_conversion does.
+
+Line vertices are read with a single cursor pass. Each segment is then traced through the grid with a digital
+differential analyser (DDA): it is sampled at intervals of at most one cell along its longer axis, and each sample
+is assigned to the cell whose centre is nearest. This gives the eight-connected, one cell wide lines that
+PolylineToRaster produces. All the segments are traced together with NumPy.
+
+A point exactly on the boundary between two cells falls in the cell to its right (higher x) and below it (lower y).
+'''
+
+import arcpy
+import numpy as np
+
+import NB_EE.lib.log as log
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log])
+
+chunkSize = 100000
+
+
+def readLineVertices(lineFC, spatialRef=None):
+
+    '''
+    Reads the vertices of the lines in lineFC, projected to spatialRef if given.
+    Returns arrays of the x and y coordinates of the vertices, the OID of each vertex's line, and a flag for the
+    vertices which start a new part (so that the segments between parts are not drawn).
+    '''
+
+    xs = []
+    ys = []
+    oids = []
+    partStarts = []
+
+    with arcpy.da.SearchCursor(lineFC, ['OID@', 'SHAPE@'], spatial_reference=spatialRef) as cursor:
+        for oid, shape in cursor:
+            if shape is None:
+                continue
+
+            for part in shape:
+                first = True
+                for point in part:
+                    if point is None:
+                        # Null points separate the rings of a part
+                        first = True
+                        continue
+                    xs.append(point.X)
+                    ys.append(point.Y)
+                    oids.append(oid)
+                    partStarts.append(first)
+                    first = False
+
+    return (np.array(xs, dtype=np.float64), np.array(ys, dtype=np.float64),
+            np.array(oids, dtype=np.int64), np.array(partStarts, dtype=bool))
+
+
+def rasteriseSegments(xs, ys, partStarts, grid):
+
+    '''
+    Traces the segments between consecutive vertices (except where a new part starts) through the grid
+    (lib/raster_arrays.RasterGrid). Returns the row and column of each cell crossed, and the index of the segment's
+    first vertex. Cells outside the grid are dropped.
+    '''
+
+    topY = grid.lowerLeftY + grid.rows * grid.cellSize
+
+    # Position of each vertex in cell units, with cell centres at whole numbers
+    colPositions = (xs - grid.lowerLeftX) / grid.cellSize - 0.5
+    rowPositions = (topY - ys) / grid.cellSize - 0.5
+
+    segmentStarts = np.flatnonzero(~partStarts[1:])
+    rowStart, rowEnd = rowPositions[segmentStarts], rowPositions[segmentStarts + 1]
+    colStart, colEnd = colPositions[segmentStarts], colPositions[segmentStarts + 1]
+
+    # One sample per cell along the longer axis, including both ends
+    steps = np.ceil(np.maximum(np.abs(rowEnd - rowStart), np.abs(colEnd - colStart))).astype(np.int64)
+    samples = steps + 1
+
+    segment = np.repeat(np.arange(len(segmentStarts)), samples)
+    firstSample = np.cumsum(samples) - samples
+    step = np.arange(samples.sum()) - np.repeat(firstSample, samples)
+    fraction = step / np.maximum(steps[segment], 1).astype(np.float64)
+
+    # Cell containing each sample. Positions exactly half way between centres go to the next column and row.
+    cols = np.floor(colStart[segment] + fraction * (colEnd - colStart)[segment] + 0.5).astype(np.int64)
+    rows = np.floor(rowStart[segment] + fraction * (rowEnd - rowStart)[segment] + 0.5).astype(np.int64)
+
+    inside = (rows >= 0) & (rows < grid.rows) & (cols >= 0) & (cols < grid.cols)
+
+    return rows[inside], cols[inside], segmentStarts[segment[inside]]
+
+
+def rasteriseLines(lineFC, grid, useOIDs=False):
+
+    '''
+    Burns the lines of lineFC into an array on the grid (lib/raster_arrays.RasterGrid).
+    Returns a boolean array of the cells crossed by a line or, if useOIDs is True, an int64 array of the OID of the
+    line crossing each cell (-1 where there is none; where lines cross the same cell, the last line read is used).
+    '''
+
+    xs, ys, oids, partStarts = readLineVertices(lineFC, grid.spatialRef)
+
+    if useOIDs:
+        lines = np.full((grid.rows, grid.cols), -1, dtype=np.int64)
+    else:
+        lines = np.zeros((grid.rows, grid.cols), dtype=bool)
+
+    if len(xs) == 0:
+        log.warning('No lines found in ' + str(lineFC))
+        return lines
+
+    # Lines with a single vertex are drawn as a point
+    partStarts = np.append(partStarts, True)
+    singleVertex = partStarts[:-1] & partStarts[1:]
+    partStarts = partStarts[:-1]
+
+    # Trace the segments in chunks of vertices, to limit the memory used by long segments
+    for chunkStart in range(0, len(xs), chunkSize):
+        chunk = slice(chunkStart, chunkStart + chunkSize + 1)
+        rows, cols, vertices = rasteriseSegments(xs[chunk], ys[chunk], partStarts[chunk], grid)
+        if useOIDs:
+            lines[rows, cols] = oids[chunkStart + vertices]
+        else:
+            lines[rows, cols] = True
+
+    pointRows, pointCols, pointVertices = rasteriseSegments(xs[singleVertex].repeat(2), ys[singleVertex].repeat(2),
+                                                            np.tile([True, False], singleVertex.sum()), grid)
+    if useOIDs:
+        lines[pointRows, pointCols] = oids[np.flatnonzero(singleVertex)[pointVertices // 2]]
+    else:
+        lines[pointRows, pointCols] = True
+
+    return lines
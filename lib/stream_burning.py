@@ -0,0 +1,81 @@
+'''
+stream_burning.py burns a stream network into a DEM array with the AGREE method, as solo/reconditionDEM.py does with
+map algebra: cells within smoothDropBuffer of a stream are lowered by up to smoothDrop, in proportion to their
+closeness to the stream, and stream cells are lowered by a further streamDrop.
+
+Rather than calculating the distance of every cell of the DEM from the streams, the DEM is split into blocks, and
+distances are only calculated for blocks within the buffer distance of a stream cell. For each of these blocks, an
+exact Euclidean distance transform is run over the block plus a border of the buffer distance, which holds every
+stream cell that can be within the buffer of the block's cells. Cells further than the buffer distance from a stream
+are not changed.
+'''
+
+import math
+
+import numpy as np
+from scipy import ndimage
+
+blockSize = 512
+
+
+def corridorBlocks(streams, borderBlocks):
+
+    ''' Mask of the blocks which are within borderBlocks blocks of a block containing a stream cell '''
+
+    rows, cols = streams.shape
+    blockRows = -(-rows // blockSize)
+    blockCols = -(-cols // blockSize)
+
+    streamRows, streamCols = np.nonzero(streams)
+    hasStream = np.zeros((blockRows, blockCols), dtype=bool)
+    hasStream[streamRows // blockSize, streamCols // blockSize] = True
+
+    if borderBlocks > 0:
+        hasStream = ndimage.binary_dilation(hasStream, structure=np.ones((3, 3), dtype=bool), iterations=borderBlocks)
+
+    return hasStream
+
+
+def burnStreams(dem, streams, cellSize, smoothDropBuffer, smoothDrop, streamDrop):
+
+    '''
+    Lowers the cells of dem (float32 array, NoData as NaN) in place. streams is a boolean array of the stream cells.
+    Returns dem.
+    '''
+
+    rows, cols = dem.shape
+    smoothDropBuffer = float(smoothDropBuffer)
+    dropPerDistance = np.float32(float(smoothDrop) / smoothDropBuffer)
+    bufferDistance = np.float32(smoothDropBuffer)
+
+    streams = streams & ~np.isnan(dem)
+    border = int(math.ceil(smoothDropBuffer / cellSize))
+
+    blocks = corridorBlocks(streams, -(-border // blockSize))
+
+    for blockRow, blockCol in zip(*np.nonzero(blocks)):
+
+        rowStart, colStart = blockRow * blockSize, blockCol * blockSize
+        rowEnd, colEnd = min(rowStart + blockSize, rows), min(colStart + blockSize, cols)
+
+        # Window holding every stream cell within the buffer distance of the block
+        windowRowStart, windowColStart = max(rowStart - border, 0), max(colStart - border, 0)
+        windowRowEnd, windowColEnd = min(rowEnd + border, rows), min(colEnd + border, cols)
+        windowStreams = streams[windowRowStart:windowRowEnd, windowColStart:windowColEnd]
+
+        if not windowStreams.any():
+            continue
+
+        distance = ndimage.distance_transform_edt(~windowStreams, sampling=cellSize).astype(np.float32)
+        distance = distance[rowStart - windowRowStart:rowEnd - windowRowStart, colStart - windowColStart:colEnd - windowColStart]
+        del windowStreams
+
+        block = dem[rowStart:rowEnd, colStart:colEnd]
+
+        corridor = distance < bufferDistance
+        block[corridor] -= dropPerDistance * (bufferDistance - distance[corridor])
+
+        blockStreams = streams[rowStart:rowEnd, colStart:colEnd]
+        block[blockStreams] -= np.float32(streamDrop)
+
+    return dem
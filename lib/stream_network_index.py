@@ -0,0 +1,325 @@
+'''
+stream_network_index.py keeps the stream network ID of each stream segment up to date as segments are added to or
+removed from a stream feature class, without relabelling the whole network.
+
+The index holds the node adjacency of the segments and the segments in each network, and is saved as JSON next to
+the stream networks output (e.g. streamnetwork.nbnet.json). The streams passed to update() must be a persistent
+feature class with SEGMENT_ID, FROM_NODE and TO_NODE fields, which the edits are made to. When there is no index yet,
+update() builds it from all the segments of streams and rewrites every network once; later updates load the index,
+so only the edits are paid for. The full labelling (assign_stream_network_id) does not write an index, but removes
+an old one, as it renumbers the networks.
+
+    - Inserting a segment joins the networks at its two nodes. When two networks are joined, the smaller one is
+      relabelled with the ID of the larger one (as in union by size).
+    - Deleting a segment may split its network. A breadth first search is run from both ends of the deleted segment
+      at the same time, stopping as soon as the searches meet (no split) or one of them runs out of segments
+      (the segments it found are split off into a new network). The cost depends on the smaller side of the split.
+
+Only the STREAM_NO values of segments whose network changed, and the stream network features of the networks which
+changed, are rewritten. Network IDs of unaffected networks do not change, so after edits the IDs are no longer
+numbered in segment order; a full run of assign_stream_network_id renumbers them.
+
+update() is for scripts which edit a stream feature class between runs, e.g. from the ArcGIS Python window. No tool
+calls it: the Stream Entry/Exits tool copies the input streams and writes a new stream network output on every run,
+so there is never an earlier output for it to update.
+'''
+
+import arcpy
+import os
+import json
+from collections import deque
+
+import NB_EE.lib.log as log
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log])
+
+indexVersion = 1
+
+
+class StreamNetworkIndex:
+
+    def __init__(self):
+
+        self.segments = {}          # segment ID -> [from node, to node]
+        self.nodeSegments = {}      # node -> set of segment IDs
+        self.networkIDs = {}        # segment ID -> stream network ID
+        self.networks = {}          # stream network ID -> set of segment IDs
+        self.nextNetworkID = 1
+
+        # Changes since the index was last written out
+        self.changedSegments = set()
+        self.changedNetworks = set()
+
+    def addSegment(self, segID, fromNode, toNode, networkID):
+
+        self.segments[segID] = [fromNode, toNode]
+        self.nodeSegments.setdefault(fromNode, set()).add(segID)
+        self.nodeSegments.setdefault(toNode, set()).add(segID)
+        self.networkIDs[segID] = networkID
+        self.networks.setdefault(networkID, set()).add(segID)
+        self.nextNetworkID = max(self.nextNetworkID, networkID + 1)
+
+    def relabel(self, segIDs, networkID):
+
+        for segID in segIDs:
+            oldID = self.networkIDs[segID]
+            if oldID == networkID:
+                continue
+
+            self.networks[oldID].discard(segID)
+            if len(self.networks[oldID]) == 0:
+                del self.networks[oldID]
+                self.changedNetworks.add(oldID)
+
+            self.networkIDs[segID] = networkID
+            self.networks.setdefault(networkID, set()).add(segID)
+            self.changedSegments.add(segID)
+
+        self.changedNetworks.add(networkID)
+
+    def insertSegment(self, segID, fromNode, toNode):
+
+        ''' Adds a segment, joining the networks at its nodes. Returns the segment's network ID. '''
+
+        if segID in self.segments:
+            self.deleteSegment(segID)
+
+        touching = set()
+        for node in (fromNode, toNode):
+            for otherSeg in self.nodeSegments.get(node, ()):
+                touching.add(self.networkIDs[otherSeg])
+
+        if len(touching) == 0:
+            networkID = self.nextNetworkID
+        else:
+            # Keep the ID of the largest network, relabelling the others
+            networkID = max(touching, key=lambda ID: (len(self.networks[ID]), -ID))
+            for otherID in touching:
+                if otherID != networkID:
+                    self.relabel(list(self.networks[otherID]), networkID)
+
+        self.addSegment(segID, fromNode, toNode, networkID)
+        self.changedSegments.add(segID)
+        self.changedNetworks.add(networkID)
+
+        return networkID
+
+    def deleteSegment(self, segID):
+
+        ''' Removes a segment, splitting its network if the segment was its only link between two parts '''
+
+        if segID not in self.segments:
+            log.warning('Stream segment ' + str(segID) + ' is not in the stream network index')
+            return
+
+        fromNode, toNode = self.segments.pop(segID)
+        networkID = self.networkIDs.pop(segID)
+
+        for node in set((fromNode, toNode)):
+            self.nodeSegments[node].discard(segID)
+            if len(self.nodeSegments[node]) == 0:
+                del self.nodeSegments[node]
+
+        self.networks[networkID].discard(segID)
+        if len(self.networks[networkID]) == 0:
+            del self.networks[networkID]
+
+        self.changedSegments.add(segID)
+        self.changedNetworks.add(networkID)
+
+        if fromNode == toNode:
+            return
+
+        splitOff = self.findSplit(fromNode, toNode)
+        if splitOff is not None and len(splitOff) > 0:
+            self.relabel(splitOff, self.nextNetworkID)
+            self.nextNetworkID += 1
+
+    def findSplit(self, nodeA, nodeB):
+
+        '''
+        Searches outwards from nodeA and nodeB in turn. Returns None if the searches meet (the nodes are still
+        connected), otherwise the segments reached by the search which finished first.
+        '''
+
+        searches = []
+        for node in (nodeA, nodeB):
+            searches.append({'queue': deque([node]), 'nodes': set([node]), 'segments': set()})
+
+        while True:
+            for i in range(0, 2):
+
+                search = searches[i]
+                other = searches[1 - i]
+
+                if len(search['queue']) == 0:
+                    return list(search['segments'])
+
+                node = search['queue'].popleft()
+                for segID in self.nodeSegments.get(node, ()):
+
+                    if segID in search['segments']:
+                        continue
+
+                    search['segments'].add(segID)
+                    for nextNode in self.segments[segID]:
+
+                        if nextNode in other['nodes']:
+                            return None
+
+                        if nextNode not in search['nodes']:
+                            search['nodes'].add(nextNode)
+                            search['queue'].append(nextNode)
+
+    def save(self, filename):
+
+        segments = [[segID] + self.segments[segID] + [self.networkIDs[segID]] for segID in sorted(self.segments)]
+
+        with open(filename, 'w') as f:
+            json.dump({'version': indexVersion, 'nextNetworkID': self.nextNetworkID, 'segments': segments}, f)
+
+        self.changedSegments = set()
+        self.changedNetworks = set()
+
+    @classmethod
+    def load(cls, filename):
+
+        ''' Loads the index from filename. Returns None if the file does not exist or is from a different version. '''
+
+        if not os.path.exists(filename):
+            return None
+
+        with open(filename, 'r') as f:
+            data = json.load(f)
+
+        if data.get('version') != indexVersion:
+            return None
+
+        index = cls()
+        for segID, fromNode, toNode, networkID in data['segments']:
+            index.addSegment(segID, fromNode, toNode, networkID)
+
+        index.nextNetworkID = max(index.nextNetworkID, data['nextNetworkID'])
+
+        return index
+
+
+    @classmethod
+    def fromStreams(cls, streams, fromNodeField="FROM_NODE", toNodeField="TO_NODE"):
+
+        ''' Builds the index by inserting every segment of streams '''
+
+        index = cls()
+        with arcpy.da.SearchCursor(streams, ["SEGMENT_ID", fromNodeField, toNodeField]) as searchCursor:
+            for row in searchCursor:
+                index.insertSegment(row[0], int(row[1]), int(row[2]))
+
+        return index
+
+
+def indexPath(streamNetworks):
+
+    return os.path.splitext(streamNetworks)[0] + '.nbnet.json'
+
+
+def whereIn(dataset, field, values, chunkSize=1000):
+
+    ''' Where clauses selecting rows of dataset whose field is one of values (split into chunks to keep them short) '''
+
+    values = sorted(values)
+    fieldName = arcpy.AddFieldDelimiters(dataset, field)
+
+    return [fieldName + ' IN (' + ', '.join([str(value) for value in values[i:i + chunkSize]]) + ')'
+            for i in range(0, len(values), chunkSize)]
+
+
+def rewriteChanges(index, streams, streamNetworks, rebuilt=False):
+
+    '''
+    Writes STREAM_NO to the changed segments of streams (if it has the field) and rebuilds the changed network features.
+    rebuilt: the index has just been built, so all the old network features are removed.
+    '''
+
+    changedSegments = [segID for segID in index.changedSegments if segID in index.segments]
+    changedNetworks = list(index.changedNetworks)
+
+    if "STREAM_NO" in [field.name.upper() for field in arcpy.ListFields(streams)]:
+        for whereClause in whereIn(streams, "SEGMENT_ID", changedSegments):
+            with arcpy.da.UpdateCursor(streams, ["SEGMENT_ID", "STREAM_NO"], whereClause) as updateCursor:
+                for row in updateCursor:
+                    row[1] = index.networkIDs[row[0]]
+                    updateCursor.updateRow(row)
+
+    # Remove the old features of the changed networks
+    whereClauses = whereIn(streamNetworks, "STREAM_NO", changedNetworks)
+    if rebuilt:
+        whereClauses = [None]
+
+    for whereClause in whereClauses:
+        with arcpy.da.UpdateCursor(streamNetworks, ["STREAM_NO"], whereClause) as updateCursor:
+            for row in updateCursor:
+                updateCursor.deleteRow()
+
+    # Read the segments of the changed networks which still exist, and write one multipart polyline per network
+    spatialRef = arcpy.Describe(streamNetworks).spatialReference
+    networkSegments = []
+    for networkID in changedNetworks:
+        networkSegments.extend(index.networks.get(networkID, ()))
+
+    networkParts = {}
+    for whereClause in whereIn(streams, "SEGMENT_ID", networkSegments):
+        with arcpy.da.SearchCursor(streams, ["SEGMENT_ID", "SHAPE@"], whereClause) as searchCursor:
+            for row in searchCursor:
+                if row[1] is None or row[0] not in index.networkIDs:
+                    continue
+
+                for part in row[1]:
+                    networkParts.setdefault(index.networkIDs[row[0]], []).append(arcpy.Array([point for point in part if point is not None]))
+
+    with arcpy.da.InsertCursor(streamNetworks, ["SHAPE@", "STREAM_NO"]) as insertCursor:
+        for networkID in sorted(networkParts):
+            insertCursor.insertRow((arcpy.Polyline(arcpy.Array(networkParts[networkID]), spatialRef), networkID))
+
+
+def update(streams, streamNetworks, insertedSegmentIDs=[], deletedSegmentIDs=[], fromNodeField="FROM_NODE", toNodeField="TO_NODE"):
+
+    '''
+    Updates the stream network IDs after segments have been added to or deleted from streams.
+    insertedSegmentIDs are SEGMENT_ID values of new rows in streams; deletedSegmentIDs are SEGMENT_ID values of rows
+    which have been removed. The index saved next to streamNetworks is updated, or built from streams (after the
+    edits) if it does not exist yet.
+
+    Returns the IDs of the stream networks which changed.
+    '''
+
+    try:
+        indexFile = indexPath(streamNetworks)
+        index = StreamNetworkIndex.load(indexFile)
+
+        rebuilt = index is None
+
+        if rebuilt:
+            # The edits are already in streams, so building the index applies them
+            log.info('Building stream network index ' + indexFile)
+            index = StreamNetworkIndex.fromStreams(streams, fromNodeField, toNodeField)
+
+        else:
+            for segID in deletedSegmentIDs:
+                index.deleteSegment(segID)
+
+            for whereClause in whereIn(streams, "SEGMENT_ID", insertedSegmentIDs):
+                with arcpy.da.SearchCursor(streams, ["SEGMENT_ID", fromNodeField, toNodeField], whereClause) as searchCursor:
+                    for row in searchCursor:
+                        index.insertSegment(row[0], int(row[1]), int(row[2]))
+
+        changedNetworks = sorted(index.changedNetworks)
+        log.info(str(len(index.changedSegments)) + ' stream segments in ' + str(len(changedNetworks)) + ' stream networks changed')
+
+        rewriteChanges(index, streams, streamNetworks, rebuilt)
+        index.save(indexFile)
+
+        return changedNetworks
+
+    except Exception:
+        log.error('Stream network IDs could not be updated')
+        raise
@@ -0,0 +1,168 @@
+'''
+stream_order.py calculates Strahler and Shreve stream orders from the topology of a stream feature class,
+where each line runs downstream from its FROM_NODE to its TO_NODE (as created by StreamToFeature).
+
+The orders are found in one topological pass over the segments, from the sources downstream, so no raster
+stream ordering is needed.
+'''
+
+import arcpy
+import os
+from collections import deque
+
+import numpy as np
+
+import NB_EE.lib.log as log
+from NB_EE.lib.external.six.moves import zip
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log])
+
+
+def computeStreamOrders(fromNodes, toNodes):
+
+    '''
+    Calculates the Strahler and Shreve order of each segment, given the from and to node IDs of each segment.
+
+    Strahler: sources are order 1. Where two or more segments of the highest upstream order meet, the order
+    increases by one, otherwise the highest upstream order is carried on.
+    Shreve: sources have magnitude 1, and each other segment's magnitude is the sum of its upstream magnitudes.
+
+    Returns the Strahler and Shreve orders as arrays in the same order as the segments.
+    '''
+
+    fromNodes = np.asarray(fromNodes, dtype=np.int64).tolist()
+    toNodes = np.asarray(toNodes, dtype=np.int64).tolist()
+    numSegments = len(fromNodes)
+
+    # Segments starting at each node
+    segmentsFromNode = {}
+    for seg in range(numSegments):
+        segmentsFromNode.setdefault(fromNodes[seg], []).append(seg)
+
+    # Number of segments flowing into each segment
+    upstreamCount = [0] * numSegments
+    for seg in range(numSegments):
+        for downstreamSeg in segmentsFromNode.get(toNodes[seg], []):
+            upstreamCount[downstreamSeg] += 1
+
+    strahler = [0] * numSegments
+    shreve = [0] * numSegments
+    upstreamMax = [0] * numSegments       # highest Strahler order flowing in
+    upstreamMaxCount = [0] * numSegments  # number of inflowing segments with that order
+    upstreamShreve = [0] * numSegments
+
+    queue = deque([seg for seg in range(numSegments) if upstreamCount[seg] == 0])
+    noProcessed = 0
+
+    while queue:
+        seg = queue.popleft()
+        noProcessed += 1
+
+        if upstreamMax[seg] == 0:
+            strahler[seg] = 1
+            shreve[seg] = 1
+        else:
+            if upstreamMaxCount[seg] >= 2:
+                strahler[seg] = upstreamMax[seg] + 1
+            else:
+                strahler[seg] = upstreamMax[seg]
+            shreve[seg] = upstreamShreve[seg]
+
+        for downstreamSeg in segmentsFromNode.get(toNodes[seg], []):
+
+            if strahler[seg] > upstreamMax[downstreamSeg]:
+                upstreamMax[downstreamSeg] = strahler[seg]
+                upstreamMaxCount[downstreamSeg] = 1
+            elif strahler[seg] == upstreamMax[downstreamSeg]:
+                upstreamMaxCount[downstreamSeg] += 1
+
+            upstreamShreve[downstreamSeg] += shreve[seg]
+
+            upstreamCount[downstreamSeg] -= 1
+            if upstreamCount[downstreamSeg] == 0:
+                queue.append(downstreamSeg)
+
+    if noProcessed < numSegments:
+        log.warning(str(numSegments - noProcessed) + ' stream segments are part of a loop and have been given order 1')
+        for seg in range(numSegments):
+            if strahler[seg] == 0:
+                strahler[seg] = 1
+                shreve[seg] = 1
+
+    return np.array(strahler, dtype=np.int32), np.array(shreve, dtype=np.int32)
+
+
+def writeStreamsWithOrder(streamLines, outputStreams):
+
+    '''
+    Copies the lines created by StreamToFeature (streamLines) to outputStreams, with the Strahler and Shreve order of
+    each line written to the Strahler and Shreve fields as the features are created.
+    '''
+
+    fields = ["SHAPE@", "ARCID", "FROM_NODE", "TO_NODE"]
+
+    # The orders need the whole network, so the nodes are read first and the lines copied in a second pass
+    fromNodes = []
+    toNodes = []
+    with arcpy.da.SearchCursor(streamLines, ["FROM_NODE", "TO_NODE"]) as searchCursor:
+        for fromNode, toNode in searchCursor:
+            fromNodes.append(fromNode)
+            toNodes.append(toNode)
+
+    spatialRef = arcpy.Describe(streamLines).spatialReference
+
+    with arcpy.da.SearchCursor(streamLines, fields) as searchCursor:
+        return writeStreams(outputStreams, spatialRef, fromNodes, toNodes, searchCursor)
+
+
+def writeStreams(outputStreams, spatialRef, fromNodes, toNodes, rows):
+
+    '''
+    Creates outputStreams from rows of (shape, ARCID, FROM_NODE, TO_NODE), adding the Strahler and Shreve order of
+    each line. fromNodes and toNodes are the nodes of the rows, in the same order. rows may be any iterable (e.g. a
+    cursor or generator), and is not held in memory.
+    '''
+
+    fields = ["SHAPE@", "ARCID", "FROM_NODE", "TO_NODE"]
+
+    strahler, shreve = computeStreamOrders(fromNodes, toNodes)
+
+    arcpy.CreateFeatureclass_management(os.path.dirname(outputStreams), os.path.basename(outputStreams), 'POLYLINE', spatial_reference=spatialRef)
+
+    for field in ["ARCID", "FROM_NODE", "TO_NODE", "Strahler", "Shreve"]:
+        arcpy.AddField_management(outputStreams, field, "LONG")
+
+    # Shapefiles are created with a default Id field, which StreamToFeature output does not have
+    if outputStreams.lower().endswith('.shp'):
+        arcpy.DeleteField_management(outputStreams, "Id")
+
+    with arcpy.da.InsertCursor(outputStreams, fields + ["Strahler", "Shreve"]) as insertCursor:
+        for row, strahlerOrder, shreveOrder in zip(rows, strahler.tolist(), shreve.tolist()):
+            insertCursor.insertRow(tuple(row) + (strahlerOrder, shreveOrder))
+
+    return outputStreams
+
+
+def writeTracedStreams(outputStreams, spatialRef, xs, ys, lineStarts, fromNodes, toNodes, keep=None):
+
+    '''
+    Creates outputStreams from the lines traced by lib/stream_tracer.py, with the Strahler and Shreve order of each
+    line. keep: optional mask of the vertices to use (e.g. the simplified display lines).
+    '''
+
+    if keep is None:
+        keep = np.ones(len(xs), dtype=bool)
+
+    xs = xs.tolist()
+    ys = ys.tolist()
+    keep = keep.tolist()
+    lineStarts = lineStarts.tolist()
+
+    def rows():
+
+        # Each line's geometry is created as it is inserted
+        for line in range(len(lineStarts) - 1):
+            points = arcpy.Array([arcpy.Point(xs[i], ys[i]) for i in range(lineStarts[line], lineStarts[line + 1]) if keep[i]])
+            yield (arcpy.Polyline(points, spatialRef), line + 1, int(fromNodes[line]), int(toNodes[line]))
+
+    return writeStreams(outputStreams, spatialRef, fromNodes, toNodes, rows())
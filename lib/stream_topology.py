@@ -0,0 +1,329 @@
+'''
+stream_topology.py builds the node/segment topology of a stream feature class (e.g. streams.shp from Preprocess DEM)
+and caches it in a binary sidecar file next to the streams, so that later runs on the same streams can memory-map
+the topology instead of rebuilding it.
+
+The sidecar is keyed by a fingerprint of the stream file (size, modification time and a hash of its contents),
+so any change to the streams invalidates it automatically. The contents are only hashed when the size or the
+modification time has changed (e.g. the streams were copied without being changed), and when the sidecar is written.
+
+Sidecar layout:
+    8 bytes     magic string
+    8 bytes     header length (little endian unsigned 64 bit int)
+    header      JSON: fingerprint, node field names and the dtype/shape/offset of each array
+    arrays      raw little endian array data, each starting on a 64 byte boundary (offsets are from the end of
+                the header, rounded up to a 64 byte boundary)
+'''
+
+import arcpy
+import os
+import json
+import struct
+import hashlib
+
+import numpy as np
+
+import NB_EE.lib.log as log
+import NB_EE.lib.assign_stream_network_id as assign_stream_network_id
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log, assign_stream_network_id])
+
+sidecarMagic = b'NBTOPO01'
+sidecarVersion = 1
+arrayAlignment = 64
+
+
+class StreamTopology:
+
+    '''
+    Topology of a stream feature class. Segment arrays are in cursor (feature) order.
+
+        fromNodes, toNodes      node IDs at either end of each segment
+        fromIndex, toIndex      the same nodes as indexes into nodeIDs
+        envelopes               xmin, ymin, xmax, ymax of each segment
+        endPoints               first x, first y, last x, last y of each segment
+        nodeIDs                 sorted unique node IDs
+        nodeCounts              number of segment ends at each node
+        adjIndptr, adjIndices   CSR adjacency from each node to the segments which touch it
+        networkIDs              connected network of each segment, numbered from 1 in first seen order
+        outletNodes             downstream end node ID of each network (index 0 is network 1), -1 if not found
+    '''
+
+    arrayNames = ['fromNodes', 'toNodes', 'fromIndex', 'toIndex', 'envelopes', 'endPoints', 'nodeIDs',
+                  'nodeCounts', 'adjIndptr', 'adjIndices', 'networkIDs', 'outletNodes']
+
+    def __init__(self, arrays):
+        for name in self.arrayNames:
+            setattr(self, name, arrays[name])
+
+        self.numSegments = len(self.fromNodes)
+        self.maxNetworkID = len(self.outletNodes)
+
+    def segmentsAtNode(self, nodeIndex):
+
+        return self.adjIndices[self.adjIndptr[nodeIndex]:self.adjIndptr[nodeIndex + 1]]
+
+
+def sidecarPath(streams):
+
+    return os.path.splitext(streams)[0] + '.nbtopo'
+
+
+def streamFiles(streams):
+
+    ''' Files holding the geometry and attributes of the streams. Returns None if the streams are not a shapefile. '''
+
+    if not streams.lower().endswith('.shp') or not os.path.exists(streams):
+        return None
+
+    files = [streams]
+    dbf = os.path.splitext(streams)[0] + '.dbf'
+    if os.path.exists(dbf):
+        files.append(dbf)
+
+    return files
+
+
+def streamFingerprint(streams, fromNodeField, toNodeField):
+
+    '''
+    Fingerprint of the stream file: total size and latest modification time. The SHA-1 of the file contents is
+    added by contentHash when it is needed. Returns None if the streams are not a shapefile (e.g. a geodatabase
+    feature class), in which case no sidecar is used.
+    '''
+
+    files = streamFiles(streams)
+    if files is None:
+        return None
+
+    size = 0
+    mtime = 0.0
+
+    for filename in files:
+        size += os.path.getsize(filename)
+        mtime = max(mtime, os.path.getmtime(filename))
+
+    return {'size': size,
+            'mtime': mtime,
+            'hash': None,
+            'fields': [fromNodeField, toNodeField],
+            'version': sidecarVersion}
+
+
+def contentHash(streams):
+
+    ''' SHA-1 of the contents of the stream files '''
+
+    sha = hashlib.sha1()
+
+    for filename in streamFiles(streams):
+        with open(filename, 'rb') as f:
+            chunk = f.read(1024 * 1024)
+            while chunk:
+                sha.update(chunk)
+                chunk = f.read(1024 * 1024)
+
+    return sha.hexdigest()
+
+
+def sameStreams(stored, fingerprint, streams):
+
+    '''
+    True if the fingerprint stored in a sidecar matches the streams' fingerprint. The contents are only hashed if the
+    sizes match but the modification times do not.
+    '''
+
+    if stored.get('fields') != fingerprint['fields'] or stored.get('version') != fingerprint['version']:
+        return False
+
+    if stored.get('size') != fingerprint['size']:
+        return False
+
+    if stored.get('mtime') == fingerprint['mtime']:
+        return True
+
+    if fingerprint['hash'] is None:
+        fingerprint['hash'] = contentHash(streams)
+
+    return stored.get('hash') == fingerprint['hash']
+
+
+def computeTopology(fromNodes, toNodes, envelopes, endPoints):
+
+    ''' Builds the topology arrays from the node IDs, envelopes and end points of each segment '''
+
+    fromNodes = np.asarray(fromNodes, dtype=np.int64)
+    toNodes = np.asarray(toNodes, dtype=np.int64)
+    numSegments = len(fromNodes)
+
+    # Map node IDs to dense indexes
+    nodeIDs, inverse = np.unique(np.concatenate([fromNodes, toNodes]), return_inverse=True)
+    inverse = inverse.astype(np.int64)
+    fromIndex = inverse[:numSegments]
+    toIndex = inverse[numSegments:]
+    nodeCounts = np.bincount(inverse, minlength=len(nodeIDs)).astype(np.int32)
+
+    # CSR adjacency from node to the segments touching it
+    segmentEnds = np.concatenate([np.arange(numSegments), np.arange(numSegments)])
+    order = np.argsort(inverse, kind='mergesort')
+    adjIndices = segmentEnds[order].astype(np.int64)
+    adjIndptr = np.zeros(len(nodeIDs) + 1, dtype=np.int64)
+    adjIndptr[1:] = np.cumsum(nodeCounts)
+
+    # Label the connected networks, numbering networks in order of their first segment
+    networkIDs, numNetworks = assign_stream_network_id.labelStreamNetworkArrays(fromNodes, toNodes)
+    networkIDs = networkIDs.astype(np.int32)
+
+    # The outlet of each network is a to node which is not the from node of any segment (streams run from -> to)
+    outletNodes = np.full(numNetworks, -1, dtype=np.int64)
+    fromNodeUse = np.bincount(fromIndex, minlength=len(nodeIDs))
+    outletSegs = np.nonzero(fromNodeUse[toIndex] == 0)[0]
+    if len(outletSegs) > 0:
+        networks, first = np.unique(networkIDs[outletSegs], return_index=True)
+        outletNodes[networks - 1] = toNodes[outletSegs[first]]
+
+    return StreamTopology({'fromNodes': fromNodes,
+                           'toNodes': toNodes,
+                           'fromIndex': fromIndex,
+                           'toIndex': toIndex,
+                           'envelopes': np.asarray(envelopes, dtype=np.float64).reshape(-1, 4),
+                           'endPoints': np.asarray(endPoints, dtype=np.float64).reshape(-1, 4),
+                           'nodeIDs': nodeIDs.astype(np.int64),
+                           'nodeCounts': nodeCounts,
+                           'adjIndptr': adjIndptr,
+                           'adjIndices': adjIndices,
+                           'networkIDs': networkIDs,
+                           'outletNodes': outletNodes})
+
+
+def buildTopology(streams, fromNodeField, toNodeField):
+
+    ''' Reads the streams with one cursor pass and builds their topology '''
+
+    fromNodes = []
+    toNodes = []
+    envelopes = []
+    endPoints = []
+
+    with arcpy.da.SearchCursor(streams, [fromNodeField, toNodeField, "SHAPE@"]) as searchCursor:
+
+        for row in searchCursor:
+            shape = row[2]
+            extent = shape.extent
+            firstPoint = shape.firstPoint
+            lastPoint = shape.lastPoint
+
+            fromNodes.append(int(row[0]))
+            toNodes.append(int(row[1]))
+            envelopes.append((extent.XMin, extent.YMin, extent.XMax, extent.YMax))
+            endPoints.append((firstPoint.X, firstPoint.Y, lastPoint.X, lastPoint.Y))
+
+    return computeTopology(fromNodes, toNodes, envelopes, endPoints)
+
+
+def writeSidecar(filename, fingerprint, topology):
+
+    arrays = []
+    header = {'fingerprint': fingerprint, 'arrays': {}}
+    offset = 0
+
+    for name in StreamTopology.arrayNames:
+        array = np.ascontiguousarray(getattr(topology, name))
+        array = array.astype(array.dtype.newbyteorder('<'), copy=False)
+        header['arrays'][name] = [array.dtype.str, list(array.shape), offset]
+        arrays.append(array)
+        offset += array.nbytes + (-array.nbytes % arrayAlignment)
+
+    headerBytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    dataStart = alignedDataStart(len(headerBytes))
+
+    with open(filename, 'wb') as f:
+        f.write(sidecarMagic)
+        f.write(struct.pack('<Q', len(headerBytes)))
+        f.write(headerBytes)
+        f.write(b'\0' * (dataStart - 16 - len(headerBytes)))
+
+        for array in arrays:
+            f.write(array.tobytes())
+            f.write(b'\0' * (-array.nbytes % arrayAlignment))
+
+
+def alignedDataStart(headerLength):
+
+    dataStart = 16 + headerLength
+    return dataStart + (-dataStart % arrayAlignment)
+
+
+def readSidecarHeader(filename):
+
+    with open(filename, 'rb') as f:
+        if f.read(8) != sidecarMagic:
+            return None
+
+        headerLength = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(headerLength).decode('utf-8'))
+        header['dataStart'] = alignedDataStart(headerLength)
+
+        return header
+
+
+def readSidecar(filename, fingerprint, streams):
+
+    '''
+    Memory-maps the topology arrays from the sidecar file.
+    Returns None if the sidecar does not exist, cannot be read or was built from different streams.
+    '''
+
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        header = readSidecarHeader(filename)
+        if header is None or not sameStreams(header['fingerprint'], fingerprint, streams):
+            return None
+
+        arrays = {}
+        for name in StreamTopology.arrayNames:
+            dtype, shape, offset = header['arrays'][name]
+
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=np.dtype(dtype))
+            else:
+                arrays[name] = np.memmap(filename, dtype=np.dtype(dtype), mode='r', offset=header['dataStart'] + offset, shape=tuple(shape))
+
+        return StreamTopology(arrays)
+
+    except Exception:
+        log.warning('Stream topology file ' + str(filename) + ' could not be read. It will be rebuilt.')
+        return None
+
+
+def getTopology(streams, fromNodeField="FROM_NODE", toNodeField="TO_NODE"):
+
+    '''
+    Returns the topology of the streams, memory-mapped from the sidecar file if it is up to date.
+    Otherwise the topology is built and the sidecar (re)written. Sidecars are only used for shapefiles.
+    '''
+
+    fingerprint = streamFingerprint(streams, fromNodeField, toNodeField)
+    if fingerprint is None:
+        return buildTopology(streams, fromNodeField, toNodeField)
+
+    sidecar = sidecarPath(streams)
+    topology = readSidecar(sidecar, fingerprint, streams)
+
+    if topology is not None:
+        log.info('Stream topology read from ' + sidecar)
+        return topology
+
+    topology = buildTopology(streams, fromNodeField, toNodeField)
+
+    try:
+        if fingerprint['hash'] is None:
+            fingerprint['hash'] = contentHash(streams)
+        writeSidecar(sidecar, fingerprint, topology)
+        log.info('Stream topology saved to ' + sidecar)
+    except Exception:
+        log.warning('Could not save stream topology to ' + sidecar)
+
+    return topology
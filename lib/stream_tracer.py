@@ -0,0 +1,211 @@
+'''
+stream_tracer.py traces stream lines from a raster of stream cells and D8 flow directions with NumPy, as
+arcpy.sa.StreamToFeature does, but in one pass which gives both the full resolution lines and simplified lines for
+display.
+
+Lines are split into links at sources and confluences: a link starts at a stream cell with no upstream stream cell
+(a source) or more than one (a confluence), and runs downstream to the next confluence, which it ends at, or to
+the stream's outlet. Each source, confluence and outlet is a node, and each link runs from its FROM_NODE to its
+TO_NODE, so the links can be ordered with lib/stream_order.py.
+
+Cells are assigned to links by pointer jumping up the single upstream cell of each cell within a link, which also
+gives each cell's position along its link, so all links are traced at once rather than cell by cell.
+
+The display lines are simplified with the Douglas-Peucker algorithm, run on all links at once: in each round, every
+section of a link whose furthest vertex is further than the tolerance from the section's chord is split there.
+'''
+
+import numpy as np
+
+import NB_EE.lib.flow_accumulation as flow_accumulation
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([flow_accumulation])
+
+
+def traceLinks(streams, fdr):
+
+    '''
+    Traces the links of the stream network. streams is a boolean array of stream cells, fdr the flow directions.
+    Returns (flat cell index of each vertex, ordered along the links; index of each link's first vertex, with the
+    number of vertices appended; FROM_NODE and TO_NODE of each link).
+    '''
+
+    rows, cols = fdr.shape
+    streams = streams & flow_accumulation.validDirections(fdr)
+    cells = np.flatnonzero(streams)
+    numCells = len(cells)
+
+    if numCells == 0:
+        return cells, np.zeros(1, dtype=np.int64), cells, cells
+
+    # Work in the stream cells' positions in cells
+    position = np.full(rows * cols, -1, dtype=np.int64)
+    position[cells] = np.arange(numCells)
+
+    receiver = flow_accumulation.receivers(fdr)[cells].astype(np.int64)
+    downstream = np.where(receiver >= 0, position[np.maximum(receiver, 0)], -1)
+    del receiver, position
+
+    hasDownstream = downstream >= 0
+    inDegree = np.bincount(downstream[hasDownstream], minlength=numCells)
+
+    # Links start at sources and confluences. Other cells have a single upstream cell, in the same link.
+    isStart = inDegree != 1
+    upstream = np.arange(numCells)
+    flowsOn = hasDownstream & ~isStart[np.maximum(downstream, 0)]
+    upstream[downstream[flowsOn]] = np.flatnonzero(flowsOn)
+
+    # Pointer jumping up to the start of each cell's link, counting the cells passed
+    head = upstream
+    distance = (~isStart).astype(np.int64)
+    for jump in range(numCells.bit_length() + 1):
+        nextHead = head[head]
+        if np.array_equal(nextHead, head):
+            break
+        distance = distance + distance[head]
+        head = nextHead
+
+    # Vertices in order along each link
+    order = np.lexsort((distance, head))
+    linkOf = head[order]
+    linkStarts = np.flatnonzero(np.concatenate([[True], linkOf[1:] != linkOf[:-1]]))
+
+    # Each link ends at the next confluence downstream, if there is one
+    lastCells = order[np.append(linkStarts[1:], numCells) - 1]
+    endCells = np.where(hasDownstream[lastCells], downstream[lastCells], -1)
+
+    vertices = np.insert(order, np.append(linkStarts[1:], numCells)[endCells >= 0], endCells[endCells >= 0])
+    vertexCounts = np.append(np.diff(linkStarts), numCells - linkStarts[-1]) + (endCells >= 0)
+
+    # Nodes: the start cell of each link, and the last cell of links ending at an outlet
+    nodeCells = np.where(endCells >= 0, endCells, lastCells)
+    nodeCellIDs, nodeIndexes = np.unique(np.concatenate([order[linkStarts], nodeCells]), return_inverse=True)
+    fromNodes = nodeIndexes[:len(linkStarts)] + 1
+    toNodes = nodeIndexes[len(linkStarts):] + 1
+
+    # Other links of a single cell (e.g. a confluence at an outlet) have no length and are dropped. A source of a
+    # single cell, whose flow leaves the stream straight away (at the edge of the raster or of the data), is kept
+    # with its cell twice, and linkCoordinates runs it from the cell's centre to its edge, as StreamToFeature does.
+    singleSource = (vertexCounts == 1) & (inDegree[order[linkStarts]] == 0)
+    toNodes[singleSource] = len(nodeCellIDs) + 1 + np.arange(np.count_nonzero(singleSource))
+    keep = (vertexCounts > 1) | singleSource
+    linkCopies = np.where(keep, 1 + singleSource, 0)
+    keptCounts = (vertexCounts * linkCopies)[keep]
+
+    return (cells[np.repeat(vertices, np.repeat(linkCopies, vertexCounts))], np.concatenate([[0], np.cumsum(keptCounts)]),
+            fromNodes[keep], toNodes[keep])
+
+
+def cellCoordinates(cellIndexes, grid):
+
+    ''' x and y coordinates of the centres of the cells (flat indexes) on the grid (lib/raster_arrays.RasterGrid) '''
+
+    rows = cellIndexes // grid.cols
+    cols = cellIndexes % grid.cols
+
+    xs = grid.lowerLeftX + (cols + 0.5) * grid.cellSize
+    ys = grid.lowerLeftY + (grid.rows - rows - 0.5) * grid.cellSize
+
+    return xs, ys
+
+
+def linkCoordinates(vertexCells, lineStarts, fdr, grid):
+
+    '''
+    x and y coordinates of the vertices of the links traced by traceLinks. The second vertex of a single cell link
+    is moved to the edge of the cell its flow leaves by (fdr), so that the link has a length.
+    '''
+
+    xs, ys = cellCoordinates(vertexCells, grid)
+
+    lineEnds = lineStarts[1:] - 1
+    single = (lineEnds - lineStarts[:-1] == 1) & (vertexCells[lineStarts[:-1]] == vertexCells[lineEnds])
+    lastVertices = lineEnds[single]
+
+    rowShifts = np.zeros(256)
+    colShifts = np.zeros(256)
+    for code, (rowShift, colShift) in flow_accumulation.directionShifts.items():
+        rowShifts[code] = rowShift
+        colShifts[code] = colShift
+
+    codes = np.asarray(fdr).ravel()[vertexCells[lastVertices]].astype(np.uint8)
+    xs[lastVertices] += colShifts[codes] * grid.cellSize * 0.5
+    ys[lastVertices] -= rowShifts[codes] * grid.cellSize * 0.5
+
+    return xs, ys
+
+
+def simplify(xs, ys, lineStarts, tolerance):
+
+    '''
+    Douglas-Peucker simplification of all the lines at once. lineStarts gives the index of each line's first vertex,
+    with the number of vertices appended. Returns a mask of the vertices to keep (the first and last of each line are
+    always kept).
+    '''
+
+    numVertices = len(xs)
+    keep = np.zeros(numVertices, dtype=bool)
+    if numVertices == 0:
+        return keep
+
+    keep[lineStarts[:-1]] = True
+    keep[lineStarts[1:] - 1] = True
+
+    # Sections of lines still to be simplified, as (first vertex, last vertex)
+    sectionStarts = lineStarts[:-1]
+    sectionEnds = lineStarts[1:] - 1
+
+    while True:
+        hasInterior = sectionEnds - sectionStarts > 1
+        sectionStarts = sectionStarts[hasInterior]
+        sectionEnds = sectionEnds[hasInterior]
+        if len(sectionStarts) == 0:
+            break
+
+        # Interior vertices of each section
+        interiorCounts = sectionEnds - sectionStarts - 1
+        section = np.repeat(np.arange(len(sectionStarts)), interiorCounts)
+        vertex = np.arange(interiorCounts.sum()) - np.repeat(np.cumsum(interiorCounts) - interiorCounts, interiorCounts) \
+            + sectionStarts[section] + 1
+
+        # Distance of each interior vertex from the section's chord
+        startX, startY = xs[sectionStarts][section], ys[sectionStarts][section]
+        chordX, chordY = xs[sectionEnds][section] - startX, ys[sectionEnds][section] - startY
+        chordLength = np.hypot(chordX, chordY)
+        offsetX, offsetY = xs[vertex] - startX, ys[vertex] - startY
+        distance = np.where(chordLength > 0, np.abs(chordX * offsetY - chordY * offsetX) / np.maximum(chordLength, 1e-12),
+                            np.hypot(offsetX, offsetY))
+
+        # Furthest vertex of each section
+        firstInSection = np.cumsum(interiorCounts) - interiorCounts
+        maxDistance = np.maximum.reduceat(distance, firstInSection)
+        isMax = distance == maxDistance[section]
+        firstMax = np.full(len(sectionStarts), -1, dtype=np.int64)
+        maxIndexes = np.flatnonzero(isMax)
+        firstMax[section[maxIndexes][::-1]] = vertex[maxIndexes][::-1]
+
+        split = maxDistance > tolerance
+        splitVertex = firstMax[split]
+        keep[splitVertex] = True
+
+        sectionStarts, sectionEnds = (np.concatenate([sectionStarts[split], splitVertex]),
+                                      np.concatenate([splitVertex, sectionEnds[split]]))
+
+    return keep
+
+
+def traceStreams(streams, fdr, grid, tolerance=None):
+
+    '''
+    Traces the stream lines. Returns (x and y vertex coordinates, index of each line's first vertex with the number of
+    vertices appended, FROM_NODE, TO_NODE, and a mask of the vertices kept in the simplified display lines).
+    tolerance: Douglas-Peucker tolerance for the display lines. Defaults to the cell size.
+    '''
+
+    vertexCells, lineStarts, fromNodes, toNodes = traceLinks(streams, fdr)
+    xs, ys = linkCoordinates(vertexCells, lineStarts, fdr, grid)
+
+    if tolerance is None:
+        tolerance = grid.cellSize
+
+    return xs, ys, lineStarts, fromNodes, toNodes, simplify(xs, ys, lineStarts, tolerance)
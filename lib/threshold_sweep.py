@@ -0,0 +1,159 @@
+'''
+threshold_sweep.py creates the stream outputs of Preprocess DEM for several pairs of stream accumulation thresholds
+(minor and major, in hectares) in one run, reusing the flow accumulation and flow direction already calculated.
+
+The flow accumulation is sorted once, so the number of stream cells for any threshold is found with a binary search
+and logged before any streams are traced. The streams for each pair are traced (lib/stream_tracer.py) in parallel in a
+pool of worker processes, which read the flow accumulation and flow directions from .npy files in the scratch folder.
+Each pair's outputs are written to its own subfolder of the output folder.
+'''
+
+import os
+import numpy as np
+
+import NB_EE.lib.log as log
+import NB_EE.lib.raster_arrays as raster_arrays
+import NB_EE.lib.stream_tracer as stream_tracer
+import NB_EE.lib.stream_order as stream_order
+import NB_EE.lib.worker as worker
+import NB_EE.lib.array_pipeline as array_pipeline
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log, raster_arrays, stream_tracer, stream_order, worker, array_pipeline])
+
+
+def parseThresholdPairs(thresholdText):
+
+    ''' Reads pairs of thresholds from text such as "1 10;2 20" (the text of a value table parameter) '''
+
+    pairs = []
+    if thresholdText in [None, '', '#']:
+        return pairs
+
+    for row in thresholdText.split(';'):
+        values = row.replace(',', ' ').split()
+        if len(values) == 2:
+            pairs.append((float(values[0]), float(values[1])))
+
+    return pairs
+
+
+def pairFolder(outputFolder, minAccThresh, majAccThresh):
+
+    ''' Subfolder for the outputs of a threshold pair, e.g. thresholds/min_2p5_maj_20 '''
+
+    def label(value):
+        return ('%g' % value).replace('.', 'p').replace('-', 'm')
+
+    return os.path.join(outputFolder, 'thresholds', 'min_' + label(minAccThresh) + '_maj_' + label(majAccThresh))
+
+
+def streamCellCounts(sortedAccumulation, thresholdsHa, cellAreaHa):
+
+    ''' Number of cells with accumulation (in hectares) above each threshold, from the sorted accumulation (in cells) '''
+
+    sortedAccumulationHa = sortedAccumulation * cellAreaHa
+
+    return [len(sortedAccumulationHa) - int(np.searchsorted(sortedAccumulationHa, threshold, side='right'))
+            for threshold in thresholdsHa]
+
+
+def traceThreshold(facFile, fdrFile, cellAreaHa, minAccThresh):
+
+    '''
+    Traces the streams with accumulation above minAccThresh hectares. Run in a worker process.
+    Returns the stream_tracer.traceLinks outputs, and the mask of the vertices kept in the display lines
+    (simplified with a tolerance of one cell).
+    '''
+
+    accumulation = np.load(facFile, mmap_mode='r')
+    fdr = np.load(fdrFile, mmap_mode='r')
+
+    with np.errstate(invalid='ignore'):
+        streams = np.asarray(accumulation) * cellAreaHa > minAccThresh
+
+    cells, lineStarts, fromNodes, toNodes = stream_tracer.traceLinks(streams, np.asarray(fdr))
+    del streams
+
+    # Simplify in cell units, which is the same as simplifying in map units with a tolerance of the cell size
+    cols = fdr.shape[1]
+    displayVertices = stream_tracer.simplify((cells % cols).astype(np.float64), -(cells // cols).astype(np.float64),
+                                             lineStarts, 1.0)
+
+    return cells, lineStarts, fromNodes, toNodes, displayVertices
+
+
+def sweep(outputFolder, hydFAC, hydFDR, thresholdPairs, scratchFolder, store=None):
+
+    '''
+    Creates streams.shp, streamDisplay.shp, streamInvRas and streamsRaster.tif (stream display classes) for each
+    (minAccThresh, majAccThresh) pair in thresholdPairs, in the pair's subfolder of outputFolder.
+    Returns the list of subfolders.
+    store: lib/array_pipeline.ArrayStore holding hydFAC and hydFDR, if they are in memory.
+    '''
+
+    if store is None:
+        store = array_pipeline.ArrayStore()
+
+    accumulation, grid = store.get('hydFAC', hydFAC)
+    fdr, fdrGrid = store.get('hydFDR', hydFDR, np.uint8)
+    cellAreaHa = grid.cellSize * grid.cellSize / 10000.0
+
+    # Stream cell counts for every threshold from one sort of the accumulation
+    sortedAccumulation = np.sort(accumulation[~np.isnan(accumulation)])
+    counts = streamCellCounts(sortedAccumulation, [pair[0] for pair in thresholdPairs], cellAreaHa)
+    del sortedAccumulation
+
+    for (minAccThresh, majAccThresh), count in zip(thresholdPairs, counts):
+        log.info('Threshold ' + str(minAccThresh) + ' ha: ' + str(count) + ' stream cells')
+
+    facFile = os.path.join(scratchFolder, 'sweep_hydFAC.npy')
+    fdrFile = os.path.join(scratchFolder, 'sweep_hydFDR.npy')
+    np.save(facFile, accumulation)
+    np.save(fdrFile, fdr)
+    del fdr
+
+    traces = worker.mapInPool(traceThreshold, [(facFile, fdrFile, cellAreaHa, pair[0]) for pair in thresholdPairs])
+
+    # The stream feature classes are created with arcpy, so rasters still being written by the store must be finished
+    store.waitForWrites()
+
+    folders = []
+    for (minAccThresh, majAccThresh), count, trace in zip(thresholdPairs, counts, traces):
+
+        folder = pairFolder(outputFolder, minAccThresh, majAccThresh)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        folders.append(folder)
+
+        # Stream raster for input to the Nature Braid (0 for stream, 1 for no stream) and stream display classes
+        with np.errstate(invalid='ignore'):
+            isStream = accumulation * cellAreaHa > minAccThresh
+            isMajor = accumulation * cellAreaHa > majAccThresh
+
+        streamInv = np.where(isStream, 0, 1).astype(np.uint8)
+        streamInv[np.isnan(accumulation)] = 255
+        raster_arrays.writeRaster(streamInv, grid, os.path.join(folder, 'streamInvRas'), 255)
+        del streamInv
+
+        streamClasses = np.where(isStream, np.where(isMajor, 2, 1), 255).astype(np.uint8)
+        raster_arrays.writeRaster(streamClasses, grid, os.path.join(folder, 'streamsRaster.tif'), 255)
+        del streamClasses, isStream, isMajor
+
+        if count == 0:
+            log.warning('No streams initiated with threshold ' + str(minAccThresh) + ' ha')
+            continue
+
+        cells, lineStarts, fromNodes, toNodes, displayVertices = trace
+        xs, ys = stream_tracer.linkCoordinates(cells, lineStarts, np.load(fdrFile, mmap_mode='r'), grid)
+
+        stream_order.writeTracedStreams(os.path.join(folder, 'streams.shp'), grid.spatialRef,
+                                        xs, ys, lineStarts, fromNodes, toNodes)
+        stream_order.writeTracedStreams(os.path.join(folder, 'streamDisplay.shp'), grid.spatialRef,
+                                        xs, ys, lineStarts, fromNodes, toNodes, displayVertices)
+
+        log.info('Stream files created for thresholds ' + str(minAccThresh) + ' and ' + str(majAccThresh) + ' ha')
+
+    os.remove(facFile)
+    os.remove(fdrFile)
+
+    return folders
@@ -0,0 +1,254 @@
+'''
+tile_prefetch.py overlaps the reading and writing of raster tiles (or blocks of rows) with their processing, so that
+the disk and the processor are busy at the same time rather than in turn.
+
+    prefetch() reads the next tiles in a reader thread while the caller processes the current one
+    BackgroundWriter writes (or otherwise stores) finished tiles in a writer thread while the caller moves on
+
+Both are limited by a queue depth (the number of tiles waiting) and a memory limit (the bytes held in the arrays of
+the waiting tiles), so that reading cannot run far ahead of processing, nor processing far ahead of writing. The
+limits are set in the user settings (00 Initialise toolbox), with defaults in configuration.py.
+
+Threads are used rather than processes, as the tiles are shared with the caller without copying. Waiting on the
+disk, and much of the work in NumPy and zlib, release the GIL.
+
+arcpy must not be called from two threads at once, so reading and writing functions which call arcpy must hold
+lib/arcpy_lock.py, as raster_arrays.RasterTileSource.read and writeRaster do. Tiles read from arrays, .npy
+files or raster stores (lib/raster_store.py) do not call arcpy.
+'''
+
+import os
+import threading
+import traceback
+
+import numpy as np
+
+import configuration
+import NB_EE.lib.common as common
+from NB_EE.lib.external.six.moves import queue
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([common])
+
+# Marks the end of the reader's results
+endOfTiles = 'endOfTiles'
+
+
+def settings():
+
+    ''' Queue depth (in tiles) and memory limit (in bytes) from the user settings, or the defaults in configuration.py '''
+
+    queueDepth = configuration.prefetchTiles
+    memoryMB = configuration.prefetchMemoryMB
+
+    try:
+        if os.path.exists(configuration.userSettingsFile):
+            userQueueDepth, userMemoryMB = common.readXML(configuration.userSettingsFile,
+                                                          ['prefetchTiles', 'prefetchMemoryMB'], showErrors=False)
+            if userQueueDepth:
+                queueDepth = int(userQueueDepth)
+            if userMemoryMB:
+                memoryMB = float(userMemoryMB)
+
+    except Exception:
+        pass # If any errors occur, ignore them. Just use the defaults.
+
+    return max(queueDepth, 1), int(memoryMB * 1024 * 1024)
+
+
+def arrayBytes(value):
+
+    ''' Bytes held in the arrays in value (an array, or a list, tuple or dictionary of them) '''
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum([arrayBytes(item) for item in value.values()])
+    if isinstance(value, (list, tuple)):
+        return sum([arrayBytes(item) for item in value])
+
+    return 0
+
+
+class MemoryLimit:
+
+    ''' Counts the bytes held in waiting tiles, and blocks while adding a tile would go over the limit '''
+
+    def __init__(self, limit):
+
+        self.limit = limit
+        self.held = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size, stopped=None):
+
+        '''
+        Waits until the tile fits within the limit, then counts it. A tile larger than the limit is let through when
+        no others are held, so that it cannot wait forever. Returns False if stopped was set while waiting.
+        '''
+
+        with self.condition:
+            while self.held > 0 and self.held + size > self.limit:
+                if stopped is not None and stopped.is_set():
+                    return False
+                self.condition.wait(0.1)
+
+            self.held += size
+
+        return True
+
+    def release(self, size):
+
+        with self.condition:
+            self.held -= size
+            self.condition.notify_all()
+
+
+def prefetch(readFunction, jobs, queueDepth=None, memoryLimit=None):
+
+    '''
+    Calls readFunction(job) for each of the jobs (e.g. tile windows) in a reader thread, up to queueDepth jobs ahead
+    of the caller, and yields (job, result) in order. An error in readFunction is raised in the caller.
+    queueDepth and memoryLimit (bytes) default to settings().
+    '''
+
+    defaultQueueDepth, defaultMemoryLimit = settings()
+    if queueDepth is None:
+        queueDepth = defaultQueueDepth
+    if memoryLimit is None:
+        memoryLimit = defaultMemoryLimit
+
+    results = queue.Queue(queueDepth)
+    limit = MemoryLimit(memoryLimit)
+    stopped = threading.Event()
+
+    def put(item):
+
+        # Gives up if the caller stops taking results
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def reader():
+
+        for job in jobs:
+            if stopped.is_set():
+                return
+
+            try:
+                result = readFunction(job)
+            except Exception:
+                put((job, None, traceback.format_exc(), 0))
+                return
+
+            size = arrayBytes(result)
+            if not limit.acquire(size, stopped) or not put((job, result, None, size)):
+                return
+
+        put(endOfTiles)
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = results.get()
+            if item is endOfTiles:
+                break
+
+            job, result, error, size = item
+            if error is not None:
+                raise RuntimeError('Tile could not be read:\n' + error)
+
+            limit.release(size)
+            yield job, result
+
+    finally:
+        stopped.set()
+        thread.join()
+
+
+class BackgroundWriter:
+
+    '''
+    Calls writeFunction with the arguments of each write() in a writer thread, in the order they were given.
+    queueDepth: number of writes which may wait (0 for no limit). memoryLimit: bytes which may be held in the arrays
+    of waiting writes (None for no limit). write() blocks while either limit is reached.
+    '''
+
+    def __init__(self, writeFunction, queueDepth=0, memoryLimit=None, description='Tile'):
+
+        self.writeFunction = writeFunction
+        self.description = description
+        self.queue = queue.Queue(queueDepth)
+        self.limit = None
+        if memoryLimit is not None:
+            self.limit = MemoryLimit(memoryLimit)
+
+        self.errors = []
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+
+                args, size = job
+                try:
+                    self.writeFunction(*args)
+                finally:
+                    if self.limit is not None:
+                        self.limit.release(size)
+
+            except Exception:
+                self.errors.append(traceback.format_exc())
+
+            finally:
+                self.queue.task_done()
+
+    def write(self, *args):
+
+        # Stop queueing work as soon as a write has failed
+        if self.errors:
+            self.wait()
+
+        size = 0
+        if self.limit is not None:
+            size = arrayBytes(args)
+            self.limit.acquire(size)
+
+        self.queue.put((args, size))
+
+    def wait(self):
+
+        ''' Waits for the queued writes to finish. Raises an error if any failed. '''
+
+        self.queue.join()
+
+        if self.errors:
+            errors = self.errors
+            self.errors = []
+            raise RuntimeError(self.description + ' could not be written:\n' + '\n'.join(errors))
+
+    def close(self):
+
+        self.queue.put(None)
+        self.thread.join()
+
+
+def writerFromSettings(writeFunction, description='Tile'):
+
+    ''' BackgroundWriter with the queue depth and memory limit from settings() '''
+
+    queueDepth, memoryLimit = settings()
+    return BackgroundWriter(writeFunction, queueDepth, memoryLimit, description)
@@ -0,0 +1,281 @@
+'''
+tiled_accumulation.py calculates flow accumulation for flow direction rasters too large to hold in memory, one tile
+at a time, with the tiles processed in parallel in a pool of worker processes (lib/worker.py).
+
+Only one tile (plus a one cell border) of flow directions is held in memory by each worker, so peak memory depends on
+the tile size rather than the size of the raster.
+
+    1. Each tile's accumulation is calculated on its own, as if no flow entered it. For each cell on the edge of the
+       tile, the cell at which its flow leaves the tile (its exit cell) is found, along with the flow leaving the
+       tile at each exit cell and the cell in the neighbouring tile it flows into.
+
+    2. The edge cells of all tiles form a small graph: each edge cell flows to its exit cell, and each exit cell
+       flows to a cell on the edge of a neighbouring tile. The flow entering each tile across its edges is found by
+       summing flow down this graph (as lib/flow_accumulation.py sums flow down the grid).
+
+    3. Each tile's accumulation is recalculated with the flow entering it added at its edge cells, giving the same
+       result as calculating the accumulation of the whole raster at once.
+
+Tiles are read from a tile source, which has rows and cols attributes and a read(rowStart, rowEnd, colStart, colEnd)
+method returning that window of the raster (e.g. RasterTileSource in lib/raster_arrays.py, or NumpyTileSource).
+Tile sources are passed to the workers, so must be picklable.
+'''
+
+import os
+import numpy as np
+
+import NB_EE.lib.flow_accumulation as flow_accumulation
+import NB_EE.lib.worker as worker
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([flow_accumulation, worker])
+
+# Rasters with more cells than this are accumulated in tiles rather than in memory
+maxInMemoryCells = 100000000
+
+defaultTileSize = 2048
+
+
+class NumpyTileSource:
+
+    ''' Reads tiles from an array saved as a .npy file, without loading the whole array '''
+
+    def __init__(self, npyFile):
+
+        self.npyFile = npyFile
+        self.rows, self.cols = np.load(npyFile, mmap_mode='r').shape
+
+    def read(self, rowStart, rowEnd, colStart, colEnd):
+
+        return np.array(np.load(self.npyFile, mmap_mode='r')[rowStart:rowEnd, colStart:colEnd])
+
+
+def tiles(rows, cols, tileSize):
+
+    ''' (row start, row end, column start, column end) of each tile, in row major order '''
+
+    return [(rowStart, min(rowStart + tileSize, rows), colStart, min(colStart + tileSize, cols))
+            for rowStart in range(0, rows, tileSize)
+            for colStart in range(0, cols, tileSize)]
+
+
+def readTile(fdrSource, weightSource, tile, border=0):
+
+    '''
+    Reads the flow directions and cell weights (flow) of the tile. Cells with no valid flow direction have no flow.
+    With a border, the flow directions of the cells around the tile (within the raster) are also returned.
+    '''
+
+    rowStart, rowEnd, colStart, colEnd = tile
+    windowRowStart, windowColStart = max(rowStart - border, 0), max(colStart - border, 0)
+    window = fdrSource.read(windowRowStart, min(rowEnd + border, fdrSource.rows),
+                            windowColStart, min(colEnd + border, fdrSource.cols))
+
+    fdr = window[rowStart - windowRowStart:rowEnd - windowRowStart, colStart - windowColStart:colEnd - windowColStart]
+    valid = flow_accumulation.validDirections(fdr).ravel()
+
+    if weightSource is None:
+        flow = valid.astype(np.float64)
+    else:
+        flow = np.nan_to_num(weightSource.read(rowStart, rowEnd, colStart, colEnd).astype(np.float64).ravel())
+        flow[~valid] = 0
+
+    return fdr, valid, flow, (window, windowRowStart, windowColStart)
+
+
+def edgeCells(tileRows, tileCols):
+
+    ''' Flat indexes (within the tile) of the cells on the edge of the tile '''
+
+    edge = np.zeros((tileRows, tileCols), dtype=bool)
+    edge[0, :] = edge[-1, :] = edge[:, 0] = edge[:, -1] = True
+
+    return np.flatnonzero(edge)
+
+
+def tileExits(fdrSource, weightSource, tile):
+
+    '''
+    Pass 1: accumulates flow within the tile, and finds where flow leaves it.
+    Returns (global cell indexes of the tile's valid edge cells, global index of each one's exit cell (-1 if its flow
+    does not leave the tile), global indexes of the exit cells, global index of the cell each exit flows into,
+    flow leaving the tile at each exit).
+    '''
+
+    rowStart, rowEnd, colStart, colEnd = tile
+    rows, cols = fdrSource.rows, fdrSource.cols
+    tileRows, tileCols = rowEnd - rowStart, colEnd - colStart
+
+    fdr, valid, flow, (window, windowRowStart, windowColStart) = readTile(fdrSource, weightSource, tile, 1)
+    receiver = flow_accumulation.receivers(fdr)
+    accumulation = flow_accumulation.propagate(receiver, flow, valid)
+
+    edge = edgeCells(tileRows, tileCols)
+    edge = edge[valid[edge]]
+    edgeRows = edge // tileCols
+    edgeCols = edge % tileCols
+
+    # Downstream cell (in the whole raster) of each edge cell
+    rowShift = np.zeros(256, dtype=np.int64)
+    colShift = np.zeros(256, dtype=np.int64)
+    isDirection = np.zeros(256, dtype=bool)
+    for code in flow_accumulation.directionShifts:
+        rowShift[code], colShift[code] = flow_accumulation.directionShifts[code]
+        isDirection[code] = True
+
+    codes = fdr.ravel()[edge].astype(np.uint8)
+    targetRows = edgeRows + rowShift[codes]
+    targetCols = edgeCols + colShift[codes]
+    globalTargetRows = targetRows + rowStart
+    globalTargetCols = targetCols + colStart
+
+    leavesTile = (isDirection[codes] & ((targetRows < 0) | (targetRows >= tileRows) | (targetCols < 0) | (targetCols >= tileCols))
+                  & (globalTargetRows >= 0) & (globalTargetRows < rows) & (globalTargetCols >= 0) & (globalTargetCols < cols))
+
+    # Flow into a NoData cell of the neighbouring tile leaves the raster, as in the whole raster accumulation
+    exits = edge[leavesTile]
+    exitTargetRows = globalTargetRows[leavesTile]
+    exitTargetCols = globalTargetCols[leavesTile]
+    targetValid = flow_accumulation.validDirections(window[exitTargetRows - windowRowStart, exitTargetCols - windowColStart])
+    del window
+
+    exits = exits[targetValid]
+    exitTargets = exitTargetRows[targetValid] * cols + exitTargetCols[targetValid]
+    exitOutflows = accumulation[exits] + flow[exits]
+
+    # Find the cell at which each cell's flow stops within the tile, by pointer jumping
+    pointer = np.where(receiver >= 0, receiver, np.arange(len(receiver), dtype=receiver.dtype))
+    del receiver, accumulation
+    while True:
+        jumped = pointer[pointer]
+        if np.array_equal(jumped, pointer):
+            break
+        pointer = jumped
+    del jumped
+
+    isExit = np.zeros(len(pointer), dtype=bool)
+    isExit[exits] = True
+    edgeEnds = pointer[edge]
+    edgeExits = np.where(isExit[edgeEnds], globalIndexes(edgeEnds, tile, cols), -1)
+
+    return (globalIndexes(edge, tile, cols), edgeExits, globalIndexes(exits, tile, cols), exitTargets, exitOutflows)
+
+
+def globalIndexes(tileIndexes, tile, cols):
+
+    ''' Converts flat indexes within the tile to flat indexes within the whole raster '''
+
+    rowStart, rowEnd, colStart, colEnd = tile
+    tileCols = colEnd - colStart
+    tileIndexes = np.asarray(tileIndexes, dtype=np.int64)
+
+    return (tileIndexes // tileCols + rowStart) * cols + tileIndexes % tileCols + colStart
+
+
+def edgeInflows(exitResults):
+
+    '''
+    Sums flow down the graph of tile edge cells. exitResults is the list of tileExits results for all tiles.
+    Returns (global cell indexes of the edge cells, flow entering the tile at each edge cell from other tiles).
+    '''
+
+    nodes = np.concatenate([result[0] for result in exitResults])
+    nodeExits = np.concatenate([result[1] for result in exitResults])
+    exits = np.concatenate([result[2] for result in exitResults])
+    exitTargets = np.concatenate([result[3] for result in exitResults])
+    exitOutflows = np.concatenate([result[4] for result in exitResults])
+
+    order = np.argsort(nodes)
+    nodes = nodes[order]
+    nodeExits = nodeExits[order]
+
+    # Edge cells flow to their exit cell, and exit cells flow into the neighbouring tile
+    receiver = np.full(len(nodes), -1, dtype=np.int64)
+    hasExit = nodeExits >= 0
+    receiver[hasExit] = np.searchsorted(nodes, nodeExits[hasExit])
+
+    exitNodes = np.searchsorted(nodes, exits)
+    targetNodes = np.searchsorted(nodes, exitTargets)
+    receiver[exitNodes] = targetNodes
+
+    # Flow within each tile is already counted at its exits, so only exits add flow to the graph
+    flow = np.zeros(len(nodes), dtype=np.float64)
+    flow[exitNodes] = exitOutflows
+
+    accumulation = flow_accumulation.propagate(receiver, flow, np.ones(len(nodes), dtype=bool))
+
+    inflows = np.zeros(len(nodes), dtype=np.float64)
+    np.add.at(inflows, targetNodes, flow[exitNodes] + accumulation[exitNodes])
+
+    entering = inflows > 0
+
+    return nodes[entering], inflows[entering]
+
+
+def tileAccumulation(fdrSource, weightSource, tile, inflowCells, inflows, accumulationFile, integerFile):
+
+    '''
+    Pass 2: accumulates flow within the tile, with the flow entering from other tiles (inflows, at the global cell
+    indexes inflowCells) added at the tile's edge cells. Saves the accumulation (float32, NaN for NoData) and its
+    integer version (NoData -1) as .npy files.
+    '''
+
+    rowStart, rowEnd, colStart, colEnd = tile
+    tileRows, tileCols = rowEnd - rowStart, colEnd - colStart
+    cols = fdrSource.cols
+
+    fdr, valid, flow, window = readTile(fdrSource, weightSource, tile)
+    del window
+
+    injected = np.zeros(len(flow), dtype=np.float64)
+    injected[(inflowCells // cols - rowStart) * tileCols + inflowCells % cols - colStart] = inflows
+
+    accumulation = flow_accumulation.propagate(flow_accumulation.receivers(fdr), flow + injected, valid) + injected
+    del fdr, flow, injected
+
+    result = accumulation.astype(np.float32).reshape(tileRows, tileCols)
+    result[~valid.reshape(tileRows, tileCols)] = np.nan
+    del accumulation
+
+    np.save(accumulationFile, result)
+    np.save(integerFile, flow_accumulation.integerView(result))
+
+    return accumulationFile, integerFile
+
+
+def accumulate(fdrSource, scratchFolder, weightSource=None, tileSize=defaultTileSize, processes=None):
+
+    '''
+    Calculates the flow accumulation of the flow directions read from fdrSource (NoData 255) in tiles.
+    weightSource: optional tile source of cell weights, as the weights of flow_accumulation.accumulate.
+    Returns a list of (row start, row end, column start, column end, accumulation .npy file, integer .npy file),
+    one per tile, with the files saved in scratchFolder.
+    '''
+
+    tileList = tiles(fdrSource.rows, fdrSource.cols, tileSize)
+
+    exitResults = worker.mapInPool(tileExits, [(fdrSource, weightSource, tile) for tile in tileList], processes)
+    inflowCells, inflows = edgeInflows(exitResults)
+    del exitResults
+
+    # Inflows for each tile's cells
+    inflowRows = inflowCells // fdrSource.cols
+    inflowCols = inflowCells % fdrSource.cols
+
+    jobs = []
+    for tile in tileList:
+        rowStart, rowEnd, colStart, colEnd = tile
+        inTile = (inflowRows >= rowStart) & (inflowRows < rowEnd) & (inflowCols >= colStart) & (inflowCols < colEnd)
+        name = os.path.join(scratchFolder, 'facTile_' + str(rowStart) + '_' + str(colStart))
+        jobs.append((fdrSource, weightSource, tile, inflowCells[inTile], inflows[inTile], name + '.npy', name + '_int.npy'))
+
+    tileFiles = worker.mapInPool(tileAccumulation, jobs, processes)
+
+    return [tile + files for tile, files in zip(tileList, tileFiles)]
+
+
+def deleteTileFiles(tileList):
+
+    for tile in tileList:
+        for tileFile in tile[4:]:
+            if os.path.exists(tileFile):
+                os.remove(tileFile)
@@ -0,0 +1,269 @@
+'''
+tiled_fill.py fills depressions in a DEM one tile at a time, with the tiles processed in parallel in a pool of worker
+processes (lib/worker.py), following Barnes (2016, "Parallel Priority-Flood depression filling for trillion cell
+digital elevation models on desktops or clusters").
+
+    1. Each tile is filled on its own with the Priority-Flood (as lib/priority_flood.py), treating every cell on the
+       edge of the tile as an outlet. Each edge cell starts its own watershed label, except for cells on the edge of
+       the DEM or next to NoData, which drain out of the DEM and share the label 0. Labels spread with the flood, and
+       where two watersheds meet, the lowest elevation at which water can spill from one to the other is recorded.
+
+    2. Neighbouring cells on either side of each tile edge join the watersheds of the two tiles, with a spill
+       elevation of the higher of the two cells. The level of each watershed is the lowest elevation at which water
+       can spill from it out of the DEM, found with a Priority-Flood over this graph of watersheds.
+
+    3. Each tile's cells are raised to the level of their watershed, where that is above their level in the tile.
+
+Levels are only ever taken from DEM elevations, so the result is bit-identical to filling the whole DEM at once with
+priority_flood.fill (with an epsilon of 0).
+
+Tiles are read from a tile source with rows and cols attributes and a read(rowStart, rowEnd, colStart, colEnd) method
+returning that window of the DEM with NoData as NaN (see lib/tiled_accumulation.py). Filled tiles are saved as .npy
+files in the scratch folder.
+'''
+
+import heapq
+from collections import deque
+import os
+
+import numpy as np
+
+import NB_EE.lib.priority_flood as priority_flood
+import NB_EE.lib.tiled_accumulation as tiled_accumulation
+import NB_EE.lib.worker as worker
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([priority_flood, tiled_accumulation, worker])
+
+
+def readPadded(demSource, tile):
+
+    ''' The tile with a one cell border of the neighbouring tiles' cells (NaN beyond the edge of the DEM) '''
+
+    rowStart, rowEnd, colStart, colEnd = tile
+    windowRowStart, windowColStart = max(rowStart - 1, 0), max(colStart - 1, 0)
+    windowRowEnd, windowColEnd = min(rowEnd + 1, demSource.rows), min(colEnd + 1, demSource.cols)
+
+    padded = np.full((rowEnd - rowStart + 2, colEnd - colStart + 2), np.nan, dtype=np.float32)
+    padded[windowRowStart - rowStart + 1:windowRowEnd - rowStart + 1, windowColStart - colStart + 1:windowColEnd - colStart + 1] = \
+        demSource.read(windowRowStart, windowRowEnd, windowColStart, windowColEnd)
+
+    return padded
+
+
+def tileFlood(demSource, tile, filledFile, labelFile):
+
+    '''
+    Pass 1: fills the tile with its edges as outlets, and labels the watershed of each cell.
+    Saves the filled tile and the labels as .npy files. Returns (number of labels, global cell indexes of the tile's
+    valid edge cells, their labels, the pairs of labels of watersheds which meet in the tile with their spill
+    elevations, and pairs of global cell indexes of edge cells and their neighbours in other tiles with their
+    spill elevations).
+    '''
+
+    rowStart, rowEnd, colStart, colEnd = tile
+    cols = demSource.cols
+    padded = readPadded(demSource, tile)
+    paddedCols = padded.shape[1]
+    offsets = priority_flood.neighbourOffsets(paddedCols)
+
+    inTile = np.zeros(padded.shape, dtype=bool)
+    inTile[1:-1, 1:-1] = True
+    valid = ~np.isnan(padded)
+
+    edge = np.zeros(padded.shape, dtype=bool)
+    edge[1, 1:-1] = edge[-2, 1:-1] = edge[1:-1, 1] = edge[1:-1, -2] = True
+    edgeCells = np.flatnonzero(edge & valid)
+
+    # Cells of the tile next to NaN drain out of the DEM (label 0). Other edge cells each start a watershed.
+    outlets = priority_flood.outletCells(padded)
+    labels = np.full(padded.size, -1, dtype=np.int64)
+    labels[edgeCells] = np.arange(1, len(edgeCells) + 1)
+    labels[outlets] = 0
+    numLabels = len(edgeCells) + 1
+
+    elevations = padded.ravel().tolist()
+    closed = bytearray((~(inTile & valid)).ravel().astype(np.uint8).tobytes())
+    labelList = labels.tolist()
+
+    openQueue = []
+    for cell in np.union1d(edgeCells, outlets).tolist():
+        openQueue.append((elevations[cell], cell))
+        closed[cell] = 1
+    heapq.heapify(openQueue)
+
+    pitQueue = deque()
+    spills = {}
+
+    while openQueue or pitQueue:
+
+        if pitQueue:
+            cell = pitQueue.popleft()
+        else:
+            cell = heapq.heappop(openQueue)[1]
+
+        level = elevations[cell]
+        label = labelList[cell]
+
+        for offset in offsets:
+            neighbour = cell + offset
+
+            if closed[neighbour]:
+                # Record where two watersheds meet (cells outside the tile, and NaN cells, have no label)
+                neighbourLabel = labelList[neighbour]
+                if neighbourLabel != label and neighbourLabel >= 0:
+                    pair = (label, neighbourLabel) if label < neighbourLabel else (neighbourLabel, label)
+                    spill = max(level, elevations[neighbour])
+                    if spill < spills.get(pair, np.inf):
+                        spills[pair] = spill
+                continue
+
+            closed[neighbour] = 1
+            labelList[neighbour] = label
+
+            if elevations[neighbour] <= level:
+                elevations[neighbour] = level
+                pitQueue.append(neighbour)
+            else:
+                heapq.heappush(openQueue, (elevations[neighbour], neighbour))
+
+    filled = np.array(elevations, dtype=np.float32).reshape(padded.shape)
+    np.save(filledFile, filled[1:-1, 1:-1])
+    np.save(labelFile, np.array(labelList, dtype=np.int32).reshape(padded.shape)[1:-1, 1:-1])
+    del filled, elevations, labelList
+
+    spillPairs = np.array(list(spills.keys()), dtype=np.int64).reshape(-1, 2)
+    spillElevations = np.array(list(spills.values()), dtype=np.float64)
+
+    # Edge cells and their valid neighbours in other tiles
+    neighbours = edgeCells[:, None] + np.array(offsets, dtype=np.int64)[None, :]
+    fromCells = np.repeat(edgeCells, len(offsets)).reshape(neighbours.shape)
+    across = ~inTile.ravel()[neighbours] & valid.ravel()[neighbours]
+    fromCells = fromCells[across]
+    toCells = neighbours[across]
+    acrossElevations = np.maximum(padded.ravel()[fromCells], padded.ravel()[toCells]).astype(np.float64)
+
+    return (numLabels, paddedToGlobal(edgeCells, tile, cols), labels[edgeCells], spillPairs, spillElevations,
+            paddedToGlobal(fromCells, tile, cols), paddedToGlobal(toCells, tile, cols), acrossElevations)
+
+
+def paddedToGlobal(paddedIndexes, tile, cols):
+
+    ''' Converts flat indexes in the padded tile to flat indexes in the whole DEM '''
+
+    rowStart, rowEnd, colStart, colEnd = tile
+    paddedCols = colEnd - colStart + 2
+
+    return (paddedIndexes // paddedCols - 1 + rowStart) * cols + paddedIndexes % paddedCols - 1 + colStart
+
+
+def spillLevels(floodResults):
+
+    '''
+    Resolves the graph of the watersheds of all tiles. Returns the level of each watershed, indexed by global label
+    (the tile's label plus the tile's offset, with label 0 of every tile being global label 0), and the tile offsets.
+    '''
+
+    numLabels = np.array([result[0] for result in floodResults], dtype=np.int64)
+    tileOffsets = np.concatenate([[0], np.cumsum(numLabels)[:-1]])
+
+    def globalLabels(tileLabels, tileOffset):
+        return np.where(tileLabels == 0, 0, tileLabels + tileOffset)
+
+    # Global label of each tile edge cell
+    edgeCells = np.concatenate([result[1] for result in floodResults])
+    edgeLabels = np.concatenate([globalLabels(result[2], tileOffset) for result, tileOffset in zip(floodResults, tileOffsets)])
+    order = np.argsort(edgeCells)
+    edgeCells = edgeCells[order]
+    edgeLabels = edgeLabels[order]
+
+    # Watersheds meeting within tiles, and across tile edges
+    labelsFrom = [globalLabels(result[3][:, 0], tileOffset) for result, tileOffset in zip(floodResults, tileOffsets)]
+    labelsTo = [globalLabels(result[3][:, 1], tileOffset) for result, tileOffset in zip(floodResults, tileOffsets)]
+    elevations = [result[4] for result in floodResults]
+
+    for result in floodResults:
+        labelsFrom.append(edgeLabels[np.searchsorted(edgeCells, result[5])])
+        labelsTo.append(edgeLabels[np.searchsorted(edgeCells, result[6])])
+        elevations.append(result[7])
+
+    labelsFrom = np.concatenate(labelsFrom)
+    labelsTo = np.concatenate(labelsTo)
+    elevations = np.concatenate(elevations)
+
+    # Adjacency lists of the (undirected) graph, sorted by label
+    nodes = np.concatenate([labelsFrom, labelsTo])
+    order = np.argsort(nodes, kind='stable')
+    adjacent = np.concatenate([labelsTo, labelsFrom])[order].tolist()
+    adjacentElevations = np.concatenate([elevations, elevations])[order].tolist()
+    starts = np.searchsorted(nodes[order], np.arange(numLabels.sum() + 1)).tolist()
+    del nodes, order
+
+    # Priority-Flood over the graph from the watersheds which drain out of the DEM
+    levels = [np.inf] * int(numLabels.sum())
+    levels[0] = -np.inf
+    done = bytearray(len(levels))
+    openQueue = [(-np.inf, 0)]
+
+    while openQueue:
+        level, label = heapq.heappop(openQueue)
+        if done[label]:
+            continue
+        done[label] = 1
+
+        for i in range(starts[label], starts[label + 1]):
+            neighbour = adjacent[i]
+            neighbourLevel = max(level, adjacentElevations[i])
+            if neighbourLevel < levels[neighbour]:
+                levels[neighbour] = neighbourLevel
+                heapq.heappush(openQueue, (neighbourLevel, neighbour))
+
+    return np.array(levels, dtype=np.float64), tileOffsets
+
+
+def tileRaise(filledFile, labelFile, tileLevels, outputFile):
+
+    '''
+    Pass 2: raises the cells of the filled tile to the level of their watershed. tileLevels gives the level of each
+    of the tile's labels. Saves the result as outputFile.
+    '''
+
+    filled = np.load(filledFile)
+    labels = np.load(labelFile)
+
+    labelled = labels >= 0
+    raised = tileLevels[labels[labelled]]
+    filled[labelled] = np.maximum(filled[labelled], raised).astype(np.float32)
+    del labels, raised
+
+    np.save(outputFile, filled)
+    os.remove(filledFile)
+    os.remove(labelFile)
+
+    return outputFile
+
+
+def fill(demSource, scratchFolder, tileSize=tiled_accumulation.defaultTileSize, processes=None):
+
+    '''
+    Fills the depressions in the DEM read from demSource (NoData as NaN) in tiles.
+    Returns a list of (row start, row end, column start, column end, filled .npy file), one per tile, with the
+    files saved in scratchFolder. The result is the same as priority_flood.fill with an epsilon of 0.
+    '''
+
+    tileList = tiled_accumulation.tiles(demSource.rows, demSource.cols, tileSize)
+    names = [os.path.join(scratchFolder, 'fillTile_' + str(tile[0]) + '_' + str(tile[2])) for tile in tileList]
+
+    floodResults = worker.mapInPool(tileFlood, [(demSource, tile, name + '_flood.npy', name + '_labels.npy')
+                                                for tile, name in zip(tileList, names)], processes)
+    levels, tileOffsets = spillLevels(floodResults)
+
+    jobs = []
+    for result, tileOffset, name in zip(floodResults, tileOffsets, names):
+        tileLevels = levels[tileOffset:tileOffset + result[0]].copy()
+        tileLevels[0] = -np.inf
+        jobs.append((name + '_flood.npy', name + '_labels.npy', tileLevels, name + '.npy'))
+    del floodResults
+
+    tileFiles = worker.mapInPool(tileRaise, jobs, processes)
+
+    return [tile + (tileFile,) for tile, tileFile in zip(tileList, tileFiles)]
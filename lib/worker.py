@@ -0,0 +1,181 @@
+'''
+worker.py runs a function in a separate worker process, so that long running geoprocessing (e.g. watershed
+delineation) can run at the same time as other work in the tool, and runs batches of jobs (e.g. raster tiles)
+in a pool of worker processes with mapInPool.
+
+Functions run by a worker must be defined at module level, and their arguments and return value must be picklable
+(e.g. file paths, numbers, strings, lists and tuples rather than arcpy geometry or raster objects).
+
+If the worker process cannot be started, or exits without returning a result (e.g. because multiprocessing is not
+usable from the host application), the function is run in this process when its result is requested, so the tool
+produces the same outputs either way.
+'''
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+
+import NB_EE.lib.log as log
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log])
+
+
+def pythonExecutable():
+
+    '''
+    ArcMap and ArcGIS Pro run Python embedded in the application, so sys.executable is the application (e.g. ArcMap.exe)
+    rather than python.exe. Worker processes need to be started with python.exe.
+    '''
+
+    executable = sys.executable
+    if executable and os.path.basename(executable).lower().startswith('python'):
+        return executable
+
+    for folder in [sys.exec_prefix, os.path.dirname(executable or '')]:
+        for name in ['python.exe', 'python']:
+            candidate = os.path.join(folder, name)
+            if os.path.isfile(candidate):
+                return candidate
+
+    return None
+
+
+def inWorkerProcess():
+
+    ''' True when called in a worker process, rather than in the tool's own process (e.g. when a WorkerTask falls back) '''
+
+    return multiprocessing.current_process().name != 'MainProcess'
+
+
+def runInWorker(conn, func, args):
+
+    ''' Entry point of the worker process. Sends ('ok', result) or ('error', traceback) back to the parent. '''
+
+    try:
+        result = func(*args)
+        conn.send(('ok', result))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class WorkerTask:
+
+    '''
+    A function call running in a worker process. Call result() to wait for it to finish and return its result.
+    Errors raised by the function in the worker are raised as RuntimeError in the calling process.
+    '''
+
+    def __init__(self, name, func, args):
+
+        self.name = name
+        self.func = func
+        self.args = args
+        self.process = None
+        self.conn = None
+        self.startTime = time.time()
+
+        executable = pythonExecutable()
+
+        try:
+            if executable is None:
+                raise RuntimeError('Python executable not found')
+
+            multiprocessing.set_executable(executable)
+
+            self.conn, childConn = multiprocessing.Pipe(False)
+            self.process = multiprocessing.Process(target=runInWorker, args=(childConn, func, args))
+            self.process.daemon = True
+            self.process.start()
+
+            # The parent only receives. Closing its copy of the sending end means recv() fails if the worker dies.
+            childConn.close()
+            log.info('Started ' + name + ' in worker process')
+
+        except Exception:
+            log.warning('Could not start worker process for ' + name + '. It will be run after the other processing.')
+            self.process = None
+            self.conn = None
+
+    def result(self):
+
+        if self.process is None:
+            log.info('Running ' + self.name)
+            return self.func(*self.args)
+
+        try:
+            status, value = self.conn.recv()
+        except (EOFError, IOError):
+            status, value = None, None
+        finally:
+            self.conn.close()
+            self.process.join()
+            self.process = None
+
+        if status == 'ok':
+            log.info(self.name + ' finished in worker process (' + str(round(time.time() - self.startTime, 1)) + ' seconds)')
+            return value
+
+        elif status == 'error':
+            raise RuntimeError(self.name + ' failed in worker process:\n' + value)
+
+        else:
+            log.warning('Worker process for ' + self.name + ' exited without a result. Running it in this process.')
+            return self.func(*self.args)
+
+    def terminate(self):
+
+        ''' Stops the worker process, e.g. if the tool fails before the result is needed '''
+
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+
+def runJob(job):
+
+    ''' Runs one job (func, args) of mapInPool in a pool worker '''
+
+    func, args = job
+    return func(*args)
+
+
+def mapInPool(func, argsList, processes=None):
+
+    '''
+    Calls func(*args) for each args in argsList in a pool of worker processes, returning the results in order.
+    processes defaults to one less than the number of CPUs. If processes is 1, or the pool cannot be started,
+    the calls are made in this process.
+    '''
+
+    if processes is None:
+        processes = max(1, multiprocessing.cpu_count() - 1)
+
+    processes = min(processes, len(argsList))
+    jobs = [(func, args) for args in argsList]
+
+    if processes > 1:
+        executable = pythonExecutable()
+
+        try:
+            if executable is None:
+                raise RuntimeError('Python executable not found')
+
+            multiprocessing.set_executable(executable)
+            pool = multiprocessing.Pool(processes)
+
+        except Exception:
+            log.warning('Could not start worker pool. Jobs will be run in this process.')
+
+        else:
+            try:
+                return pool.map(runJob, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+    return [runJob(job) for job in jobs]
@@ -1,204 +1,621 @@
 import arcpy
-from arcpy.sa import Watershed, SnapPourPoint, Reclassify, RemapRange
+from arcpy.sa import Watershed, SnapPourPoint
 import os
 import NB_EE.lib.log as log
 import NB_EE.lib.common as common
 import NB_EE.lib.assign_stream_network_id as assign_stream_network_id
+import NB_EE.lib.stream_topology as stream_topology
+import NB_EE.lib.instrumentation as instrumentation
+import NB_EE.lib.worker as worker
+import NB_EE.lib.raster_store as raster_store
 
 from NB_EE.lib.refresh_modules import refresh_modules
-refresh_modules([log, common, assign_stream_network_id])
+refresh_modules([log, common, assign_stream_network_id, stream_topology, instrumentation, worker, raster_store])
 
-def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
+
+class StreamSeg:
+
+    def __init__(self, ID, fromNode, toNode, shape, fromNodePoint, toNodePoint, streamNetworkID=None):
+        self.ID = ID
+        self.fromNode = fromNode
+        self.toNode = toNode
+        self.shape = shape
+        self.fromNodePoint = fromNodePoint
+        self.toNodePoint = toNodePoint
+        self.streamNetworkID = streamNetworkID
+
+
+class StreamNetwork:
+
+    def __init__(self, ID, soloNodes=[], startNodes=[], lastStreamSeg=None, lastNode=None, lastNodePoint=None, lastNodeSeg=None):
+        self.ID = ID
+        self.soloNodes = soloNodes
+        self.startNodes = startNodes
+        self.lastStreamSeg = lastStreamSeg
+        self.lastNode = lastNode
+        self.lastNodePoint = lastNodePoint
+        self.lastNodeSeg = lastNodeSeg
+
+
+class StraightLineSeg:
+
+    def __init__(self, StreamSegID, polyline, intersectingPoints=[]):
+        self.StreamSegID = StreamSegID
+        self.polyline = polyline
+        self.intersectingPoints = intersectingPoints
+
+
+class NodeAndSegmentPair:
+
+    def __init__(self, node, segmentId):
+        self.node = node
+        self.segmentId = segmentId
+
+
+class IntersectingPoint:
+
+    def __init__(self, pointID, streamSeg, streamNetworkID, pointCoords, pointType, pointFAC):
+        self.pointID = pointID
+        self.streamSeg = streamSeg
+        self.streamNetworkID = streamNetworkID
+        self.pointCoords = pointCoords
+        self.pointType = pointType
+        self.pointFAC = pointFAC
+
+
+class IntersectingPointIndex:
 
     '''
-    Find stream end points which lie on the boundary of the study area mask.
-    The watersheds for each point are also calculated if wanted.
+    Index of intersecting points by stream segment ID and by stream network ID.
+
+    Points are added as they are created, and the lists in the index are sorted by pointFAC (lowest first) once, when
+    they are first queried after points have been added, so max exit and per-network queries only look at the points
+    on one segment or network.
+    Point types are read from the points themselves, so they can be assigned or changed after the points are indexed.
     '''
 
-    class StreamSeg:
+    def __init__(self):
+        self.points = {}
+        self.bySegment = {}
+        self.byNetwork = {}
+        self.allPoints = []
+        self.isSorted = True
 
-        def __init__(self, ID, fromNode, toNode, shape, fromNodePoint, toNodePoint, streamNetworkID=None):
-            self.ID = ID
-            self.fromNode = fromNode
-            self.toNode = toNode
-            self.shape = shape
-            self.fromNodePoint = fromNodePoint
-            self.toNodePoint = toNodePoint
-            self.streamNetworkID = streamNetworkID
+    def add(self, point):
 
+        self.points[point.pointID] = point
 
-    class StreamNetwork:
+        key = (point.pointFAC, point.pointID)
+        self.bySegment.setdefault(point.streamSeg, []).append(key)
+        self.byNetwork.setdefault(point.streamNetworkID, []).append(key)
+        self.allPoints.append(key)
+        self.isSorted = False
 
-        def __init__(self, ID, soloNodes=[], startNodes=[], lastStreamSeg=None, lastNode=None, lastNodePoint=None, lastNodeSeg=None):
-            self.ID = ID
-            self.soloNodes = soloNodes
-            self.startNodes = startNodes
-            self.lastStreamSeg = lastStreamSeg
-            self.lastNode = lastNode
-            self.lastNodePoint = lastNodePoint
-            self.lastNodeSeg = lastNodeSeg
+    def sortLists(self):
 
+        if self.isSorted:
+            return
 
-    class StraightLineSeg:
+        for keys in list(self.bySegment.values()) + list(self.byNetwork.values()) + [self.allPoints]:
+            keys.sort()
+        self.isSorted = True
 
-        def __init__(self, StreamSegID, polyline, intersectingPoints=[]):
-            self.StreamSegID = StreamSegID
-            self.polyline = polyline
-            self.intersectingPoints = intersectingPoints
+    def pointsFromKeys(self, keys, pointType=None):
 
+        points = [self.points[pointID] for pointFAC, pointID in keys]
+        if pointType is not None:
+            points = [pt for pt in points if pt.pointType == pointType]
 
-    class NodeAndSegmentPair:
+        return points
 
-        def __init__(self, node, segmentId):
-            self.node = node
-            self.segmentId = segmentId
+    def pointsOnSegment(self, streamSegID, pointType=None):
 
+        ''' Points on the stream segment, in increasing pointFAC order '''
+        self.sortLists()
+        return self.pointsFromKeys(self.bySegment.get(streamSegID, []), pointType)
 
-    class IntersectingPoint:
+    def pointsInNetwork(self, streamNetworkID, pointType=None):
 
-        def __init__(self, pointID, streamSeg, streamNetworkID, pointCoords, pointType, pointFAC):
-            self.pointID = pointID
-            self.streamSeg = streamSeg
-            self.streamNetworkID = streamNetworkID
-            self.pointCoords = pointCoords
-            self.pointType = pointType
-            self.pointFAC = pointFAC
+        ''' Points on the stream network, in increasing pointFAC order '''
+        self.sortLists()
+        return self.pointsFromKeys(self.byNetwork.get(streamNetworkID, []), pointType)
 
+    def allPointsByFAC(self, pointType=None):
 
-    def getMaxValueFromCellAndSurrounds(pointX, pointY, cellSize, cellSizeUnits, spatRef, raster):
+        self.sortLists()
+        return self.pointsFromKeys(self.allPoints, pointType)
 
-        ''' Find maximum raster value at this point and also the 8 cells surrounding it '''
-        maxValueAtPoint = 0
+    def networkIDs(self):
 
-        for xMultiplier in range(-1, 2):
-            for yMultiplier in range(-1, 2):
+        return sorted(self.byNetwork.keys())
 
-                shiftedX = pointX + (cellSize * xMultiplier)
-                shiftedY = pointY + (cellSize * yMultiplier)
-                shiftedXY = str(shiftedX) + " " + str(shiftedY)
-                rasterValueAtPoint = arcpy.GetCellValue_management(raster, shiftedXY).getOutput(0)
+    def maxExitPoint(self, streamNetworkID=None):
 
-                if xMultiplier == 0 and yMultiplier == 0:
-                    valueAtExactPoint = rasterValueAtPoint
+        '''
+        Exit point with the highest flow accumulation on the stream network (or over all networks if no ID is given).
+        Ties go to the point with the lowest ID. Returns None if there are no exit points.
+        '''
 
-                if rasterValueAtPoint != 'NoData':
-                    rasterValueAtPoint = float(rasterValueAtPoint)
-                    if rasterValueAtPoint > maxValueAtPoint:
-                        maxValueAtPoint = rasterValueAtPoint
+        if streamNetworkID is None:
+            exitPoints = self.allPointsByFAC('Exit')
+        else:
+            exitPoints = self.pointsInNetwork(streamNetworkID, 'Exit')
 
-        polyBuffer = os.path.join(arcpy.env.scratchGDB, "polyBuffer")
+        if len(exitPoints) == 0:
+            return None
 
-        # If value of exact point is NoData, then the point may lie exactly on the boundary of two raster cells,
-        # which leads to spurious results from above calcs. Hence, we use a buffer around the point instead.
-        if valueAtExactPoint == 'NoData':
+        maxFAC = exitPoints[-1].pointFAC
+        for pt in exitPoints:
+            if pt.pointFAC == maxFAC:
+                return pt
 
-            # Create buffer around point
-            if arcpy.ProductInfo() == "ArcServer":
-                pointFC = os.path.join(arcpy.env.scratchGDB, "pointFC")
-                arcpy.CreateFeatureclass_management(arcpy.env.scratchGDB, "pointFC", 'POINT', spatial_reference=spatRef)
-            else:
-                pointFC = "in_memory/pointFC"
-                arcpy.CreateFeatureclass_management("in_memory", "pointFC", 'POINT', spatial_reference=spatRef)
 
-            # Add a zone field
-            arcpy.AddField_management(pointFC, "ZONE", "SHORT")
+def readIntersectingPointIndex(entryExitPoints):
+
+    '''
+    Builds an IntersectingPointIndex from an entry/exit points feature class written by this module,
+    so post-processing scripts can query the points without re-scanning the output.
+    '''
+
+    pointIndex = IntersectingPointIndex()
+    with arcpy.da.SearchCursor(entryExitPoints, ["POINT_NO", "SEGMENT_ID", "STREAM_NO", "SHAPE@XY", "POINT_TYPE", "POINT_FAC"]) as searchCursor:
+
+        for row in searchCursor:
+            pointIndex.add(IntersectingPoint(row[0], row[1], row[2], row[3], row[4], row[5]))
+
+    return pointIndex
+
+
+def getMaxValueFromCellAndSurrounds(pointX, pointY, cellSize, cellSizeUnits, spatRef, raster, zonalStats):
+
+    ''' Find maximum raster value at this point and also the 8 cells surrounding it '''
+    maxValueAtPoint = 0
+
+    for xMultiplier in range(-1, 2):
+        for yMultiplier in range(-1, 2):
+
+            shiftedX = pointX + (cellSize * xMultiplier)
+            shiftedY = pointY + (cellSize * yMultiplier)
+            rasterValueAtPoint = raster_store.getCellValue(raster, shiftedX, shiftedY)
+
+            if xMultiplier == 0 and yMultiplier == 0:
+                valueAtExactPoint = rasterValueAtPoint
+
+            if rasterValueAtPoint != 'NoData':
+                rasterValueAtPoint = float(rasterValueAtPoint)
+                if rasterValueAtPoint > maxValueAtPoint:
+                    maxValueAtPoint = rasterValueAtPoint
+
+    polyBuffer = os.path.join(arcpy.env.scratchGDB, "polyBuffer")
+
+    # If value of exact point is NoData, then the point may lie exactly on the boundary of two raster cells,
+    # which leads to spurious results from above calcs. Hence, we use a buffer around the point instead.
+    if valueAtExactPoint == 'NoData':
+
+        # Create buffer around point
+        if arcpy.ProductInfo() == "ArcServer":
+            pointFC = os.path.join(arcpy.env.scratchGDB, "pointFC")
+            arcpy.CreateFeatureclass_management(arcpy.env.scratchGDB, "pointFC", 'POINT', spatial_reference=spatRef)
+        else:
+            pointFC = "in_memory/pointFC"
+            arcpy.CreateFeatureclass_management("in_memory", "pointFC", 'POINT', spatial_reference=spatRef)
+
+        # Add a zone field
+        arcpy.AddField_management(pointFC, "ZONE", "SHORT")
+
+        # Write point to a feature class
+        insertCursor = arcpy.da.InsertCursor(pointFC, ["SHAPE@X", "SHAPE@Y", "ZONE"])
+        row = (pointX, pointY, 0)
+        insertCursor.insertRow(row)
+        del insertCursor
+
+        # Buffer the point by the cellsize
+        arcpy.Buffer_analysis(pointFC, polyBuffer, str(cellSize * 1.5) + " " + cellSizeUnits)
+
+        # Reset mask and extent environment variables as they can produce errors that made Zonal Stats fail
+        arcpy.ClearEnvironment("extent")
+        arcpy.ClearEnvironment("mask")
+
+        outZonalStats = arcpy.sa.ZonalStatistics(polyBuffer, "ZONE", raster, "MAXIMUM", "DATA")
+        outZonalStats.save(zonalStats)
+        arcpy.CalculateStatistics_management(zonalStats)
+        maxValueAtPoint = arcpy.GetRasterProperties_management(zonalStats, "MAXIMUM").getOutput(0)
+
+        if maxValueAtPoint == 'NoData':
+            maxValueAtPoint = 0
+        else:
+            maxValueAtPoint = int(maxValueAtPoint)
+
+        arcpy.Delete_management(pointFC)
+        arcpy.Delete_management(polyBuffer)
+        instrumentation.count('scratch datasets created', 3)
+
+    return maxValueAtPoint
+
+
+def polygonToPolyline(polygon, polyline):
+
+    '''
+    Converts a polygon to a polyline.
+    Used when advanced licence (and hence PolygonToLine_management tool) is not available.
+    '''
+
+    featuresList = []
+    # Loop through each feature to fetch coordinates
+    for row in arcpy.da.SearchCursor(polygon, ["SHAPE@"]):
+
+        featurePartsList = []
+        # Step through each part of the feature
+        for part in row[0]:
+
+            featurePointsList = []
+            # Step through each vertex in the feature
+            for pnt in part:
+
+                if pnt:
+                    # Add x,y coordinates of current point to feature list
+                    featurePointsList.append([pnt.X, pnt.Y])
+
+            featurePartsList.append(featurePointsList)
+
+        featuresList.append(featurePartsList)
+
+    # Create Polylines
+    features = []
+    for feature in featuresList:
+
+        # Create a Polyline object based on the array of points
+        # Append to the list of Polyline objects
+        for part in feature:
+            features.append(
+                arcpy.Polyline(
+                    arcpy.Array([arcpy.Point(*coords) for coords in part])))
+
+    # Persist a copy of the Polyline objects using CopyFeatures
+    arcpy.CopyFeatures_management(features, polyline)
+
+    # Set the Polyline's spatial reference
+    spatialRef = arcpy.Describe(polygon).spatialReference
+    if spatialRef is not None:
+        arcpy.DefineProjection_management(polyline, spatialRef)
+
+
+def pointWithinPolygonFC(point, polygonFC):
+
+    '''Determine if point is within polygon feature class'''
+
+    spatialRef = arcpy.Describe(polygonFC).spatialReference
+    pointGeom = arcpy.PointGeometry(point, spatialRef)
 
-            # Write point to a feature class
-            insertCursor = arcpy.da.InsertCursor(pointFC, ["SHAPE@X", "SHAPE@Y", "ZONE"])
-            row = (pointX, pointY, 0)
-            insertCursor.insertRow(row)
-            del insertCursor
+    inside = False
+    with arcpy.da.SearchCursor(polygonFC, ["SHAPE@"]) as searchCursor:
 
-            # Buffer the point by the cellsize
-            arcpy.Buffer_analysis(pointFC, polyBuffer, str(cellSize * 1.5) + " " + cellSizeUnits)
+        for poly in searchCursor:
+            polygonGeom = poly[0]
+            instrumentation.count('cursor rows')
 
-            # Reset mask and extent environment variables as they can produce errors that made Zonal Stats fail
-            arcpy.ClearEnvironment("extent")
-            arcpy.ClearEnvironment("mask")
+            # Check if the point lies within the polygon
+            if not inside:
+                inside = pointGeom.within(polygonGeom)
 
-            outZonalStats = arcpy.sa.ZonalStatistics(polyBuffer, "ZONE", raster, "MAXIMUM", "DATA")
-            outZonalStats.save(zonalStats)
-            arcpy.CalculateStatistics_management(zonalStats)
-            maxValueAtPoint = arcpy.GetRasterProperties_management(zonalStats, "MAXIMUM").getOutput(0)
+    instrumentation.count('point in polygon tests')
 
-            if maxValueAtPoint == 'NoData':
-                maxValueAtPoint = 0
+    return inside
+
+
+def loadStreamSegments(streams, streamsCopy, studyAreaMask):
+
+    '''
+    Copies the streams to streamsCopy, removes the segments which are not needed and gives the remaining
+    segments a SEGMENT_ID. Returns the list of StreamSeg objects, indexed by SEGMENT_ID.
+
+    The node counts, segment envelopes and network IDs come from the stream topology, which is read from the
+    sidecar file next to the streams if it is up to date (see stream_topology.py), so they are only built once.
+    The segments are returned with their stream network IDs already assigned.
+    '''
+
+    # Get the topology of the streams (cached between runs)
+    topology = stream_topology.getTopology(streams, "FROM_NODE", "TO_NODE")
+    nodeCounts = topology.nodeCounts
+    fromIndex = topology.fromIndex
+    toIndex = topology.toIndex
+    envelopes = topology.envelopes
+
+    # Make a copy of streams file as it will be amended
+    with instrumentation.phase('copy'):
+        arcpy.CopyFeatures_management(streams, streamsCopy)
+        instrumentation.count('scratch datasets created')
+
+    # The copy has the same features in the same order as the streams
+    if int(arcpy.GetCount_management(streamsCopy).getOutput(0)) != topology.numSegments:
+        raise RuntimeError('Stream topology does not match the stream network ' + str(streams))
+
+    maskExtent = arcpy.Describe(studyAreaMask).extent
+
+    # Populate stream segments list, so can access quicker and easier than using search cursors
+    streamSegments = []
+    streamSegID = 0
+    networkIDLookup = {}
+    arcpy.AddField_management(streamsCopy, "SEGMENT_ID", "LONG")
+
+    with instrumentation.phase('filter'):
+        with arcpy.da.UpdateCursor(streamsCopy, ["FROM_NODE", "TO_NODE", "SHAPE@", "SEGMENT_ID"]) as updateCursor:
+
+            for i, row in enumerate(updateCursor):
+
+                fromNode = int(row[0])
+                toNode = int(row[1])
+                shape = row[2]
+                fromNodePoint = shape.firstPoint
+                toNodePoint = shape.lastPoint
+
+                # Segments whose envelope misses the mask extent cannot have an end point within the mask
+                env = envelopes[i]
+                overlapsMask = not (env[2] < maskExtent.XMin or env[0] > maskExtent.XMax
+                                 or env[3] < maskExtent.YMin or env[1] > maskExtent.YMax)
+
+                # Include stream segments which have both end points within the study area mask boundary
+                # Also include stream segment is not connected to any other stream segments
+                if (nodeCounts[fromIndex[i]] > 1
+                 or nodeCounts[toIndex[i]] > 1
+                 or (overlapsMask and pointWithinPolygonFC(fromNodePoint, studyAreaMask))
+                 or (overlapsMask and pointWithinPolygonFC(toNodePoint, studyAreaMask))):
+
+                    # Only single, unconnected segments are removed, so the networks are unchanged apart from
+                    # their numbering. Renumber them consecutively in order of first appearance.
+                    cachedNetworkID = int(topology.networkIDs[i])
+                    if cachedNetworkID not in networkIDLookup:
+                        networkIDLookup[cachedNetworkID] = len(networkIDLookup) + 1
+
+                    row[3] = streamSegID
+                    streamSegments.append(StreamSeg(streamSegID, fromNode, toNode, shape, fromNodePoint, toNodePoint, networkIDLookup[cachedNetworkID]))
+                    streamSegID += 1
+                    updateCursor.updateRow(row)
+
+                else:
+                    updateCursor.deleteRow()
+
+        instrumentation.count('cursor rows', topology.numSegments)
+        instrumentation.count('segments', len(streamSegments))
+
+    return streamSegments
+
+
+def createStraightLineSegments(streamSegments):
+
+    # Break up each of the segments in the streamSegments list into its straight line components.
+    # Store these straight line segments in straightLineSegments list.
+    straightLineSegments = []
+    for streamSeg in streamSegments:
+
+        shape = streamSeg.shape
+
+        # Step through each part of the feature
+        for part in shape:
+
+            prevX = None
+            prevY = None
+
+            # Step through each vertex in the feature
+            for pnt in part:
+                if pnt:
+                    if prevX:
+                        array = arcpy.Array([arcpy.Point(prevX, prevY), arcpy.Point(pnt.X, pnt.Y)])
+                        polyline = arcpy.Polyline(array)
+                        straightLineSegments.append(StraightLineSeg(streamSeg.ID, polyline))
+
+                    prevX = pnt.X
+                    prevY = pnt.Y
+                else:
+                    # If pnt is None, this represents an interior ring
+                    log.info("Interior Ring:")
+
+    instrumentation.count('vertex pairs', len(straightLineSegments))
+
+    return straightLineSegments
+
+
+def findTerminalNodesForStreamNetworks(streamSegments, maxStreamNetworkID):
+
+    # Find start and end (solo) nodes for each stream network
+    # The solo nodes only appear once (hence solo)
+    streamNetworks = []
+    for i in range(1, maxStreamNetworkID + 1):
+
+        soloNodes = []
+        manyNodes = []
+
+        for streamSeg in streamSegments:
+            if streamSeg.streamNetworkID == i:
+
+                nodePair = [streamSeg.fromNode, streamSeg.toNode]
+
+                # Add the node to soloNodes or manyNodes lists. It can only be in one of these lists.
+                for node in nodePair:
+
+                    # Find if node is in soloNodes list
+                    inSoloNodes = False
+                    for nodeSeg in soloNodes:
+                        if nodeSeg.node == node:
+                            soloNodesIndex = soloNodes.index(nodeSeg)
+                            inSoloNodes = True
+
+                    inManyNodes = node in manyNodes
+
+                    if inSoloNodes:
+                        # Remove node from list
+                        del soloNodes[soloNodesIndex]
+
+                        # Add node to manyNodes
+                        manyNodes.append(node)
+
+                    if not inSoloNodes and not inManyNodes:
+                        soloNodes.append(NodeAndSegmentPair(node, streamSeg.ID))
+
+        streamNetworks.append(StreamNetwork(i, soloNodes))
+
+    return streamNetworks
+
+
+def findStreamNetworkOutlets(streamNetworks, streamSegments, cellSize, cellSizeUnits, spatialRef, hydFAC, zonalStats):
+
+    ''' Find last stream segment and node of each stream network (i.e. towards end of stream) '''
+
+    for streamNetwork in streamNetworks:
+
+        maxFAC = 0
+        for nodeSeg in streamNetwork.soloNodes:
+
+            node = nodeSeg.node
+            segID = nodeSeg.segmentId
+
+            # Find the node's point
+            if streamSegments[segID].fromNode == node:
+                point = streamSegments[segID].fromNodePoint
             else:
-                maxValueAtPoint = int(maxValueAtPoint)
+                point = streamSegments[segID].toNodePoint
 
-            arcpy.Delete_management(pointFC)
-            arcpy.Delete_management(polyBuffer)
+            # Find the flow accumulation at this point
+            maxFlowAccAtPoint = getMaxValueFromCellAndSurrounds(point.X, point.Y, cellSize, cellSizeUnits, spatialRef, hydFAC, zonalStats)
 
-        return maxValueAtPoint
+            if maxFlowAccAtPoint >= maxFAC:
+                maxFAC = maxFlowAccAtPoint
+                maxFACStreamSegID = segID
+                maxFACNode = node
+                maxFACPoint = point
+                maxFACNodeSeg = nodeSeg
 
+        streamNetwork.lastStreamSeg = maxFACStreamSegID
+        streamNetwork.lastNode = maxFACNode
+        streamNetwork.lastNodePoint = maxFACPoint
+        streamNetwork.lastNodeSeg = maxFACNodeSeg
 
-    def polygonToPolyline(polygon, polyline):
+    return streamNetworks
 
-        '''
-        Converts a polygon to a polyline.
-        Used when advanced licence (and hence PolygonToLine_management tool) is not available.
-        '''
 
-        featuresList = []
-        # Loop through each feature to fetch coordinates
-        for row in arcpy.da.SearchCursor(polygon, ["SHAPE@"]):
+def streamNetworkOutletPoints(streamNetworks):
+
+    ''' (X, Y, STREAM_NO) of the last node of each stream network '''
 
-            featurePartsList = []
-            # Step through each part of the feature
-            for part in row[0]:
+    return [(stream.lastNodePoint.X, stream.lastNodePoint.Y, stream.ID) for stream in streamNetworks]
 
-                featurePointsList = []
-                # Step through each vertex in the feature
-                for pnt in part:
 
-                    if pnt:
-                        # Add x,y coordinates of current point to feature list
-                        featurePointsList.append([pnt.X, pnt.Y])
+def createWatersheds(outletPoints, hydFAC, hydFDR, cellSize, spatialRef, prefix, watershedsFC):
 
-                featurePartsList.append(featurePointsList)
+    ''' Delineate the watershed draining to each outlet point (X, Y, STREAM_NO) '''
 
-            featuresList.append(featurePartsList)
+    streamEnds = os.path.join(arcpy.env.scratchWorkspace, prefix + "streamEnds")
+    watershedsPoly = prefix + "watershedsPoly"
 
-        # Create Polylines
-        features = []
-        for feature in featuresList:
+    # Create stream ends feature class
+    arcpy.CreateFeatureclass_management(os.path.dirname(streamEnds), os.path.basename(streamEnds), 'POINT', spatial_reference=spatialRef)
 
-            # Create a Polyline object based on the array of points
-            # Append to the list of Polyline objects
-            for part in feature:
-                features.append(
-                    arcpy.Polyline(
-                        arcpy.Array([arcpy.Point(*coords) for coords in part])))
+    # Add stream no field
+    arcpy.AddField_management(streamEnds, "STREAM_NO", "LONG")
 
-        # Persist a copy of the Polyline objects using CopyFeatures
-        arcpy.CopyFeatures_management(features, polyline)
-        
-        # Set the Polyline's spatial reference
-        spatialRef = arcpy.Describe(polygon).spatialReference
-        if spatialRef is not None:
-            arcpy.DefineProjection_management(polyline, spatialRef)
+    # Write stream end points to a feature class (used when calculating the watersheds)
+    insertCursor = arcpy.da.InsertCursor(streamEnds, ["SHAPE@X", "SHAPE@Y", "STREAM_NO"])
+    for point in outletPoints:
+        insertCursor.insertRow((point))
+    del insertCursor
 
+    log.info("Determining watershed for each of the streams in the stream network")
 
-    def pointWithinPolygonFC(point, polygonFC):
+    # Snap pour points (stream ends) to surrounding cell with highest flow accumulation
+    pourPoints = SnapPourPoint(streamEnds, hydFAC, cellSize * 1.5, "STREAM_NO")
 
-        '''Determine if point is within polygon feature class'''
+    # Calculate watersheds from pour points
+    watersheds = Watershed(hydFDR, pourPoints)
 
-        spatialRef = arcpy.Describe(polygonFC).spatialReference
-        pointGeom = arcpy.PointGeometry(point, spatialRef)
+    # Convert watersheds raster to feature class
+    arcpy.RasterToPolygon_conversion(watersheds, watershedsPoly, "NO_SIMPLIFY")
 
-        inside = False
-        with arcpy.da.SearchCursor(polygonFC, ["SHAPE@"]) as searchCursor:
+    # 'Rename' gridcode column to STREAM_NO
+    arcpy.AddField_management(watershedsPoly, "STREAM_NO", "LONG")
+    with arcpy.da.UpdateCursor(watershedsPoly, ["gridcode", "STREAM_NO"]) as updateCursor:
+        for row in updateCursor:
+            row[1] = row[0]
+            updateCursor.updateRow(row)
 
-            for poly in searchCursor:
-                polygonGeom = poly[0]
+    arcpy.DeleteField_management(watershedsPoly, "gridcode")
 
-                # Check if the point lies within the polygon
-                if not inside:
-                    inside = pointGeom.within(polygonGeom)
+    # Dissolve watersheds poly
+    arcpy.Dissolve_management(watershedsPoly, watershedsFC, "STREAM_NO")
 
-        return inside
+    return watershedsFC
 
 
+def createWatershedsInWorker(outletPoints, hydFAC, hydFDR, cellSize, spatialRefString, scratchFolder, watershedsFC):
+
+    '''
+    Runs createWatersheds in a worker process. The worker has its own scratch geodatabase,
+    so that it does not lock datasets used by the main process.
+    '''
+
+    # A worker process starts without the tool's licences. In the tool's own process, Spatial Analyst is already
+    # checked out (common.runSystemChecks).
+    if worker.inWorkerProcess():
+        if arcpy.CheckExtension("Spatial") == "Available":
+            arcpy.CheckOutExtension("Spatial")
+        else:
+            raise RuntimeError("Spatial Analyst license not present or could not be checked out")
+
+    workerGDB = os.path.join(scratchFolder, "watershedsWorker.gdb")
+    if not arcpy.Exists(workerGDB):
+        arcpy.CreateFileGDB_management(scratchFolder, os.path.basename(workerGDB))
+
+    # Restore the environment afterwards, in case this is run in the main process
+    oldScratchWorkspace = arcpy.env.scratchWorkspace
+    oldWorkspace = arcpy.env.workspace
+    oldOverwriteOutput = arcpy.env.overwriteOutput
+
+    try:
+        arcpy.env.overwriteOutput = True
+        arcpy.env.scratchWorkspace = workerGDB
+        arcpy.env.workspace = workerGDB
+
+        spatialRef = arcpy.SpatialReference()
+        spatialRef.loadFromString(spatialRefString)
+
+        prefix = os.path.join(workerGDB, "exit_")
+
+        return createWatersheds(outletPoints, hydFAC, hydFDR, cellSize, spatialRef, prefix, watershedsFC)
+
+    finally:
+        arcpy.env.scratchWorkspace = oldScratchWorkspace
+        arcpy.env.workspace = oldWorkspace
+        arcpy.env.overwriteOutput = oldOverwriteOutput
+
+
+def startWatersheds(streamNetworks, hydFAC, hydFDR, cellSize, spatialRef, watershedsFC):
+
+    '''
+    Starts delineating the watersheds of the stream networks in a worker process, once their outlets are known.
+    Returns a worker.WorkerTask; its result() is the watersheds feature class.
+    '''
+
+    outletPoints = streamNetworkOutletPoints(streamNetworks)
+    instrumentation.count('scratch datasets created', 2)
+
+    return worker.WorkerTask('Watershed delineation', createWatershedsInWorker,
+                             (outletPoints, hydFAC, hydFDR, cellSize, spatialRef.exportToString(), arcpy.env.scratchFolder, watershedsFC))
+
+
+def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
+
+    '''
+    Find stream end points which lie on the boundary of the study area mask.
+    The watersheds for each point are also calculated if wanted.
+
+    The work is split into two branches which only share the stream networks:
+
+        streams -> networks -> outlets -> watersheds (worker process)
+        streams -> mask boundary intersection -> sampling -> typing -> removal -> write
+
+    Watershed delineation only needs the FDR, the FAC and the outlet of each network, so it is started in a
+    worker process as soon as the outlets are known, and collected once the entry/exit points have been written.
+    '''
+
     def assignTypesToPoints(straightLineSeg, spatialRef):
 
         '''
@@ -216,11 +633,9 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
         lastPointInside = pointWithinPolygonFC(lastPoint, studyAreaMaskDissolved)
 
         # Find the flow accumulation at each of these points and determine which has the max flow
-        firstXY = str(firstPoint.X) + " " + str(firstPoint.Y)
-        lastXY = str(lastPoint.X) + " " + str(lastPoint.Y)
-
-        firstFAC = arcpy.GetCellValue_management(hydFAC, firstXY).getOutput(0)
-        lastFAC = arcpy.GetCellValue_management(hydFAC, lastXY).getOutput(0)
+        # (from the raster store written by Preprocess DEM, if there is one)
+        firstFAC = raster_store.getCellValue(hydFAC, firstPoint.X, firstPoint.Y)
+        lastFAC = raster_store.getCellValue(hydFAC, lastPoint.X, lastPoint.Y)
         maxFAC = max(firstFAC, lastFAC)
 
         if firstFAC != 'NoData':
@@ -240,7 +655,7 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
             pointCoords = intersectPointsList[pointID].pointCoords
 
             # Check that both points are not inside or outside the polygon.
-            # If they are then the intersecting point is at a vertex 
+            # If they are then the intersecting point is at a vertex
             if firstPointInside and lastPointInside or (not firstPointInside and not lastPointInside):
                 pointType = "Touches" # Unlikely but possible
             else:
@@ -260,14 +675,14 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
                         pointType = "Entry"
                     else:
                         pointType = "Exit"
-            
+
             # Set the point's pointType property
             intersectPointsList[pointID].pointType = pointType
 
         # If two or more intersecting points fall on straight line segment
         elif len(straightLineSeg.intersectingPoints) >= 2:
 
-            log.info('More than one intersecting point on this straight line segment')            
+            log.info('More than one intersecting point on this straight line segment')
 
             # Order points so that point closest to the first point is at the top of the list,
             # and the point furthest from it is at the end of the list.
@@ -290,7 +705,7 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
 
                 # Assign the point type to the intersection point closest to the first point
                 if i == 0:
-                    
+
                     if maxFAC == firstFAC:
                         if firstPointInside:
                             pointType = 'Entry'
@@ -312,111 +727,15 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
 
                 # Set the point's pointType property
                 pointID = orderedPoints[i][0]
-                intersectPointsList[pointID].pointType = pointType    
-
-
-    def createStraightLineSegments(streamSegments):
-
-        # Break up each of the segments in the streamSegments list into its straight line components.
-        # Store these straight line segments in straightLineSegments list.
-        straightLineSegments = []
-        for streamSeg in streamSegments:
-
-            shape = streamSeg.shape
-
-            # Step through each part of the feature
-            for part in shape:
-
-                prevX = None
-                prevY = None
-
-                # Step through each vertex in the feature
-                for pnt in part:
-                    if pnt:
-                        if prevX:
-                            array = arcpy.Array([arcpy.Point(prevX, prevY), arcpy.Point(pnt.X, pnt.Y)])
-                            polyline = arcpy.Polyline(array)
-                            straightLineSegments.append(StraightLineSeg(streamSeg.ID, polyline))
-
-                        prevX = pnt.X
-                        prevY = pnt.Y
-                    else:
-                        # If pnt is None, this represents an interior ring
-                        log.info("Interior Ring:")
-
-        return straightLineSegments
-
-
-    def findTerminalNodesForStreamNetworks(streamSegments):
-
-        # Find start and end (solo) nodes for each stream network
-        # The solo nodes only appear once (hence solo)
-        streamNetworks = []
-        for i in range(1, maxStreamNetworkID + 1):
-
-            soloNodes = []
-            manyNodes = []
-
-            for streamSeg in streamSegments:
-                if streamSeg.streamNetworkID == i:
-
-                    nodePair = [streamSeg.fromNode, streamSeg.toNode]
-
-                    # Add the node to soloNodes or manyNodes lists. It can only be in one of these lists.
-                    for node in nodePair:
-
-                        # Find if node is in soloNodes list
-                        inSoloNodes = False
-                        for nodeSeg in soloNodes:
-                            if nodeSeg.node == node:
-                                soloNodesIndex = soloNodes.index(nodeSeg)
-                                inSoloNodes = True
-
-                        inManyNodes = node in manyNodes
-
-                        if inSoloNodes:
-                            # Remove node from list
-                            del soloNodes[soloNodesIndex]
-
-                            # Add node to manyNodes
-                            manyNodes.append(node)
-
-                        if not inSoloNodes and not inManyNodes:
-                            soloNodes.append(NodeAndSegmentPair(node, streamSeg.ID))
-
-            streamNetworks.append(StreamNetwork(i, soloNodes))
-
-        return streamNetworks
-
-
-    def findFirstEntryPoint(streamSeg):
-
-        entryPointsOnStreamSeg = []
-
-        # Loop through intersecting points, looking for the entry point which lies on this stream segment
-        for id in range(1, len(intersectPointsList)):
-
-            intersectPoint = intersectPointsList[id]
-            if intersectPoint.streamSeg == streamSeg.ID and intersectPoint.pointType == 'Entry':
-                entryPointsOnStreamSeg.append(intersectPoint)
-
-        if len(entryPointsOnStreamSeg) > 0:
-
-            # Sort the entry points so that lowest FAC comes first
-            entryPointsOnStreamSeg.sort(key=lambda x: x.pointFAC)
-            firstEntryPoint = entryPointsOnStreamSeg[0]
-
-        else:
-            log.warning('Could not find first entry point which should exist on stream segment ' + str(streamSeg.ID))
-            firstEntryPoint = None
-
-        return firstEntryPoint
+                intersectPointsList[pointID].pointType = pointType
 
 
     #############################
     ### Main code starts here ###
     #############################
 
+    watershedsTask = None
+
     try:
         # Reset mask and extent environment variables
         arcpy.ClearEnvironment("extent")
@@ -429,7 +748,7 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
 
         # Initialise temporary variables
         prefix = os.path.join(arcpy.env.scratchGDB, "exit_")
-        
+
         studyAreaMaskDissolved = prefix + "studyAreaMaskDissolved"
         streamsCopy = prefix + "streamsCopy"
         intersectPoints = prefix + "intersectPoints"
@@ -440,6 +759,7 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
         # Initialise output variables
         entryExitPoints = os.path.join(outputFolder, 'entryexits.shp')
         streamNetworkFC = os.path.join(outputFolder, 'streamnetwork.shp')
+        watershedsFC = os.path.join(outputFolder, "watersheds.shp")
 
         # Get cell size of raster
         cellSize = float(arcpy.GetRasterProperties_management(hydFAC, "CELLSIZEX").getOutput(0))
@@ -451,60 +771,15 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
         # Find polygon spatial reference
         spatialRefStreams = arcpy.Describe(streams).spatialReference
 
-        # Make a copy of streams file as it will be amended
-        arcpy.CopyFeatures_management(streams, streamsCopy)
-
-        # Create a dictionary, with the index being the stream node number and the value being the number of times
-        # it appears in the feature class
-        nodeCounts = {}
-        with arcpy.da.SearchCursor(streamsCopy, ["FROM_NODE", "TO_NODE"]) as searchCursor:
-
-            for row in searchCursor:
-
-                fromNode = int(row[0])
-                toNode = int(row[1])
-                nodePair = [fromNode, toNode]
-
-                for node in nodePair:
-                    if node in nodeCounts:
-                        nodeCounts[node] += 1
-                    else:
-                        nodeCounts[node] = 1
-
-        # Populate stream segments list, so can access quicker and easier than using search cursors
-        streamSegments = []
-        streamSegID = 0
-        arcpy.AddField_management(streamsCopy, "SEGMENT_ID", "LONG")
-        
-        with arcpy.da.UpdateCursor(streamsCopy, ["FROM_NODE", "TO_NODE", "SHAPE@", "SEGMENT_ID"]) as updateCursor:
-
-            for row in updateCursor:
-
-                fromNode = int(row[0])
-                toNode = int(row[1])
-                shape = row[2]
-                fromNodePoint = shape.firstPoint
-                toNodePoint = shape.lastPoint
-
-                # Include stream segments which have both end points within the study area mask boundary
-                # Also include stream segment is not connected to any other stream segments
-                if (pointWithinPolygonFC(fromNodePoint, studyAreaMask)
-                 or pointWithinPolygonFC(toNodePoint, studyAreaMask)
-                 or nodeCounts[fromNode] > 1
-                 or nodeCounts[toNode] > 1):
-
-                    row[3] = streamSegID
-                    streamSegments.append(StreamSeg(streamSegID, fromNode, toNode, shape, fromNodePoint, toNodePoint))
-                    streamSegID += 1
-                    updateCursor.updateRow(row)
-
-                else:
-                    updateCursor.deleteRow()
+        # Copy the streams and populate stream segments list, so can access quicker and easier than using search cursors
+        streamSegments = loadStreamSegments(streams, streamsCopy, studyAreaMask)
 
         ###################
         ### Exit points ###
         ###################
 
+        instrumentation.startPhase('dissolve')
+
         # Dissolve the study area mask
         arcpy.Dissolve_management(studyAreaMask, studyAreaMaskDissolved)
 
@@ -515,6 +790,9 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
             log.info("Advanced licence not available. Using alternative function to generate boundary line.")
             polygonToPolyline(studyAreaMaskDissolved, boundaryLine)
 
+        instrumentation.count('scratch datasets created', 2)
+        instrumentation.startPhase('intersect')
+
         # Find all points where streams intersect the boundary line. The intersection points are multipoints (i.e. multiple points per line segment)
         arcpy.Intersect_analysis([streamsCopy, boundaryLine], intersectMultiPoints, output_type="POINT")
 
@@ -525,6 +803,10 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
         intPtsCopy = prefix + 'intPtsCopy'
         arcpy.CopyFeatures_management(intersectPoints, intPtsCopy)
 
+        instrumentation.count('scratch datasets created', 3)
+        instrumentation.count('points', noIntersectPoints)
+        instrumentation.endPhase()
+
         ############################################################
         ### Find if intersection points are entry or exit points ###
         ############################################################
@@ -541,6 +823,22 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
         log.info('Creating stream network feature class, with one row per stream')
         streamSegments, maxStreamNetworkID = assign_stream_network_id.function(streamsCopy, streamNetworkFC, "FROM_NODE", "TO_NODE", streamSegments)
 
+        ##########################################
+        ### Start watersheds in worker process ###
+        ##########################################
+
+        instrumentation.startPhase('outlets')
+
+        # Find start and end (solo) nodes for each stream network
+        streamNetworks = findTerminalNodesForStreamNetworks(streamSegments, maxStreamNetworkID)
+
+        # Find last stream segment and node of each stream network (i.e. towards end of stream)
+        findStreamNetworkOutlets(streamNetworks, streamSegments, cellSize, cellSizeUnits, spatialRefStreams, hydFAC, zonalStats)
+
+        # Delineate the watersheds while the entry and exit points are found
+        watershedsTask = startWatersheds(streamNetworks, hydFAC, hydFDR, cellSize, spatialRefStreams, watershedsFC)
+        instrumentation.endPhase()
+
         log.info('Finding intersection points')
 
         if noIntersectPoints == 0:
@@ -549,10 +847,14 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
 
         else:
             log.info('Populate intersection points list')
+            instrumentation.startPhase('sampling')
 
             # Create and populate intersection points list
             # + 1 in the following line as the OBJECTID column in intersectPoints feature class starts at 1. The zeroth index is unused.
             intersectPointsList = [None] * (noIntersectPoints + 1)
+
+            # Index the points by stream segment and stream network as they are created
+            pointIndex = IntersectingPointIndex()
             with arcpy.da.SearchCursor(intersectPoints, ["OBJECTID", "SEGMENT_ID", "SHAPE@XY"]) as searchCursor:
 
                 for pt in searchCursor:
@@ -563,9 +865,13 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
 
                     pointCoordsXY = str(pointCoords[0]) + " " + str(pointCoords[1])
                     streamNetworkID = streamSegments[streamSeg].streamNetworkID
-                    pointFAC = getMaxValueFromCellAndSurrounds(pointCoords[0], pointCoords[1], cellSize, cellSizeUnits, spatialRefStreams, hydFAC)
+                    pointFAC = getMaxValueFromCellAndSurrounds(pointCoords[0], pointCoords[1], cellSize, cellSizeUnits, spatialRefStreams, hydFAC, zonalStats)
 
                     intersectPointsList[pointID] = IntersectingPoint(pointID, streamSeg, streamNetworkID, pointCoords, '', pointFAC)
+                    pointIndex.add(intersectPointsList[pointID])
+
+            instrumentation.count('cursor rows', noIntersectPoints)
+            instrumentation.startPhase('typing')
 
             # Break up polylines into their component straight line segments
             straightLineSegments = createStraightLineSegments(streamSegments)
@@ -581,7 +887,7 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
 
                         pointID = point.pointID
                         streamSegID = point.streamSeg
-                        pointCoords = point.pointCoords                        
+                        pointCoords = point.pointCoords
 
                         if lineSeg.StreamSegID == streamSegID:
 
@@ -591,7 +897,7 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
                             lineSegGeom = lineSeg.polyline
                             if lineSegGeom.contains(intersectPointGeom):
 
-                                # Add intersecting point ID to the 
+                                # Add intersecting point ID to the
                                 lineSeg.intersectingPoints = lineSeg.intersectingPoints + [pointID]
 
                 # Add to list
@@ -604,7 +910,11 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
 
                 # If there are no stream segments with entry/exit points
                 log.warning('No entry/exit points found')
-                return None, streamNetworkFC
+                instrumentation.startPhase('watersheds')
+                watershedsFC = watershedsTask.result()
+                instrumentation.endPhase()
+
+                return None, streamNetworkFC, watershedsFC
 
             else:
                 for straightLineSeg in intersectingStraightLines:
@@ -625,71 +935,16 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
 
             '''
 
-            # First, find the entry and exit points for each stream network
-            streamNetEntryPoints = {}
-            streamNetExitPoints = {}
-
-            for id in range(1, len(intersectPointsList)):
-                pt = intersectPointsList[id]
-
-                if pt.pointType == 'Entry':
-                    if pt.streamNetworkID in streamNetEntryPoints:
-                        streamNetEntryPoints[pt.streamNetworkID].append(pt)
-                    else:
-                        streamNetEntryPoints[pt.streamNetworkID] = [pt]
-
-                if pt.pointType == 'Exit':
-                    if pt.streamNetworkID in streamNetExitPoints:
-                        streamNetExitPoints[pt.streamNetworkID].append(pt)
-                    else:
-                        streamNetExitPoints[pt.streamNetworkID] = [pt]
-            
             # Work out which entry and exit points to keep (as streams may weave along the study area mask boundary).
             # We only want the last exit point and the first entry point on each stream branch.
             pointsToRemove = []
             entryPointsToKeep = []
 
-            # For each stream network, find the exit point with the maximum flow accumulation
-            # Mark all other exit points as points to be removed
-            for streamNetworkID in streamNetExitPoints:
-                maxExitPoint = max(streamNetExitPoints[streamNetworkID], key=lambda item: item.pointFAC)
-
-            # Find start and end (solo) nodes for each stream network
-            streamNetworks = findTerminalNodesForStreamNetworks(streamSegments)
-
-            # Find last stream segment and node of each stream network (i.e. towards end of stream)
-            for streamNetwork in streamNetworks:
-
-                maxFAC = 0
-                for nodeSeg in streamNetwork.soloNodes:
-
-                    node = nodeSeg.node
-                    segID = nodeSeg.segmentId
-
-                    # Find the node's point
-                    if streamSegments[segID].fromNode == node:
-                        point = streamSegments[segID].fromNodePoint
-                    else:
-                        point = streamSegments[segID].toNodePoint
-
-                    # Find the flow accumulation at this point
-                    maxFlowAccAtPoint = getMaxValueFromCellAndSurrounds(point.X, point.Y, cellSize, cellSizeUnits, spatialRefStreams, hydFAC)
-
-                    if maxFlowAccAtPoint >= maxFAC:
-                        maxFAC = maxFlowAccAtPoint
-                        maxFACStreamSegID = segID
-                        maxFACNode = node
-                        maxFACPoint = point
-                        maxFACNodeSeg = nodeSeg
-
-                streamNetwork.lastStreamSeg = maxFACStreamSegID
-                streamNetwork.lastNode = maxFACNode
-                streamNetwork.lastNodePoint = maxFACPoint
-                streamNetwork.lastNodeSeg = maxFACNodeSeg
+            instrumentation.startPhase('removal')
 
             # Populate the entryPointsToKeep array initially with all entry points
-            for streamNetworkID in streamNetEntryPoints:
-                for pt in streamNetEntryPoints[streamNetworkID]:
+            for streamNetworkID in pointIndex.networkIDs():
+                for pt in pointIndex.pointsInNetwork(streamNetworkID, 'Entry'):
                     entryPointsToKeep.append(pt.pointID)
 
             ### Find pairs of entry/exit points that are close together and have similar flow accumulation values ###
@@ -717,30 +972,27 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
                             if distanceBetweenPoints < distanceThresh:
                                 if pt1.pointID not in pointsToRemove:
                                     pointsToRemove.append(pt1.pointID)
-                                                                    
+
                                 if pt2.pointID not in pointsToRemove:
                                     pointsToRemove.append(pt2.pointID)
-                                    
-            # Find the exit point with the maximum FAC. First create list of exit points.
-            exitPointsList = []
-            for id in range(1, len(intersectPointsList)):
-                pt = intersectPointsList[id]
-                if pt.pointType == 'Exit':
-                    exitPointsList.append(pt)
-
-            # Find the point with the maximum overall flow accumulation
-            maxExitPoint = max(exitPointsList, key=lambda item: item.pointFAC)
-            
-            # Update this point with a point type of 'Main exit'
-            intersectPointsList[maxExitPoint.pointID].pointType = 'Main exit'
+
+            # Find the exit point with the maximum overall flow accumulation and update it with a point type of 'Main exit'
+            maxExitPoint = pointIndex.maxExitPoint()
+            if maxExitPoint is not None:
+                maxExitPoint.pointType = 'Main exit'
+                maxExitPointID = maxExitPoint.pointID
+            else:
+                maxExitPointID = None
 
             # Update the intersecting points feature class with the point types, point numbers and stream network numbers.
-            log.info('Update the intersecting points feature class with the point types')            
+            log.info('Update the intersecting points feature class with the point types')
+            instrumentation.startPhase('write')
             arcpy.AddField_management(intersectPoints, "POINT_NO", "LONG")
             arcpy.AddField_management(intersectPoints, "POINT_TYPE", "TEXT")
             arcpy.AddField_management(intersectPoints, "STREAM_NO", "LONG")
+            arcpy.AddField_management(intersectPoints, "POINT_FAC", "DOUBLE")
             pointNo = 1
-            with arcpy.da.UpdateCursor(intersectPoints, ["OBJECTID", "SEGMENT_ID", "SHAPE@XY", "POINT_NO", "POINT_TYPE", "STREAM_NO"]) as updateCursor:
+            with arcpy.da.UpdateCursor(intersectPoints, ["OBJECTID", "SEGMENT_ID", "SHAPE@XY", "POINT_NO", "POINT_TYPE", "STREAM_NO", "POINT_FAC"]) as updateCursor:
 
                 for pt in updateCursor:
                     pointID = pt[0]
@@ -750,13 +1002,14 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
                     pt[3] = pointNo
                     pt[4] = intersectPointsList[pointID].pointType
                     pt[5] = intersectPointsList[pointID].streamNetworkID
+                    pt[6] = intersectPointsList[pointID].pointFAC
 
-                    if pointID in pointsToRemove and pointID != maxExitPoint.pointID:                        
+                    if pointID in pointsToRemove and pointID != maxExitPointID:
                         updateCursor.deleteRow()
                     else:
-                        if intersectPointsList[pointID].pointType == 'Entry' and pointID not in entryPointsToKeep:                            
+                        if intersectPointsList[pointID].pointType == 'Entry' and pointID not in entryPointsToKeep:
                             updateCursor.deleteRow()
-                            
+
                         else:
                             updateCursor.updateRow(pt)
 
@@ -764,53 +1017,23 @@ def function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster):
 
             # Write intersection point feature class to disk
             arcpy.CopyFeatures_management(intersectPoints, entryExitPoints)
+            instrumentation.count('cursor rows', noIntersectPoints)
 
-        #########################
-        ### Create watersheds ###
-        #########################
-
-        streamEnds = os.path.join(arcpy.env.scratchWorkspace, prefix + "streamEnds")
-        watershedsPoly = prefix + "watershedsPoly"
-        watershedsFC = os.path.join(outputFolder, "watersheds.shp")
+        ##########################
+        ### Collect watersheds ###
+        ##########################
 
-        # Create stream ends feature class
-        arcpy.CreateFeatureclass_management(os.path.dirname(streamEnds), os.path.basename(streamEnds), 'POINT', spatial_reference=spatialRefStreams)
-
-        # Add stream no field
-        arcpy.AddField_management(streamEnds, "STREAM_NO", "LONG")
-        
-        # Write stream end points to a feature class (used when calculating the watersheds)
-        insertCursor = arcpy.da.InsertCursor(streamEnds, ["SHAPE@X", "SHAPE@Y", "STREAM_NO"])
-        for stream in streamNetworks:
-            point = (stream.lastNodePoint.X, stream.lastNodePoint.Y, stream.ID)
-            insertCursor.insertRow((point))
-        del insertCursor
-
-        log.info("Determining watershed for each of the streams in the stream network")
-
-        # Snap pour points (stream ends) to surrounding cell with highest flow accumulation
-        pourPoints = SnapPourPoint(streamEnds, hydFAC, cellSize * 1.5, "STREAM_NO")
-
-        # Calculate watersheds from pour points
-        watersheds = Watershed(hydFDR, pourPoints)
-
-        # Convert watersheds raster to feature class
-        arcpy.RasterToPolygon_conversion(watersheds, watershedsPoly, "NO_SIMPLIFY")
-
-        # 'Rename' gridcode column to STREAM_NO
-        arcpy.AddField_management(watershedsPoly, "STREAM_NO", "LONG")
-        with arcpy.da.UpdateCursor(watershedsPoly, ["gridcode", "STREAM_NO"]) as updateCursor:
-            for row in updateCursor:
-                row[1] = row[0]
-                updateCursor.updateRow(row)
-
-        arcpy.DeleteField_management(watershedsPoly, "gridcode")
-
-        # Dissolve watersheds poly
-        arcpy.Dissolve_management(watershedsPoly, watershedsFC, "STREAM_NO")
+        # Time spent here is time the watersheds took beyond the entry/exit point work
+        instrumentation.startPhase('watersheds')
+        watershedsFC = watershedsTask.result()
+        instrumentation.endPhase()
+        instrumentation.count('stream networks', maxStreamNetworkID)
 
         return entryExitPoints, streamNetworkFC, watershedsFC
 
     except Exception:
+        if watershedsTask is not None:
+            watershedsTask.terminate()
+
         log.error("Critical exit point operations did not complete successfully")
         raise
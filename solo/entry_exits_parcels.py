@@ -0,0 +1,492 @@
+'''
+Planar-partition version of the entry/exit points calculation, used when the study area mask contains several
+adjacent parcels (e.g. a cadastral layer) which each need their own entry and exit points.
+
+Rather than running the single mask calculation once per parcel, the boundary edges of all the parcels are built
+once as a planar partition. Each unique edge knows the parcel on its left and the parcel on its right, so streams
+are intersected with each edge a single time and a crossing on a shared edge is given to both parcels with
+opposite point types (an exit from one parcel is an entry to its neighbour). A crossing at a vertex where three or
+more parcels meet is given to each of them.
+'''
+
+import arcpy
+import os
+
+import NB_EE.lib.log as log
+import NB_EE.lib.common as common
+import NB_EE.lib.instrumentation as instrumentation
+import NB_EE.lib.assign_stream_network_id as assign_stream_network_id
+import NB_EE.solo.entry_exits as entry_exits
+import NB_EE.lib.raster_store as raster_store
+
+from NB_EE.lib.refresh_modules import refresh_modules
+refresh_modules([log, common, instrumentation, assign_stream_network_id, entry_exits, raster_store])
+
+
+class Parcel:
+
+    def __init__(self, OID, parcelID, shape):
+        self.OID = OID
+        self.parcelID = parcelID
+        self.shape = shape
+
+
+class Crossing:
+
+    def __init__(self, crossingID, streamSeg, streamNetworkID, pointCoords, parcelOIDs, pointFAC):
+        self.crossingID = crossingID
+        self.streamSeg = streamSeg
+        self.streamNetworkID = streamNetworkID
+        self.pointCoords = pointCoords
+        self.parcelOIDs = parcelOIDs # parcels whose boundary the crossing lies on
+        self.pointFAC = pointFAC
+
+
+class ParcelPoint:
+
+    def __init__(self, crossing, parcelOID, pointType):
+        self.crossing = crossing
+        self.parcelOID = parcelOID
+        self.pointType = pointType
+
+
+def splitAtVertices(rings, tolerance=1e-6):
+
+    '''
+    Splits the edges of the rings (lists of rounded vertices, with the ring's parcel OID) at every vertex of any ring
+    which lies inside the edge, so that a boundary shared by two parcels is made of the same edges in both, even
+    where one side has a vertex the other does not (a T-junction). Returns a list of (start, end, OID), in the
+    direction of each ring.
+    '''
+
+    # Vertices binned on a grid about the mean edge length, so each edge is only tested against nearby vertices
+    lengths = [((ring[i + 1][0] - ring[i][0]) ** 2 + (ring[i + 1][1] - ring[i][1]) ** 2) ** 0.5
+               for ring, OID in rings for i in range(len(ring) - 1)]
+    binSize = max(sum(lengths) / max(len(lengths), 1), tolerance)
+
+    bins = {}
+    for ring, OID in rings:
+        for vertex in ring:
+            bins.setdefault((int(vertex[0] // binSize), int(vertex[1] // binSize)), set()).add(vertex)
+
+    edges = []
+    for ring, OID in rings:
+        for i in range(len(ring) - 1):
+
+            start, end = ring[i], ring[i + 1]
+            if start == end:
+                continue
+
+            dx, dy = end[0] - start[0], end[1] - start[1]
+            lengthSq = dx * dx + dy * dy
+
+            # Vertices inside the edge, by their position along it
+            splits = []
+            for binX in range(int(min(start[0], end[0]) // binSize), int(max(start[0], end[0]) // binSize) + 1):
+                for binY in range(int(min(start[1], end[1]) // binSize), int(max(start[1], end[1]) // binSize) + 1):
+                    for vertex in bins.get((binX, binY), ()):
+
+                        t = ((vertex[0] - start[0]) * dx + (vertex[1] - start[1]) * dy) / lengthSq
+                        if t <= 0 or t >= 1:
+                            continue
+
+                        cross = (vertex[0] - start[0]) * dy - (vertex[1] - start[1]) * dx
+                        if cross * cross <= tolerance * tolerance * lengthSq:
+                            splits.append((t, vertex))
+
+            points = [start] + [vertex for t, vertex in sorted(splits)] + [end]
+            for j in range(len(points) - 1):
+                if points[j] != points[j + 1]:
+                    edges.append((points[j], points[j + 1], OID))
+
+    return edges
+
+
+def buildParcelEdges(parcels, parcelEdges):
+
+    '''
+    Builds the boundary edge graph of the parcels. Each feature in parcelEdges is a unique edge with the OIDs of
+    the parcels on either side stored in LEFT_FID and RIGHT_FID (-1 where the edge is on the outer boundary).
+    '''
+
+    if common.checkLicenceLevel('Advanced'):
+        arcpy.PolygonToLine_management(parcels, parcelEdges, "IDENTIFY_NEIGHBORS")
+
+    else:
+        log.info("Advanced licence not available. Using alternative function to generate parcel edges.")
+
+        # Read the rings of each parcel. Coordinates are rounded so that the shared vertices of adjacent parcels match.
+        rings = []
+        with arcpy.da.SearchCursor(parcels, ["OID@", "SHAPE@"]) as searchCursor:
+
+            for row in searchCursor:
+                OID = row[0]
+                shape = row[1]
+
+                for part in shape:
+                    ring = []
+                    for pnt in part:
+
+                        # A None point separates the interior rings of the part
+                        if pnt is None:
+                            if len(ring) > 1:
+                                rings.append((ring, OID))
+                            ring = []
+                            continue
+
+                        ring.append((round(pnt.X, 6), round(pnt.Y, 6)))
+
+                    if len(ring) > 1:
+                        rings.append((ring, OID))
+
+        # Key each edge by its (ordered) end points, so edges shared by two parcels appear twice with the same key.
+        # Rings run with the parcel on their right (clockwise outer rings, anticlockwise holes), so a parcel which
+        # runs along the edge from its first to its last end point is on the edge's right, otherwise on its left.
+        edges = {}
+        edgeOrder = []
+        for start, end, OID in splitAtVertices(rings):
+
+            key = (min(start, end), max(start, end))
+            if key not in edges:
+                edges[key] = [-1, -1]
+                edgeOrder.append(key)
+
+            if start == key[0]:
+                edges[key][1] = OID
+            else:
+                edges[key][0] = OID
+
+        spatialRef = arcpy.Describe(parcels).spatialReference
+        arcpy.CreateFeatureclass_management(os.path.dirname(parcelEdges), os.path.basename(parcelEdges), 'POLYLINE', spatial_reference=spatialRef)
+        arcpy.AddField_management(parcelEdges, "LEFT_FID", "LONG")
+        arcpy.AddField_management(parcelEdges, "RIGHT_FID", "LONG")
+
+        with arcpy.da.InsertCursor(parcelEdges, ["SHAPE@", "LEFT_FID", "RIGHT_FID"]) as insertCursor:
+
+            for key in edgeOrder:
+                leftOID, rightOID = edges[key]
+                polyline = arcpy.Polyline(arcpy.Array([arcpy.Point(*key[0]), arcpy.Point(*key[1])]), spatialRef)
+                insertCursor.insertRow((polyline, leftOID, rightOID))
+
+
+def assignParcelTypes(crossings, lineSeg, parcels, hydFAC, spatialRef):
+
+    '''
+    Assigns point types to the crossings which lie on a straight line segment of a stream.
+
+    The downstream direction along the line is taken from the flow accumulation at its two vertices. For each
+    crossing, a probe point is placed half way between the crossing and the next crossing (or vertex) downstream.
+    The parcel which contains the probe is the one the stream flows into, so the crossing is an entry point for
+    that parcel and an exit point for the parcel on the other side of the edge.
+    '''
+
+    firstPoint = lineSeg.polyline.firstPoint
+    lastPoint = lineSeg.polyline.lastPoint
+
+    firstFAC = raster_store.getCellValue(hydFAC, firstPoint.X, firstPoint.Y)
+    lastFAC = raster_store.getCellValue(hydFAC, lastPoint.X, lastPoint.Y)
+
+    if firstFAC != 'NoData':
+        firstFAC = int(firstFAC)
+
+    if lastFAC != 'NoData':
+        lastFAC = int(lastFAC)
+
+    parcelPoints = []
+
+    if firstFAC == lastFAC or 'NoData' in [firstFAC, lastFAC]:
+        for crossing in crossings:
+            for OID in crossing.parcelOIDs:
+                parcelPoints.append(ParcelPoint(crossing, OID, "Cannot determine"))
+        return parcelPoints
+
+    # Orient the line so that it runs downstream
+    if firstFAC < lastFAC:
+        upX, upY, downX, downY = firstPoint.X, firstPoint.Y, lastPoint.X, lastPoint.Y
+    else:
+        upX, upY, downX, downY = lastPoint.X, lastPoint.Y, firstPoint.X, firstPoint.Y
+
+    lengthSq = (downX - upX) ** 2 + (downY - upY) ** 2
+
+    # Position of each crossing along the line (0 = upstream vertex, 1 = downstream vertex)
+    orderedCrossings = []
+    for crossing in crossings:
+        x, y = crossing.pointCoords
+        t = ((x - upX) * (downX - upX) + (y - upY) * (downY - upY)) / lengthSq
+        orderedCrossings.append((t, crossing))
+
+    orderedCrossings.sort(key=lambda x: x[0])
+
+    for i in range(0, len(orderedCrossings)):
+
+        t, crossing = orderedCrossings[i]
+
+        if i + 1 < len(orderedCrossings):
+            tNext = orderedCrossings[i + 1][0]
+        else:
+            tNext = 1.0
+
+        sides = crossing.parcelOIDs
+
+        # Crossing lies on the downstream vertex (or on top of the next crossing), so the probe cannot be placed
+        if tNext - t <= 1e-9:
+            for OID in sides:
+                parcelPoints.append(ParcelPoint(crossing, OID, "Touches"))
+            continue
+
+        tProbe = (t + tNext) / 2.0
+        probe = arcpy.Point(upX + tProbe * (downX - upX), upY + tProbe * (downY - upY))
+        probeGeom = arcpy.PointGeometry(probe, spatialRef)
+
+        for OID in sides:
+            if probeGeom.within(parcels[OID].shape):
+                pointType = 'Entry'
+            else:
+                pointType = 'Exit'
+
+            parcelPoints.append(ParcelPoint(crossing, OID, pointType))
+
+    return parcelPoints
+
+
+def removeSuperfluousPoints(parcelPoints, spatialRef, distanceThresh=100):
+
+    '''
+    Applies the single mask point removal rules within one parcel: entry/exit pairs which are closer than the
+    threshold distance are removed, and the exit point with the largest flow accumulation becomes the main exit.
+    '''
+
+    pointsToRemove = set()
+
+    for i in range(0, len(parcelPoints)):
+
+        pt1 = parcelPoints[i]
+        pt1Geom = arcpy.PointGeometry(arcpy.Point(*pt1.crossing.pointCoords), spatialRef)
+
+        for j in range(i + 1, len(parcelPoints)):
+
+            pt2 = parcelPoints[j]
+            if set([pt1.pointType, pt2.pointType]) == set(['Entry', 'Exit']):
+
+                pt2Geom = arcpy.PointGeometry(arcpy.Point(*pt2.crossing.pointCoords), spatialRef)
+                if pt1Geom.distanceTo(pt2Geom) < distanceThresh:
+                    pointsToRemove.add(i)
+                    pointsToRemove.add(j)
+
+    exitPoints = [i for i in range(0, len(parcelPoints)) if parcelPoints[i].pointType == 'Exit']
+
+    if len(exitPoints) > 0:
+        mainExit = max(exitPoints, key=lambda i: parcelPoints[i].crossing.pointFAC)
+        parcelPoints[mainExit].pointType = 'Main exit'
+        pointsToRemove.discard(mainExit)
+
+    return [parcelPoints[i] for i in range(0, len(parcelPoints)) if i not in pointsToRemove]
+
+
+def function(outputFolder, parcelsFC, parcelIDField, streamNetwork, facRaster, fdrRaster):
+
+    '''
+    Find the points where streams cross the boundaries of each parcel in parcelsFC, and whether each point is an
+    entry or exit point for that parcel. The watersheds for each stream network are also calculated.
+    '''
+
+    watershedsTask = None
+
+    try:
+        # Reset mask and extent environment variables
+        arcpy.ClearEnvironment("extent")
+        arcpy.ClearEnvironment("mask")
+
+        hydFAC = facRaster
+        hydFDR = fdrRaster
+        streams = streamNetwork
+
+        # Initialise temporary variables
+        prefix = os.path.join(arcpy.env.scratchGDB, "exitp_")
+
+        parcelsDissolved = prefix + "parcelsDissolved"
+        parcelEdges = prefix + "parcelEdges"
+        streamsCopy = prefix + "streamsCopy"
+        crossingMultiPoints = prefix + "crossingMultiPoints"
+        crossingPoints = prefix + "crossingPoints"
+        zonalStats = prefix + "zonalStats"
+
+        # Initialise output variables
+        entryExitPoints = os.path.join(outputFolder, 'entryexits.shp')
+        streamNetworkFC = os.path.join(outputFolder, 'streamnetwork.shp')
+        watershedsFC = os.path.join(outputFolder, 'watersheds.shp')
+
+        # Get cell size of raster
+        cellSize = float(arcpy.GetRasterProperties_management(hydFAC, "CELLSIZEX").getOutput(0))
+        cellSizeUnits = arcpy.Describe(hydFAC).spatialReference.linearUnitName
+        spatialRefStreams = arcpy.Describe(streams).spatialReference
+
+        # Read the parcels into memory
+        parcels = {}
+        with arcpy.da.SearchCursor(parcelsFC, ["OID@", parcelIDField, "SHAPE@"]) as searchCursor:
+            for row in searchCursor:
+                parcels[row[0]] = Parcel(row[0], row[1], row[2])
+
+        log.info(str(len(parcels)) + ' parcels read in')
+
+        # Find the type of the parcel ID field so that it can be carried through to the output
+        parcelIDFieldType = "TEXT"
+        for field in arcpy.ListFields(parcelsFC):
+            if field.name.lower() == parcelIDField.lower() and field.type in ["Integer", "SmallInteger", "OID"]:
+                parcelIDFieldType = "LONG"
+
+        ############################
+        ### Streams and networks ###
+        ############################
+
+        # Streams are filtered against the union of all the parcels
+        instrumentation.startPhase('dissolve')
+        arcpy.Dissolve_management(parcelsFC, parcelsDissolved)
+        instrumentation.count('scratch datasets created')
+        instrumentation.endPhase()
+        streamSegments = entry_exits.loadStreamSegments(streams, streamsCopy, parcelsDissolved)
+
+        log.info('Creating stream network feature class, with one row per stream')
+        streamSegments, maxStreamNetworkID = assign_stream_network_id.function(streamsCopy, streamNetworkFC, "FROM_NODE", "TO_NODE", streamSegments)
+
+        # Delineate the watersheds in a worker process while the parcel entry and exit points are found
+        instrumentation.startPhase('outlets')
+        streamNetworks = entry_exits.findTerminalNodesForStreamNetworks(streamSegments, maxStreamNetworkID)
+        entry_exits.findStreamNetworkOutlets(streamNetworks, streamSegments, cellSize, cellSizeUnits, spatialRefStreams, hydFAC, zonalStats)
+        watershedsTask = entry_exits.startWatersheds(streamNetworks, hydFAC, hydFDR, cellSize, spatialRefStreams, watershedsFC)
+        instrumentation.endPhase()
+
+        ###########################################
+        ### Intersect streams with parcel edges ###
+        ###########################################
+
+        instrumentation.startPhase('intersect')
+
+        log.info('Building parcel boundary edges')
+        buildParcelEdges(parcelsFC, parcelEdges)
+
+        # Each unique edge is intersected with the streams once
+        arcpy.Intersect_analysis([streamsCopy, parcelEdges], crossingMultiPoints, output_type="POINT")
+        arcpy.MultipartToSinglepart_management(crossingMultiPoints, crossingPoints)
+        instrumentation.count('scratch datasets created', 3)
+
+        instrumentation.startPhase('sampling')
+
+        # Read the crossings. A crossing at a vertex of the parcel edges is returned once per edge, so the rows are
+        # grouped by stream segment and location, and the crossing lies on the boundary of every parcel on either
+        # side of those edges (more than two where three or more parcels meet at the vertex).
+        log.info('Populate crossing points list')
+        crossingParcels = {}
+        crossingOrder = []
+        with arcpy.da.SearchCursor(crossingPoints, ["SEGMENT_ID", "LEFT_FID", "RIGHT_FID", "SHAPE@XY"]) as searchCursor:
+
+            for row in searchCursor:
+                instrumentation.count('cursor rows')
+                streamSeg = row[0]
+                pointCoords = row[3]
+
+                key = (streamSeg, round(pointCoords[0], 6), round(pointCoords[1], 6))
+                if key not in crossingParcels:
+                    crossingParcels[key] = (pointCoords, [])
+                    crossingOrder.append(key)
+
+                for OID in [row[1], row[2]]:
+                    if OID != -1 and OID not in crossingParcels[key][1]:
+                        crossingParcels[key][1].append(OID)
+
+        crossings = []
+        for key in crossingOrder:
+            streamSeg = key[0]
+            pointCoords, parcelOIDs = crossingParcels[key]
+
+            # The flow accumulation is sampled once per crossing, rather than once for each parcel
+            pointFAC = entry_exits.getMaxValueFromCellAndSurrounds(pointCoords[0], pointCoords[1], cellSize, cellSizeUnits,
+                                                                   spatialRefStreams, hydFAC, zonalStats)
+
+            crossings.append(Crossing(len(crossings), streamSeg, streamSegments[streamSeg].streamNetworkID,
+                                      pointCoords, sorted(parcelOIDs), pointFAC))
+
+        log.info(str(len(crossings)) + ' stream crossings of parcel edges found')
+        instrumentation.count('points', len(crossings))
+
+        #####################################
+        ### Assign point types per parcel ###
+        #####################################
+
+        instrumentation.startPhase('typing')
+
+        # Group the crossings by stream segment, so each segment's straight lines are only tested against its own crossings
+        crossingsBySegment = {}
+        for crossing in crossings:
+            crossingsBySegment.setdefault(crossing.streamSeg, []).append(crossing)
+
+        parcelPointsByParcel = {}
+        for streamSegID in crossingsBySegment:
+
+            remaining = list(crossingsBySegment[streamSegID])
+            for lineSeg in entry_exits.createStraightLineSegments([streamSegments[streamSegID]]):
+
+                if len(remaining) == 0:
+                    break
+
+                onLine = []
+                for crossing in remaining:
+                    pointGeom = arcpy.PointGeometry(arcpy.Point(*crossing.pointCoords))
+                    if lineSeg.polyline.contains(pointGeom):
+                        onLine.append(crossing)
+
+                if len(onLine) == 0:
+                    continue
+
+                for parcelPoint in assignParcelTypes(onLine, lineSeg, parcels, hydFAC, spatialRefStreams):
+                    parcelPointsByParcel.setdefault(parcelPoint.parcelOID, []).append(parcelPoint)
+
+                remaining = [crossing for crossing in remaining if crossing not in onLine]
+
+        ########################
+        ### Write the output ###
+        ########################
+
+        instrumentation.startPhase('write')
+
+        spatialRefPoints = arcpy.Describe(crossingPoints).spatialReference
+
+        arcpy.CreateFeatureclass_management(outputFolder, os.path.basename(entryExitPoints), 'POINT', spatial_reference=spatialRefPoints)
+        arcpy.AddField_management(entryExitPoints, "PARCEL_ID", parcelIDFieldType)
+        arcpy.AddField_management(entryExitPoints, "POINT_NO", "LONG")
+        arcpy.AddField_management(entryExitPoints, "POINT_TYPE", "TEXT")
+        arcpy.AddField_management(entryExitPoints, "STREAM_NO", "LONG")
+        arcpy.AddField_management(entryExitPoints, "SEGMENT_ID", "LONG")
+        arcpy.AddField_management(entryExitPoints, "POINT_FAC", "DOUBLE")
+
+        noPoints = 0
+        with arcpy.da.InsertCursor(entryExitPoints, ["SHAPE@XY", "PARCEL_ID", "POINT_NO", "POINT_TYPE", "STREAM_NO", "SEGMENT_ID", "POINT_FAC"]) as insertCursor:
+
+            for OID in sorted(parcelPointsByParcel):
+                for parcelPoint in removeSuperfluousPoints(parcelPointsByParcel[OID], spatialRefPoints):
+
+                    crossing = parcelPoint.crossing
+                    insertCursor.insertRow((crossing.pointCoords, parcels[OID].parcelID, crossing.crossingID + 1,
+                                            parcelPoint.pointType, crossing.streamNetworkID, crossing.streamSeg, crossing.pointFAC))
+                    noPoints += 1
+
+        if noPoints == 0:
+            log.warning('No entry or exit points found')
+            entryExitPoints = None
+
+        ##########################
+        ### Collect watersheds ###
+        ##########################
+
+        instrumentation.startPhase('watersheds')
+        watershedsFC = watershedsTask.result()
+        instrumentation.endPhase()
+
+        return entryExitPoints, streamNetworkFC, watershedsFC
+
+    except Exception:
+        if watershedsTask is not None:
+            watershedsTask.terminate()
+
+        log.error("Parcel entry/exit point operations did not complete successfully")
+        raise
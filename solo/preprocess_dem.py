@@ -3,22 +3,59 @@ Preprocessing tool for NB_EE. Generates hydrological and topographical files
 for use in other NB_EE functions.
 '''
 import arcpy
-from arcpy.sa import Int, Reclassify, RemapRange, RemapValue, Raster, Fill, Float
-from arcpy.sa import FlowAccumulation, FlowDirection, StreamOrder
+from arcpy.sa import Int, Reclassify, RemapRange, RemapValue, Raster, Fill, Float, Con
+from arcpy.sa import FlowAccumulation, FlowDirection
 import os
+import numpy as np
 
 import NB_EE.lib.progress as progress
 import NB_EE.lib.log as log
 import NB_EE.lib.common as common
 import NB_EE.solo.reconditionDEM as reconditionDEM
 import NB_EE.lib.baseline as baseline
+import NB_EE.lib.stream_order as stream_order
+import NB_EE.lib.raster_arrays as raster_arrays
+import NB_EE.lib.priority_flood as priority_flood
+import NB_EE.lib.flow_direction as flow_direction
+import NB_EE.lib.flow_accumulation as flow_accumulation
+import NB_EE.lib.fused_hydrology as fused_hydrology
+import NB_EE.lib.tiled_accumulation as tiled_accumulation
+import NB_EE.lib.tiled_fill as tiled_fill
+import NB_EE.lib.stream_tracer as stream_tracer
+import NB_EE.lib.local_ops as local_ops
+import NB_EE.lib.threshold_sweep as threshold_sweep
+import NB_EE.lib.array_pipeline as array_pipeline
+import NB_EE.lib.raster_store as raster_store
 
 from NB_EE.lib.refresh_modules import refresh_modules
-refresh_modules([log, common, reconditionDEM, baseline])
+refresh_modules([log, common, reconditionDEM, baseline, stream_order, raster_arrays, priority_flood, flow_direction,
+                 flow_accumulation, fused_hydrology, tiled_accumulation, tiled_fill, stream_tracer, local_ops, threshold_sweep,
+                 array_pipeline, raster_store])
 
 
 def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAccThresh,
-             smoothDropBuffer, smoothDrop, streamDrop, rerun=False):
+             smoothDropBuffer, smoothDrop, streamDrop, rerun=False, hydrologyEngine='ArcGIS', fillEpsilon=0.0,
+             thresholdSweep=[], inMemory=False, checkpoints=False, rasterStores=False):
+
+    '''
+    hydrologyEngine: 'ArcGIS' uses the Spatial Analyst hydrology tools. 'NumPy' uses the NumPy engines in lib
+    (priority_flood for filling sinks, flow_direction for D8 flow directions and flow_accumulation), which do not
+    need Spatial Analyst for those steps. Flow directions too large to hold in memory are accumulated in tiles
+    (lib/tiled_accumulation.py). 'NumPy (fused)' produces the filled DEM, flow direction and flow
+    accumulation in one pass (lib/fused_hydrology.py), reading burnedDEM once. 'NumPy (parallel)' fills sinks
+    (lib/tiled_fill.py) and calculates flow accumulation in tiles in a pool of worker processes. With the NumPy
+    engines, the stream lines are traced in one pass with lib/stream_tracer.py rather than with StreamToFeature, and
+    the rasters derived from rawDEM, hydFDR and hydFAC are created in one block by block pass (lib/local_ops.py).
+    fillEpsilon: with the NumPy engine, cells in filled sinks are raised by this amount above their outlet so that they drain.
+    thresholdSweep: list of further (minAccThresh, majAccThresh) pairs. The stream outputs for each pair are created in
+    a subfolder of outputFolder (lib/threshold_sweep.py), reusing hydFAC and hydFDR.
+    inMemory: with the NumPy engines, the rasters passed between code blocks are kept in memory as arrays
+    (lib/array_pipeline.py). burnedDEM is not written, and the final outputs are written in a writer thread while the
+    later blocks run. checkpoints: with inMemory, also write burnedDEM and log each block's progress as it completes,
+    so that a rerun can continue from any block.
+    rasterStores: hydDEM, hydFDR, hydFAC, streamInvRas and multRaster are also written to compressed raster stores
+    (lib/raster_store.py), which Terrestrial Flow and Entry/Exits read in place of the rasters.
+    '''
 
     try:
         # Set environment variables
@@ -56,9 +93,19 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
         allPolygonSinks = prefix + "allPolygonSinks"
         DEMTemp = prefix + "DEMTemp"
         hydFACTemp = prefix + "hydFACTemp"
+        streamLines = prefix + "streamLines"
+        streamDisplayLines = prefix + "streamDisplayLines"
+
+        # Read once here, as arcpy.env cannot be read while rasters are being written in the store's writer thread
+        scratchFolder = arcpy.env.scratchFolder
 
         # Saved as .tif as did not save as ESRI grid on server
-        streamsRasterFile = os.path.join(arcpy.env.scratchFolder, "base_") + "StreamsRaster.tif"
+        streamsRasterFile = os.path.join(scratchFolder, "base_") + "StreamsRaster.tif"
+
+        # Arrays passed between the NumPy code blocks
+        if inMemory and hydrologyEngine == 'ArcGIS':
+            log.warning('Intermediate rasters can only be kept in memory with the NumPy engines')
+        store = array_pipeline.ArrayStore(inMemory and hydrologyEngine != 'ArcGIS', checkpoints, scratchFolder)
 
         ###############################
         ### Save DEM to base folder ###
@@ -86,8 +133,9 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
         ### Create multiplier raster ###
         ################################
 
+        # The NumPy engines create the multiplier raster with the other derived rasters, in 'Create stream file'
         codeBlock = 'Create multiplier raster'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+        if hydrologyEngine == 'ArcGIS' and not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
             Reclassify(rawDEM, "Value", RemapRange([[-999999.9, 999999.9, 1]]), "NODATA").save(multRaster)
             progress.logProgress(codeBlock, outputFolder)
@@ -102,40 +150,100 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
 
             # Recondition DEM (burning stream network in using AGREE method)
             log.info("Burning streams into DEM.")
-            reconditionDEM.function(rawDEM, streamInput, smoothDropBuffer, smoothDrop, streamDrop, burnedDEM)
+            if hydrologyEngine == 'ArcGIS':
+                reconditionDEM.function(rawDEM, streamInput, smoothDropBuffer, smoothDrop, streamDrop, burnedDEM)
+            else:
+                reconditionDEM.function(rawDEM, streamInput, smoothDropBuffer, smoothDrop, streamDrop, burnedDEM, 'NumPy',
+                                        store)
             log.info("Completed stream network burn in to DEM")
 
-            progress.logProgress(codeBlock, outputFolder)
+            store.checkpoint(codeBlock, outputFolder)
+
+        ###########################################################
+        ### Fill sinks, flow direction and accumulation (fused) ###
+        ###########################################################
+
+        fusedBlocks = ['Fill sinks', 'Flow direction', 'Flow accumulation']
+        fused = hydrologyEngine == 'NumPy (fused)'
+
+        if fused:
+            if not all([progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun) for codeBlock in fusedBlocks]):
+
+                dem, grid = store.get('burnedDEM', burnedDEM)
+                store.release('burnedDEM')
+                filled, fdr, accumulation = fused_hydrology.fillDirectionAccumulation(dem, fillEpsilon)
+                del dem
+
+                # Each block is logged as its output is written, so that a rerun picks up where this one stopped
+                store.put('hydDEM', filled, grid, hydDEM)
+                log.info("Sinks in DEM filled")
+                store.checkpoint('Fill sinks', outputFolder)
+                del filled
+
+                store.put('hydFDR', fdr, grid, hydFDR, flow_direction.noDataCode)
+                log.info("Flow Direction calculated")
+                store.checkpoint('Flow direction', outputFolder)
+                del fdr
+
+                store.put('hydFAC', accumulation, grid, hydFAC)
+                store.put('hydFACInt', flow_accumulation.integerView(accumulation), grid, hydFACInt, -1)
+                log.info("Flow Accumulation calculated")
+                store.checkpoint('Flow accumulation', outputFolder)
+                del accumulation
 
         ##################
         ### Fill sinks ###
         ##################
 
         codeBlock = 'Fill sinks'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
-
-            Fill(burnedDEM).save(hydDEM)
+        if not fused and not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+
+            if hydrologyEngine == 'NumPy (parallel)' and not fillEpsilon > 0:
+                grid = store.grid('burnedDEM', burnedDEM)
+                demSource = store.tileSource('burnedDEM', burnedDEM, np.nan, shared=True)
+                tileList = tiled_fill.fill(demSource, scratchFolder)
+                store.release('burnedDEM')
+                raster_arrays.writeRasterTiles(tileList, grid, hydDEM, "32_BIT_FLOAT")
+                tiled_accumulation.deleteTileFiles(tileList)
+
+            elif hydrologyEngine in ['NumPy', 'NumPy (parallel)']:
+                if hydrologyEngine == 'NumPy (parallel)':
+                    log.warning('The parallel fill does not support a fill epsilon. Sinks will be filled in one pass.')
+
+                dem, grid = store.get('burnedDEM', burnedDEM)
+                store.release('burnedDEM')
+                store.put('hydDEM', priority_flood.fill(dem, fillEpsilon), grid, hydDEM)
+                del dem
+            else:
+                Fill(burnedDEM).save(hydDEM)
 
             log.info("Sinks in DEM filled")
-            progress.logProgress(codeBlock, outputFolder)
+            store.checkpoint(codeBlock, outputFolder)
 
         ######################
         ### Flow direction ###
         ######################
 
         codeBlock = 'Flow direction'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+        if not fused and not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
-            FlowDirection(hydDEM, "NORMAL").save(hydFDR)
+            if hydrologyEngine in ['NumPy', 'NumPy (parallel)']:
+                dem, grid = store.get('hydDEM', hydDEM)
+                store.release('hydDEM')
+                store.put('hydFDR', flow_direction.flowDirection(dem), grid, hydFDR, flow_direction.noDataCode)
+                del dem
+            else:
+                FlowDirection(hydDEM, "NORMAL").save(hydFDR)
             log.info("Flow Direction calculated")
-            progress.logProgress(codeBlock, outputFolder)
+            store.checkpoint(codeBlock, outputFolder)
 
         #################################
         ### Flow direction in degrees ###
         #################################
 
+        # The NumPy engines create the flow direction in degrees with the other derived rasters, in 'Create stream file'
         codeBlock = 'Flow direction in degrees'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+        if hydrologyEngine == 'ArcGIS' and not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
             # Save flow direction raster in degrees (for display purposes)
             degreeValues = RemapValue([[1, 90], [2, 135], [4, 180], [8, 225], [16, 270], [32, 315], [64, 0], [128, 45]])
@@ -147,15 +255,37 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
         #########################
 
         codeBlock = 'Flow accumulation'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
-
-            hydFACTemp = FlowAccumulation(hydFDR, "", "FLOAT")
-            hydFACTemp.save(hydFAC)
-            arcpy.sa.Int(Raster(hydFAC)).save(hydFACInt) # integer version
+        if not fused and not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+
+            fdrGrid = store.grid('hydFDR', hydFDR)
+            tiled = fdrGrid.rows * fdrGrid.cols > tiled_accumulation.maxInMemoryCells
+            if hydrologyEngine == 'NumPy (parallel)' or (hydrologyEngine == 'NumPy' and tiled):
+
+                # Too large to hold in memory, so accumulate in tiles in a pool of worker processes
+                fdrSource = store.tileSource('hydFDR', hydFDR, flow_direction.noDataCode, shared=True)
+                tileList = tiled_accumulation.accumulate(fdrSource, scratchFolder)
+
+                grid = fdrGrid
+                raster_arrays.writeRasterTiles([tile[:5] for tile in tileList], grid, hydFAC, "32_BIT_FLOAT")
+                raster_arrays.writeRasterTiles([tile[:4] + (tile[5],) for tile in tileList], grid, hydFACInt, "32_BIT_SIGNED", -1)
+                tiled_accumulation.deleteTileFiles(tileList)
+
+            elif hydrologyEngine == 'NumPy':
+                fdr, grid = store.get('hydFDR', hydFDR, np.uint8)
+                accumulation = flow_accumulation.accumulate(fdr)
+                del fdr
+
+                # Integer version is derived from the array in memory rather than re-reading hydFAC
+                store.put('hydFAC', accumulation, grid, hydFAC)
+                store.put('hydFACInt', flow_accumulation.integerView(accumulation), grid, hydFACInt, -1)
+                del accumulation
+            else:
+                hydFACTemp = FlowAccumulation(hydFDR, "", "FLOAT")
+                hydFACTemp.save(hydFAC)
+                arcpy.sa.Int(Raster(hydFAC)).save(hydFACInt) # integer version
             log.info("Flow Accumulation calculated")
 
-            progress.logProgress(codeBlock, outputFolder)
-
+            store.checkpoint(codeBlock, outputFolder)
 
         ##########################
         ### Create stream file ###
@@ -163,45 +293,76 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
 
         codeBlock = 'Create stream file'
         if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
-            
-            # Create accumulation in metres
-            streamAccHaFile = hydFACTemp * cellSizeDEM * cellSizeDEM / 10000.0
 
-            # Check stream initiation threshold reached
-            streamYes = float(arcpy.GetRasterProperties_management(streamAccHaFile, "MAXIMUM").getOutput(0))
+            if hydrologyEngine == 'ArcGIS':
+
+                # Create accumulation in metres
+                streamAccHaFile = hydFACTemp * cellSizeDEM * cellSizeDEM / 10000.0
+
+                # Check stream initiation threshold reached
+                streamYes = float(arcpy.GetRasterProperties_management(streamAccHaFile, "MAXIMUM").getOutput(0))
+
+            else:
+
+                # One pass over rawDEM, hydFDR and hydFAC creates the multiplier raster, the flow direction in degrees,
+                # the stream raster for input to the Nature Braid and the stream display classes
+                streamYes = local_ops.derivedRasters(rawDEM, hydFDR, hydFAC, multRaster, hydFDRDegrees, streamInvRas,
+                                                     streamsRasterFile, minAccThresh, majAccThresh, scratchFolder,
+                                                     store)
 
             if streamYes > float(minAccThresh):
 
-                reclassifyRanges = RemapRange([[-1000000, float(minAccThresh), 1],
-                                               [float(minAccThresh), 9999999999, 0]])
+                if hydrologyEngine == 'ArcGIS':
+
+                    reclassifyRanges = RemapRange([[-1000000, float(minAccThresh), 1],
+                                                   [float(minAccThresh), 9999999999, 0]])
+
+                    outNBstream = Reclassify(streamAccHaFile, "VALUE", reclassifyRanges)
+                    outNBstream.save(streamInvRas)
+                    del outNBstream
+                    log.info("Stream raster for input to the Nature Braid created")
 
-                outNBstream = Reclassify(streamAccHaFile, "VALUE", reclassifyRanges)
-                outNBstream.save(streamInvRas)
-                del outNBstream
-                log.info("Stream raster for input to the Nature Braid created")
+                    # Create stream file for display
+                    reclassifyRanges = RemapRange([[0, float(minAccThresh), "NODATA"],
+                                        [float(minAccThresh), float(majAccThresh), 1],
+                                        [float(majAccThresh), 99999999999999, 2]])
 
-                # Create stream file for display
-                reclassifyRanges = RemapRange([[0, float(minAccThresh), "NODATA"],
-                                    [float(minAccThresh), float(majAccThresh), 1],
-                                    [float(majAccThresh), 99999999999999, 2]])
+                    streamsRaster = Reclassify(streamAccHaFile, "Value", reclassifyRanges, "NODATA")
+                    streamsRaster.save(streamsRasterFile)
 
-                streamsRaster = Reclassify(streamAccHaFile, "Value", reclassifyRanges, "NODATA")
-                streamOrderRaster = StreamOrder(streamsRaster, hydFDR, "STRAHLER")
-                streamsRaster.save(streamsRasterFile)
+                    # All stream cells have the same value, so the lines are only split at stream junctions. As in the
+                    # rasters above, cells at exactly the threshold are not streams.
+                    streamCells = Con(streamAccHaFile > float(minAccThresh), 1)
 
-                # Create two streams feature classes - one for analysis and one for display
-                arcpy.sa.StreamToFeature(streamOrderRaster, hydFDR, streams, 'NO_SIMPLIFY')
-                arcpy.sa.StreamToFeature(streamOrderRaster, hydFDR, streamDisplay, 'SIMPLIFY')
+                    # Create two streams feature classes - one for analysis and one for display
+                    arcpy.sa.StreamToFeature(streamCells, hydFDR, streamLines, 'NO_SIMPLIFY')
+                    arcpy.sa.StreamToFeature(streamCells, hydFDR, streamDisplayLines, 'SIMPLIFY')
 
-                # Rename grid_code column to 'Strahler'
-                for streamFC in [streams, streamDisplay]:
+                    # Calculate the Strahler and Shreve orders from the FROM_NODE -> TO_NODE topology of the lines
+                    stream_order.writeStreamsWithOrder(streamLines, streams)
+                    stream_order.writeStreamsWithOrder(streamDisplayLines, streamDisplay)
 
-                    arcpy.AddField_management(streamFC, "Strahler", "LONG")
-                    arcpy.CalculateField_management(streamFC, "Strahler", "!GRID_CODE!", "PYTHON_9.3")
-                    arcpy.DeleteField_management(streamFC, "GRID_CODE")
+                    del streamsRaster
+                    del streamCells
 
-                del streamsRaster
-                del streamOrderRaster
+                else:
+
+                    # Trace the stream lines once, giving both the analysis lines and the simplified display lines
+                    accumulation, grid = store.get('hydFAC', hydFAC)
+                    fdr, fdrGrid = store.get('hydFDR', hydFDR, np.uint8)
+
+                    with np.errstate(invalid='ignore'):
+                        streamMask = accumulation * cellSizeDEM * cellSizeDEM / 10000.0 > float(minAccThresh)
+                    del accumulation
+
+                    xs, ys, lineStarts, fromNodes, toNodes, displayVertices = stream_tracer.traceStreams(streamMask, fdr, grid)
+                    del streamMask, fdr
+
+                    # The derived rasters must be written before the stream feature classes are created with arcpy
+                    store.waitForWrites()
+                    stream_order.writeTracedStreams(streams, grid.spatialRef, xs, ys, lineStarts, fromNodes, toNodes)
+                    stream_order.writeTracedStreams(streamDisplay, grid.spatialRef, xs, ys, lineStarts, fromNodes, toNodes,
+                                                    displayVertices)
 
                 log.info("Stream files created")
 
@@ -212,9 +373,53 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
                 common.logWarnings(outputFolder, warning)
 
                 # Create NBStream file from multiplier raster (i.e. all cells have value of 1 = no stream)
-                arcpy.CopyRaster_management(multRaster, streamInvRas)
+                if hydrologyEngine == 'ArcGIS':
+                    arcpy.CopyRaster_management(multRaster, streamInvRas)
 
-            progress.logProgress(codeBlock, outputFolder)
+            store.checkpoint(codeBlock, outputFolder)
+
+        ##########################
+        ### Write raster store ###
+        ##########################
+
+        # Compressed, tiled copies of the hydrology rasters, which the downstream tools sample without geoprocessing calls
+        codeBlock = 'Write raster store'
+        if rasterStores and not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+
+            # The stores record the size and modification time of their rasters, so the rasters must be written first
+            store.waitForWrites()
+
+            for name, raster, dtype, noDataValue in [('hydDEM', hydDEM, np.float32, np.nan),
+                                                     ('hydFDR', hydFDR, np.uint8, flow_direction.noDataCode),
+                                                     ('hydFAC', hydFAC, np.float32, np.nan),
+                                                     ('streamInv', streamInvRas, np.uint8, 255),
+                                                     ('mult', multRaster, np.uint8, 255)]:
+                source = store.tileSource(name, raster, noDataValue)
+                raster_store.writeStore(source, store.grid(name, raster), dtype, noDataValue, raster)
+
+            log.info("Raster store written")
+            store.checkpoint(codeBlock, outputFolder)
+
+        ##############################
+        ### Stream threshold sweep ###
+        ##############################
+
+        # Pairs of thresholds whose stream outputs have not yet been created
+        sweepPairs = []
+        for minSweepThresh, majSweepThresh in thresholdSweep:
+            codeBlock = 'Stream threshold sweep ' + str(minSweepThresh) + ' ' + str(majSweepThresh)
+            if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+                sweepPairs.append((minSweepThresh, majSweepThresh))
+
+        if len(sweepPairs) > 0:
+
+            threshold_sweep.sweep(outputFolder, hydFAC, hydFDR, sweepPairs, scratchFolder, store)
+
+            for minSweepThresh, majSweepThresh in sweepPairs:
+                store.checkpoint('Stream threshold sweep ' + str(minSweepThresh) + ' ' + str(majSweepThresh), outputFolder)
+
+        # All outputs must be written before their pyramids and statistics are built
+        store.finish()
 
         codeBlock = 'Clip data, build pyramids and generate statistics'
         if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
@@ -233,5 +438,7 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
         arcpy.env.snapRaster = None
         
     except Exception:
+        if 'store' in locals():
+            store.finish(logPending=False)
         log.error("Error in preprocessing operations")
         raise
@@ -2,10 +2,21 @@ import arcpy
 from arcpy.sa import EucDistance, Con, IsNull, Raster
 
 import NB_EE.lib.log as log
+import NB_EE.lib.raster_arrays as raster_arrays
+import NB_EE.lib.stream_burning as stream_burning
+import NB_EE.lib.rasterise_lines as rasterise_lines
 from NB_EE.lib.refresh_modules import refresh_modules
-refresh_modules([log])
+refresh_modules([log, raster_arrays, stream_burning, rasterise_lines])
 
-def function(DEM, streamNetwork, smoothDropBuffer, smoothDrop, streamDrop, outputReconDEM):
+def function(DEM, streamNetwork, smoothDropBuffer, smoothDrop, streamDrop, outputReconDEM, engine='ArcGIS', store=None):
+
+    '''
+    engine: 'ArcGIS' uses map algebra over the whole raster. 'NumPy' burns the streams into the DEM array with
+    lib/stream_burning.py, which only calculates distances within smoothDropBuffer of the streams. The streams are
+    rasterised in this process with lib/rasterise_lines.py.
+    store: with the NumPy engine, the reconditioned DEM is put in this lib/array_pipeline.ArrayStore as 'burnedDEM'
+    (an intermediate raster) rather than written to outputReconDEM.
+    '''
 
     try:
         # Set environment variables
@@ -21,6 +32,24 @@ def function(DEM, streamNetwork, smoothDropBuffer, smoothDrop, streamDrop, outpu
         size = arcpy.GetRasterProperties_management(DEM, "CELLSIZEX")
         OIDField = arcpy.Describe(streamNetwork).OIDFieldName
 
+        if engine == 'NumPy':
+            dem, grid = raster_arrays.readRaster(DEM)
+
+            # Burn the stream network into an array on the DEM's grid, without a scratch raster
+            streams = rasterise_lines.rasteriseLines(streamNetwork, grid)
+
+            stream_burning.burnStreams(dem, streams, grid.cellSize, smoothDropBuffer, smoothDrop, streamDrop)
+            del streams
+
+            if store is None:
+                raster_arrays.writeRaster(dem, grid, outputReconDEM)
+            else:
+                store.put('burnedDEM', dem, grid, outputReconDEM, final=False)
+            del dem
+
+            log.info("Reconditioned DEM generated")
+            return
+
         # Convert stream network to raster
         arcpy.PolylineToRaster_conversion(streamNetwork, OIDField, streamRaster, "", "", size)
 
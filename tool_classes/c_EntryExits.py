@@ -134,6 +134,16 @@ class StreamEntryExits(object):
         param.symbology = os.path.join(configuration.displayPath, "watersheds.lyr")
         params.append(param)
 
+        # 10 Parcel ID field
+        param = arcpy.Parameter()
+        param.name = u'Parcel_ID_field'
+        param.displayName = u'Parcel ID field (treats the study area mask as a set of adjacent parcels)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Field'
+        param.parameterDependencies = [u'Study_area_mask']
+        params.append(param)
+
         return params
 
     def isLicensed(self):
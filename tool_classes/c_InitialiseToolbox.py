@@ -41,10 +41,23 @@ class InitialiseToolbox(object):
                         if common.readXML(userSettings, 'developerMode') == 'Yes':
                             self.params[2].value = u'True'
 
+                    # Tile prefetching
+                    if not self.params[4].altered:
+                        prefetchTiles = common.readXML(userSettings, 'prefetchTiles')
+                        if prefetchTiles:
+                            self.params[4].value = prefetchTiles
+
+                    if not self.params[5].altered:
+                        prefetchMemoryMB = common.readXML(userSettings, 'prefetchMemoryMB')
+                        if prefetchMemoryMB:
+                            self.params[5].value = prefetchMemoryMB
+
                 # If the values have not been read from the configuration file, populate the values with defaults
                 defaults = {
                     'scratchPath': configuration.scratchPath,
-                    'developerMode': u'False'
+                    'developerMode': u'False',
+                    'prefetchTiles': configuration.prefetchTiles,
+                    'prefetchMemoryMB': configuration.prefetchMemoryMB
                 }
 
                 # Scratch path
@@ -60,6 +73,13 @@ class InitialiseToolbox(object):
                 if self.params[3].value is None:
                     self.params[3].value = defaults['developerMode']
 
+                # Tile prefetching
+                if self.params[4].value is None:
+                    self.params[4].value = defaults['prefetchTiles']
+
+                if self.params[5].value is None:
+                    self.params[5].value = defaults['prefetchMemoryMB']
+
             except Exception:
                 pass
 
@@ -67,6 +87,8 @@ class InitialiseToolbox(object):
 
                 self.params[1].value = defaults['scratchPath']
                 self.params[2].value = defaults['developerMode']
+                self.params[4].value = defaults['prefetchTiles']
+                self.params[5].value = defaults['prefetchMemoryMB']
     
         def updateMessages(self):
             """Modify the messages created by internal validation for each tool parameter.
@@ -123,6 +145,24 @@ class InitialiseToolbox(object):
         param.value = u'False'
         params.append(param)
 
+        # 4 Prefetch_tiles
+        param = arcpy.Parameter()
+        param.name = u'Prefetch_tiles'
+        param.displayName = u'Number of raster tiles to read ahead and write behind'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Long'
+        params.append(param)
+
+        # 5 Prefetch_memory
+        param = arcpy.Parameter()
+        param.name = u'Prefetch_memory'
+        param.displayName = u'Memory limit for tiles read ahead or waiting to be written (MB)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Double'
+        params.append(param)
+
         return params
 
     def isLicensed(self):
@@ -145,6 +145,67 @@ class PreprocessDEM(object):
         param.value = u'False'
         params.append(param)
 
+        # 11 Hydrology engine
+        param = arcpy.Parameter()
+        param.name = u'Hydrology_engine'
+        param.displayName = u'Hydrology engine'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'String'
+        param.filter.list = [u'ArcGIS', u'NumPy', u'NumPy (fused)', u'NumPy (parallel)']
+        param.value = u'ArcGIS'
+        params.append(param)
+
+        # 12 Fill epsilon
+        param = arcpy.Parameter()
+        param.name = u'Fill_epsilon'
+        param.displayName = u'Fill epsilon gradient (m, NumPy engine only)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Double'
+        param.value = u'0'
+        params.append(param)
+
+        # 13 Threshold sweep
+        param = arcpy.Parameter()
+        param.name = u'Threshold_sweep'
+        param.displayName = u'Further stream accumulation thresholds to sweep (ha)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'GPValueTable'
+        param.columns = [['GPDouble', 'Stream initiation threshold (ha)'], ['GPDouble', 'Major river threshold (ha)']]
+        params.append(param)
+
+        # 14 In memory intermediates
+        param = arcpy.Parameter()
+        param.name = u'In_memory_intermediates'
+        param.displayName = u'Keep intermediate rasters in memory (NumPy engines only)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Boolean'
+        param.value = u'False'
+        params.append(param)
+
+        # 15 Save checkpoints
+        param = arcpy.Parameter()
+        param.name = u'Save_checkpoints'
+        param.displayName = u'Save intermediate rasters so that a rerun can continue from any step'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Boolean'
+        param.value = u'False'
+        params.append(param)
+
+        # 16 Raster stores
+        param = arcpy.Parameter()
+        param.name = u'Write_raster_stores'
+        param.displayName = u'Write compressed raster stores for Terrestrial Flow and Entry/Exits'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Boolean'
+        param.value = u'False'
+        params.append(param)
+
         return params
 
     def isLicensed(self):
@@ -3,10 +3,12 @@ import os
 
 import NB_EE.lib.log as log
 import NB_EE.lib.common as common
+import NB_EE.lib.instrumentation as instrumentation
 import NB_EE.solo.entry_exits as entry_exits
+import NB_EE.solo.entry_exits_parcels as entry_exits_parcels
 
 from NB_EE.lib.refresh_modules import refresh_modules
-refresh_modules([log, common, entry_exits])
+refresh_modules([log, common, instrumentation, entry_exits, entry_exits_parcels])
 
 def function(params):
 
@@ -19,6 +21,7 @@ def function(params):
         streamNetwork = pText[4]
         facRaster = pText[5]
         fdrRaster = pText[6]
+        parcelIDField = pText[10]
 
         # Run system checks
         common.runSystemChecks()
@@ -26,8 +29,14 @@ def function(params):
         # Set up logging output to file
         log.setupLogging(outputFolder)
 
-        # Call Entry Exits function
-        entryExitPoints, streamNetworkFC, watershedsFC = entry_exits.function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster)
+        # Record phase timings and counters, written to the logs folder when the tool finishes
+        instrumentation.startProfile('StreamEntryExits')
+
+        # Call Entry Exits function. If a parcel ID field is given, each parcel in the mask gets its own entry/exit points.
+        if parcelIDField not in [None, '', '#']:
+            entryExitPoints, streamNetworkFC, watershedsFC = entry_exits_parcels.function(outputFolder, studyMask, parcelIDField, streamNetwork, facRaster, fdrRaster)
+        else:
+            entryExitPoints, streamNetworkFC, watershedsFC = entry_exits.function(outputFolder, studyMask, streamNetwork, facRaster, fdrRaster)
         
         # Set outputs
         if entryExitPoints is not None:
@@ -40,6 +49,15 @@ def function(params):
         arcpy.SetParameter(0, True)
         log.info("Entry/exits operations completed successfully")
 
+        profileFile = instrumentation.writeProfile(outputFolder)
+        log.info("Run profile written to " + str(profileFile))
+
     except Exception:
         log.exception("Entry/exits tool failed")
+
+        try:
+            instrumentation.writeProfile(outputFolder)
+        except Exception:
+            pass
+
         raise
@@ -19,6 +19,8 @@ def function(params):
     p = common.paramsAsText(params)
     scratchPath = p[1]
     developerMode = common.strToBool(p[2])
+    prefetchTiles = p[4]
+    prefetchMemoryMB = p[5]
 
     if developerMode == True:
         developerMode = 'Yes'
@@ -30,10 +32,18 @@ def function(params):
         configValues = [('scratchPath', scratchPath),
                         ('developerMode', developerMode)]
 
+        # Tile prefetching (lib/tile_prefetch.py)
+        if prefetchTiles not in [None, '', '#']:
+            configValues.append(('prefetchTiles', prefetchTiles))
+        if prefetchMemoryMB not in [None, '', '#']:
+            configValues.append(('prefetchMemoryMB', prefetchMemoryMB))
+
         common.writeXML(configuration.userSettingsFile, configValues)
 
         arcpy.AddMessage('Scratch path updated: ' + scratchPath)
         arcpy.AddMessage('Developer mode updated: ' + developerMode)
+        for name, value in configValues[2:]:
+            arcpy.AddMessage(name + ' updated: ' + value)
 
     except Exception:
         raise
@@ -11,11 +11,12 @@ import NB_EE.lib.log as log
 import NB_EE.lib.progress as progress
 import NB_EE.lib.common as common
 import NB_EE.lib.baseline as baseline
+import NB_EE.lib.threshold_sweep as threshold_sweep
 import NB_EE.solo.preprocess_dem as preprocess_dem
 
 from NB_EE.lib.refresh_modules import refresh_modules
 from NB_EE.lib.external import six # Python 2/3 compatibility module
-refresh_modules([log, common, baseline, preprocess_dem])
+refresh_modules([log, common, baseline, threshold_sweep, preprocess_dem])
 
 def function(params):
 
@@ -36,6 +37,24 @@ def function(params):
         smoothDrop = pText[8]
         streamDrop = pText[9]
         rerun = common.strToBool(pText[10])
+        hydrologyEngine = pText[11]
+        fillEpsilon = pText[12]
+        thresholdSweep = threshold_sweep.parseThresholdPairs(pText[13])
+        inMemory = pText[14]
+        checkpoints = pText[15]
+        rasterStores = pText[16]
+
+        if hydrologyEngine in [None, '', '#']:
+            hydrologyEngine = 'ArcGIS'
+
+        if fillEpsilon in [None, '', '#']:
+            fillEpsilon = 0.0
+        else:
+            fillEpsilon = float(fillEpsilon)
+
+        inMemory = inMemory not in [None, '', '#'] and common.strToBool(inMemory)
+        checkpoints = checkpoints not in [None, '', '#'] and common.strToBool(checkpoints)
+        rasterStores = rasterStores not in [None, '', '#'] and common.strToBool(rasterStores)
 
         log.info('Inputs read in')
 
@@ -186,7 +205,13 @@ def function(params):
                                 smoothDropBuffer,
                                 smoothDrop,
                                 streamDrop,
-                                rerun)
+                                rerun,
+                                hydrologyEngine,
+                                fillEpsilon,
+                                thresholdSweep,
+                                inMemory,
+                                checkpoints,
+                                rasterStores)
 
     except Exception:
         arcpy.SetParameter(0, False)
@@ -5,9 +5,10 @@ from scipy.ndimage.morphology import binary_dilation
 
 import NB_EE.lib.common as common
 import NB_EE.lib.log as log
+import NB_EE.lib.raster_store as raster_store
 
 from NB_EE.lib.refresh_modules import refresh_modules
-refresh_modules([log, common])
+refresh_modules([log, common, raster_store])
 
 def function(params):
 
@@ -39,15 +40,21 @@ def function(params):
         ### Flow direction raster to numpy ###
         ######################################
 
-        # Clip flow direction raster to study area
-        arcpy.sa.ExtractByMask(fdr, studyAreaMask).save(fdrClip)
+        # If Preprocess DEM wrote a raster store for the flow direction raster, the study area's window is read
+        # from it once the study area raster is made (below), rather than clipping and converting the raster
+        fdrStore = raster_store.findStore(fdr)
 
-        # Convert flow direction raster to numpy array
-        fdrArray = arcpy.RasterToNumPyArray(fdrClip)
-        fdrArray.astype(int)
-        rows, cols = fdrArray.shape # Returns the rows, columns
+        if fdrStore is None:
 
-        log.info('Flow direction raster converted to numpy array')
+            # Clip flow direction raster to study area
+            arcpy.sa.ExtractByMask(fdr, studyAreaMask).save(fdrClip)
+
+            # Convert flow direction raster to numpy array
+            fdrArray = arcpy.RasterToNumPyArray(fdrClip)
+            fdrArray.astype(int)
+            rows, cols = fdrArray.shape # Returns the rows, columns
+
+            log.info('Flow direction raster converted to numpy array')
 
         ###########################
         ### Study area to numpy ###
@@ -74,6 +81,17 @@ def function(params):
 
         log.info('Study area raster converted to numpy array')
 
+        if fdrStore is not None:
+
+            # Flow directions of the cells covering the study area raster (which is snapped to the flow direction grid)
+            studyAreaExtent = arcpy.Describe(studyAreaBinary).extent
+            rowStart, rowEnd, colStart, colEnd = fdrStore.windowForExtent(studyAreaExtent.XMin, studyAreaExtent.YMin,
+                                                                          studyAreaExtent.XMax, studyAreaExtent.YMax)
+            fdrArray = fdrStore.read(rowStart, rowEnd, colStart, colEnd)
+            rows, cols = fdrArray.shape
+
+            log.info('Flow direction read from raster store')
+
         ##############################################
         ### Create study area boundary numpy array ###
         ##############################################
@@ -211,12 +229,19 @@ def function(params):
                     outArray.itemset((rowNum, colNum), outValue)
 
         # Convert numpy array back to a raster
-        dsc = arcpy.Describe(fdrClip)
-        sr = dsc.SpatialReference
-        ext = dsc.Extent
-        lowerLeftCorner = arcpy.Point(ext.XMin, ext.YMin)
-
-        outRasterTemp = arcpy.NumPyArrayToRaster(outArray, lowerLeftCorner, dsc.meanCellWidth, dsc.meanCellHeight)
+        if fdrStore is None:
+            dsc = arcpy.Describe(fdrClip)
+            sr = dsc.SpatialReference
+            ext = dsc.Extent
+            lowerLeftCorner = arcpy.Point(ext.XMin, ext.YMin)
+            cellWidth, cellHeight = dsc.meanCellWidth, dsc.meanCellHeight
+        else:
+            sr = fdrStore.grid().spatialRef
+            lowerLeftCorner = arcpy.Point(fdrStore.lowerLeftX + colStart * fdrStore.cellSize,
+                                          fdrStore.lowerLeftY + (fdrStore.rows - rowEnd) * fdrStore.cellSize)
+            cellWidth, cellHeight = fdrStore.cellSize, fdrStore.cellSize
+
+        outRasterTemp = arcpy.NumPyArrayToRaster(outArray, lowerLeftCorner, cellWidth, cellHeight)
         arcpy.DefineProjection_management(outRasterTemp, sr)
 
         # Set zero values in raster to NODATA